@@ -1,95 +1,116 @@
-import json
-import os
-import time
-import subprocess
-
-# IMport the parent directory and the src to system
-actual_path = os.path.dirname(os.path.realpath(__file__))
-parent_path = os.path.abspath(os.path.join(actual_path, os.pardir))
-os.sys.path.append(parent_path)
-os.sys.path.append(os.path.join(parent_path, 'src'))
-
-from src.UdpComms import UdpComms
-from src.boards import setup_and_prepare_board
-from src.bids_files import save_raw_bids
-
-# Import the path to save the data
-from global_config import PATH_TO_SAVE_DATA_EEG_MI
-
-
-########################## THIS INFORMATION MUST BE DEFINED EVERY TIME THAT YOU HAVE TO ADQUIRE DATA ##########################
-info = {
-        "subject_ID": "001",
-        "session_ID": 0,
-        "run_ID": 1,
-        "task": "SSVEP",
-        "project_name": "SSVEPBCIproject",
-        "gender": "femenine",
-        "dominance": "right"
-    }
-
-
-# Obtain the path of the script
-script_folder = os.path.dirname(os.path.realpath(__file__))
-
-#################### LOAD CONFIG FILES ####################
-# Load the board configuration file
-with open(os.path.join(script_folder, 'configs', 'board_config.json')) as file:
-    board_config = json.load(file)  # Python dictionary
-
-# Load the stimulation protocol configuration file
-with open(os.path.join(script_folder, 'configs', 'stim_protocol_config.json')) as file:
-    stim_protocol_config = json.load(file)  # Python dictionary
-
-folder_name = stim_protocol_config['folder_name']
-file_name = stim_protocol_config['file_name']
-markers_dict = stim_protocol_config['markers_dict']
-stim_protocol_file_path = os.path.join(script_folder, 'stimulation_protocol',  
-                                       stim_protocol_config['folder_name'], 
-                                       stim_protocol_config['file_name'])
-
-# Set up the board, prepare it and start streaming
-board, mne_info, exg_channels = setup_and_prepare_board(board_config)
-board.start_stream()
-
-# Create UDP socket to use for receiving data from Unity application (necessary if a Unity application is used as stimulation protocol)
-sock = UdpComms(udpIP="127.0.0.1", portTX=8000, portRX=8001, enableRX=True, suppressWarnings=False)
-time.sleep(1.5)
-
-# Execute the stimulation protocol file (in this case, a Unity application but it could be any other)
-protocol = subprocess.Popen(stim_protocol_file_path)
-
-markers_time_list = []
-markers_code_list = []
-trials_arrays_list = []
-trials_counter = 0
-
-while True:   # Until the end_game marker is received
-    # Check if new data has been received from the Unity application
-    received_data = sock.ReceiveData()
-    if received_data: # if NEW data has been received since last ReadReceivedData function call
-        # Received data is a string with the format "marker_code-time stamp"
-        markers_time_list.append(received_data)
-        marker_code = int(received_data.split('-')[0])
-        markers_code_list.append(marker_code)
-        if marker_code != markers_dict['end_game']:
-            # Insert marker in the board
-            board.insert_marker(marker_code)
-            if marker_code == markers_dict['start_trial']:
-                trials_counter += 1
-                print ("Trial number: " + str(trials_counter))   # Just to see the progress of the calibration in the console
-        else:
-            break
-
-time.sleep(3)
-# End the game
-protocol.kill()
-
-# Get the full data from the board
-data = board.get_board_data()
-# Stop the board streaming
-board.stop_stream()
-board.release_session()
-
-# Save the markers and the data following BIDS format
-save_raw_bids(data, exg_channels, markers_dict, mne_info, info, PATH_TO_SAVE_DATA_EEG_MI, session_type='SSVEP')
\ No newline at end of file
+import json
+import os
+import time
+import subprocess
+
+# IMport the parent directory and the src to system
+actual_path = os.path.dirname(os.path.realpath(__file__))
+parent_path = os.path.abspath(os.path.join(actual_path, os.pardir))
+os.sys.path.append(parent_path)
+os.sys.path.append(os.path.join(parent_path, 'src'))
+
+from src.UdpComms import UdpComms
+from src.markers import MarkerProtocol, marker_inserter
+from src.boards import setup_and_prepare_board, StreamHealthMonitor
+from src.bids_writer import BidsWriter
+from src.spool import create_run_spool, finish_run
+from src.stimulator import HeadlessStimulator
+
+# Import the path to save the data
+from global_config import PATH_TO_SAVE_DATA_EEG_MI
+
+
+########################## THIS INFORMATION MUST BE DEFINED EVERY TIME THAT YOU HAVE TO ADQUIRE DATA ##########################
+info = {
+        "subject_ID": "001",
+        "session_ID": 0,
+        "run_ID": 1,
+        "task": "SSVEP",
+        "project_name": "SSVEPBCIproject",
+        "gender": "femenine",
+        "dominance": "right"
+    }
+# Run a Python stand-in of the stimulation protocol instead of the Unity application (e.g. on Linux, or to benchmark
+# the cue-to-decision latency), with headless_trials trials of each class
+headless_stimulator = False
+headless_trials = 10
+
+
+# Obtain the path of the script
+script_folder = os.path.dirname(os.path.realpath(__file__))
+
+#################### LOAD CONFIG FILES ####################
+# Load the board configuration file
+with open(os.path.join(script_folder, 'configs', 'board_config.json')) as file:
+    board_config = json.load(file)  # Python dictionary
+
+# Load the stimulation protocol configuration file
+with open(os.path.join(script_folder, 'configs', 'stim_protocol_config.json')) as file:
+    stim_protocol_config = json.load(file)  # Python dictionary
+
+folder_name = stim_protocol_config['folder_name']
+file_name = stim_protocol_config['file_name']
+markers_dict = stim_protocol_config['markers_dict']
+stim_protocol_file_path = os.path.join(script_folder, 'stimulation_protocol',  
+                                       stim_protocol_config['folder_name'], 
+                                       stim_protocol_config['file_name'])
+
+# Set up the board, prepare it and start streaming
+board, mne_info, exg_channels = setup_and_prepare_board(board_config, ring_buffer=True)
+# The run is spooled to disk as it is acquired, instead of being kept in memory until the end.
+# If the script crashes, the run can be recovered with: python -m src.spool <spool file>
+spool = create_run_spool(board, exg_channels, markers_dict, mne_info, info, PATH_TO_SAVE_DATA_EEG_MI, session_type='SSVEP')
+board.add_chunk_callback(spool.append)
+# Background process that saves the run in BIDS format at the end (it loads mne_bids during the run)
+bids_writer = BidsWriter()
+# Package counter gaps, effective sampling rate and read latency of the stream
+stream_health = StreamHealthMonitor(board_config['board_ID'])
+board.add_chunk_callback(stream_health.update)
+board.start_stream()
+
+# Create UDP socket to use for receiving data from Unity application (necessary if a Unity application is used as stimulation protocol)
+# The markers are received as MarkerEvents, from the binary marker protocol or the ASCII strings
+marker_protocol = MarkerProtocol()
+sock = UdpComms(udpIP="127.0.0.1", portTX=8000, portRX=8001, enableRX=True, suppressWarnings=False, protocol=marker_protocol)
+
+# The markers are inserted in the board by the receiving thread of the socket, as soon as they are received
+sock.AddCallback(marker_inserter(board, markers_dict['end_game']))
+time.sleep(1.5)
+
+# Execute the stimulation protocol file (in this case, a Unity application but it could be any other)
+if headless_stimulator:
+    protocol = HeadlessStimulator(markers_dict, headless_trials)
+    protocol.start()
+else:
+    protocol = subprocess.Popen(stim_protocol_file_path)
+
+markers_time_list = []
+markers_code_list = []
+trials_arrays_list = []
+trials_counter = 0
+
+while True:   # Until the end_game marker is received
+    # Check if new data has been received from the Unity application
+    event = sock.ReceiveData()
+    if event is not None: # if NEW data has been received since last ReadReceivedData function call
+        # Received data is a MarkerEvent (code, sequence number, sender clock, flags)
+        markers_time_list.append(event)
+        marker_code = event.code
+        markers_code_list.append(marker_code)
+        if marker_code != markers_dict['end_game']:
+            # The marker has already been inserted in the board by insert_received_marker
+            if marker_code == markers_dict['start_trial']:
+                trials_counter += 1
+                print ("Trial number: " + str(trials_counter))   # Just to see the progress of the calibration in the console
+        else:
+            break
+
+time.sleep(3)
+# End the game
+protocol.kill()
+if headless_stimulator:
+    print(f"Headless stimulator: {protocol.summary()}")
+
+# Stop the board, print the statistics of the run and save it in BIDS format in the background process of the
+# BIDS writer. The script does not wait for it: the writer prints when the run is saved, and the next run can be started
+finish_run(board, spool, sock, stream_health, bids_writer, board_config)
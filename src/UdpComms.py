@@ -1,108 +1,194 @@
-class UdpComms():
-    def __init__(self,udpIP,portTX,portRX,enableRX=False,suppressWarnings=True):
-        """
-        Constructor
-        :param udpIP: Must be string e.g. "127.0.0.1"
-        :param portTX: integer number e.g. 8000. Port to transmit from i.e From Python to other application
-        :param portRX: integer number e.g. 8001. Port to receive on i.e. From other application to Python
-        :param enableRX: When False you may only send from Python and not receive. If set to True a thread is created to enable receiving of data
-        :param suppressWarnings: Stop printing warnings if not connected to other application
-        """
-
-        import socket
-
-        self.udpIP = udpIP
-        self.udpSendPort = portTX
-        self.udpRcvPort = portRX
-        self.enableRX = enableRX
-        self.suppressWarnings = suppressWarnings # when true warnings are suppressed
-        self.isDataReceived = False
-        self.dataRX = None
-
-        # Connect via UDP
-        self.udpSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # internet protocol, udp (DGRAM) socket
-        self.udpSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # allows the address/port to be reused immediately instead of it being stuck in the TIME_WAIT state waiting for late packets to arrive.
-        self.udpSock.bind((udpIP, portRX))
-
-        # Create Receiving thread if required
-        if enableRX:
-            # print('activo enableRX')
-            import threading
-            self.rxThread = threading.Thread(target=self.ReadUdpThreadFunc, daemon=True)
-            self.rxThread.start()
-
-    def __del__(self):
-        self.CloseSocket()
-
-    def CloseSocket(self):
-        # Function to close socket
-        self.udpSock.close()
-
-    def SendData(self, strToSend):
-        # Use this function to send string to C#
-        self.udpSock.sendto(bytes(strToSend,'utf-8'), (self.udpIP, self.udpSendPort))
-
-    def ReceiveData(self):
-        """
-        Should not be called by user
-        Function BLOCKS until data is returned from C#. It then attempts to convert it to string and returns on successful conversion.
-        An warning/error is raised if:
-            - Warning: Not connected to C# application yet. Warning can be suppressed by setting suppressWarning=True in constructor
-            - Error: If data receiving procedure or conversion to string goes wrong
-            - Error: If user attempts to use this without enabling RX
-        :return: returns None on failure or the received string on success
-        """
-        if not self.enableRX: # if RX is not enabled, raise error
-            raise ValueError("Attempting to receive data without enabling this setting. Ensure this is enabled from the constructor")
-
-        data = None
-        # print('entro ReceiveData')
-        try:
-            data, _ = self.udpSock.recvfrom(1024)
-            data = data.decode('utf-8')
-        except WindowsError as e:
-            if e.winerror == 10054: # An error occurs if you try to receive before connecting to other application
-                if not self.suppressWarnings:
-                    print("Are You connected to the other application? Connect to it!")
-                else:
-                    pass
-            #else:
-            #    raise ValueError("Unexpected Error. Are you sure that the received data can be converted to a string")
-
-        return data
-
-    def ReadUdpThreadFunc(self): # Should be called from thread
-        """
-        This function should be called from a thread [Done automatically via constructor]
-                (import threading -> e.g. udpReceiveThread = threading.Thread(target=self.ReadUdpNonBlocking, daemon=True))
-        This function keeps looping through the BLOCKING ReceiveData function and sets self.dataRX when data is received and sets received flag
-        This function runs in the background and updates class variables to read data later
-
-        """
-
-        self.isDataReceived = False # Initially nothing received
-        # print('entro ReadUdpThreadFunc')
-        while True:
-            data = self.ReceiveData()  # Blocks (in thread) until data is returned (OR MAYBE UNTIL SOME TIMEOUT AS WELL)
-            self.dataRX = data # Populate AFTER new data is received
-            self.isDataReceived = True
-            # print('entre al true de ReadUdpThreadFunc')
-            # When it reaches here, data received is available
-
-    def ReadReceivedData(self):
-        """
-        This is the function that should be used to read received data
-        Checks if data has been received SINCE LAST CALL, if so it returns the received string and sets flag to False (to avoid re-reading received data)
-        data is None if nothing has been received
-        :return:
-        """
-        #print('entro ReadReceivedData')
-        # time.sleep(0.01)
-        data = None
-
-        if self.isDataReceived: # if data has been received
-            self.isDataReceived = False
-            data = self.dataRX
-            self.dataRX = None # Empty receive buffer
-
-        return data
\ No newline at end of file
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+class UdpComms():
+    def __init__(self,udpIP,portTX,portRX,enableRX=False,suppressWarnings=True,maxQueue=1024,protocol=None):
+        """
+        Constructor
+        :param udpIP: Must be string e.g. "127.0.0.1"
+        :param portTX: integer number e.g. 8000. Port to transmit from i.e From Python to other application
+        :param portRX: integer number e.g. 8001. Port to receive on i.e. From other application to Python
+        :param enableRX: When False you may only send from Python and not receive. If set to True a thread is created to enable receiving of data
+        :param suppressWarnings: Stop printing warnings if not connected to other application
+        :param maxQueue: Number of received strings kept until they are read. When the queue is full, the oldest one is dropped, counted in n_overflow (saved with the stream statistics of the run, see src.spool.finish_run) and reported unless suppressWarnings
+        :param protocol: None to receive strings, or a MarkerProtocol (src.markers) to receive the MarkerEvents of the binary (or ASCII) marker protocol
+
+        The receiving thread is the only reader of the socket: it waits on a selector (no busy-waiting), and every
+        datagram is stamped with time.monotonic_ns() right after the socket read, passed to the registered callbacks
+        (AddCallback) and put in the queue, read by ReceiveData, ReceiveDataStamped, ReadReceivedData or
+        DrainReceivedData. The callbacks run in the receiving thread as soon as the datagram is read, e.g. to
+        insert the marker in the board, and the time from the read to the end of the callbacks is kept in
+        dispatch_latencies (seconds).
+        The queue is a deque written only by the receiving thread: appending and popping are atomic, so it needs no lock,
+        and an Event wakes up the blocking readers.
+        """
+
+        self.udpIP = udpIP
+        self.udpSendPort = portTX
+        self.udpRcvPort = portRX
+        self.enableRX = enableRX
+        self.suppressWarnings = suppressWarnings # when true warnings are suppressed
+        self.protocol = protocol
+        self.callbacks = []
+        self.receivedData = deque(maxlen=maxQueue)   # (string, receive time in ns)
+        self.dataAvailable = threading.Event()
+        self.n_received = 0
+        self.n_overflow = 0
+        self.dispatch_latencies = deque(maxlen=10000)
+        self.closed = False
+
+        # Connect via UDP
+        self.udpSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # internet protocol, udp (DGRAM) socket
+        self.udpSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # allows the address/port to be reused immediately instead of it being stuck in the TIME_WAIT state waiting for late packets to arrive.
+        self.udpSock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20) # larger receive buffer of the OS, so bursts of markers are not dropped before they are read
+        self.udpSock.bind((udpIP, portRX))
+
+        # Create Receiving thread if required
+        if enableRX:
+            self.udpSock.setblocking(False)
+            # The socket pair wakes up the selector when the socket is closed
+            self.wakeupRX, self.wakeupTX = socket.socketpair()
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.udpSock, selectors.EVENT_READ)
+            self.selector.register(self.wakeupRX, selectors.EVENT_READ)
+            self.rxThread = threading.Thread(target=self.ReadUdpThreadFunc, daemon=True)
+            self.rxThread.start()
+
+    def __del__(self):
+        self.CloseSocket()
+
+    def CloseSocket(self):
+        # Function to close socket, the receiving thread is stopped first
+        if self.closed:
+            return
+        self.closed = True
+        if self.enableRX:
+            self.wakeupTX.send(b'\0')
+            if self.rxThread is not threading.current_thread():
+                self.rxThread.join()
+            self.selector.close()
+            self.wakeupRX.close()
+            self.wakeupTX.close()
+        self.udpSock.close()
+
+    def SendData(self, strToSend):
+        # Use this function to send string to C#
+        self.udpSock.sendto(bytes(strToSend,'utf-8'), (self.udpIP, self.udpSendPort))
+
+    def SendBytes(self, bytesToSend):
+        # Use this function to send an already encoded message, e.g. MarkerProtocol.encode_decision
+        self.udpSock.sendto(bytesToSend, (self.udpIP, self.udpSendPort))
+
+    def AddCallback(self, callback):
+        """
+        Registers a function called with (data, receive_time) for every received string (or MarkerEvent, with a protocol), in the receiving thread.
+        receive_time is the time.monotonic_ns() of the socket read.
+        """
+        self.callbacks.append(callback)
+
+    def ReceiveData(self, timeout=None):
+        """
+        Function BLOCKS until data is received from C#, or until timeout seconds, and returns the oldest received string.
+        Every received string is returned once, in order.
+        An error is raised if the user attempts to use this without enabling RX
+        :return: returns None on timeout or the received string
+        """
+        received = self.ReceiveDataStamped(timeout)
+        return None if received is None else received[0]
+
+    def ReceiveDataStamped(self, timeout=None):
+        """
+        As ReceiveData, but returns (string, receive time), with the time.monotonic_ns() of the socket read
+        :return: returns None on timeout or the received (string, receive time)
+        """
+        if not self.enableRX: # if RX is not enabled, raise error
+            raise ValueError("Attempting to receive data without enabling this setting. Ensure this is enabled from the constructor")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return self.receivedData.popleft()
+            except IndexError:
+                pass
+            # The event is cleared before checking the queue again, so a string appended meanwhile sets it again
+            self.dataAvailable.clear()
+            if self.receivedData:
+                continue
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            self.dataAvailable.wait(remaining)
+
+    def ReadUdpThreadFunc(self): # Should be called from thread
+        """
+        This function should be called from a thread [Done automatically via constructor]
+        It waits on the selector until a datagram is available, reads every available datagram, converts it to string,
+        calls the callbacks and puts it in the queue of received data. It returns when the socket is closed.
+        """
+        while not self.closed:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.wakeupRX:
+                    return
+                while True:
+                    try:
+                        data, _ = self.udpSock.recvfrom(1024)
+                        receive_time = time.monotonic_ns()
+                        read_time = time.perf_counter()
+                    except BlockingIOError:   # every available datagram has been read
+                        break
+                    except ConnectionResetError:
+                        # On Windows, an error occurs if you try to receive before connecting to other application
+                        if not self.suppressWarnings:
+                            print("Are You connected to the other application? Connect to it!")
+                        continue
+                    except OSError:   # the socket was closed
+                        return
+                    try:
+                        received = self.protocol.decode(data) if self.protocol is not None else [data.decode('utf-8')]
+                    except ValueError:   # includes UnicodeDecodeError
+                        if not self.suppressWarnings:
+                            print(f"Received data that can not be decoded: {data!r}")
+                        continue
+                    for data in received:   # the events of a batch share the receive time
+                        self.DispatchData(data, receive_time, read_time)
+
+    def DispatchData(self, data, receive_time, read_time):
+        # Passes the received string to the callbacks and to the queue of received data
+        for callback in self.callbacks:
+            try:
+                callback(data, receive_time)
+            except Exception as e:   # the receiving thread keeps running
+                print(f"Error in the UDP callback {callback}: {e!r}")
+        self.dispatch_latencies.append(time.perf_counter() - read_time)
+        if len(self.receivedData) == self.receivedData.maxlen:
+            self.n_overflow += 1   # the oldest string is dropped by the append
+            if not self.suppressWarnings:
+                print(f"The queue of received data is full, the oldest string was dropped ({self.n_overflow} dropped)")
+        self.receivedData.append((data, receive_time))
+        self.n_received += 1
+        self.dataAvailable.set()
+
+    def ReadReceivedData(self):
+        """
+        This is the function that should be used to read received data without blocking
+        Returns the oldest string received and not read yet, or None if nothing has been received
+        :return:
+        """
+        try:
+            return self.receivedData.popleft()[0]
+        except IndexError:
+            return None
+
+    def DrainReceivedData(self):
+        """
+        Returns every (string, receive time) received and not read yet, oldest first, without blocking
+        :return:
+        """
+        drained = []
+        while True:
+            try:
+                drained.append(self.receivedData.popleft())
+            except IndexError:
+                return drained
@@ -1,63 +1,197 @@
-import datetime
-import mne
-from mne_bids import write_raw_bids
-from mne_bids import BIDSPath
-import numpy as np
-import os
-
-def save_raw_bids(data, exg_channels, markers_dict, mne_info, info, save_data_path, session_type): 
-    """
-    Save the raw data in BIDS format.
-
-    """
-    
-    # Create the MNE raw object
-    eeg_data = data[exg_channels]
-    eeg_data = eeg_data / 1000000  # BrainFlow returns data in uV, convert to V for MNE
-    raw = mne.io.RawArray(eeg_data, mne_info)
-    
-    # Measurement date
-    meas_date = datetime.datetime.now(datetime.timezone.utc)
-    raw.set_meas_date(meas_date)
-    raw.info['line_freq'] = 50
-    
-    # Gender
-    gender = info['gender']
-    if (gender == 'masculine'):
-        gen = 1
-    elif (gender == 'female'):
-        gen = 2
-    else:
-        gen = 0
-    
-    # Dominance
-    dominance = info['dominance']
-    if (dominance == 'right'):
-        domi = 1
-    elif (dominance == 'left'):
-        domi = 2
-    else:
-        domi = 3
-    
-    raw.info['subject_info'] = {'sex': gen, 'birthday': None, 'hand': domi}
-    
-    bids_path = BIDSPath(subject=info['subject_ID'],
-                         session=info['session_ID'],
-                         task=session_type,
-                         run=info['run_ID'],
-                         root=os.path.join(save_data_path, info['project_name']))
-    
-    # Get the events codes from the data
-    events = data[-1][data[-1] != 0]
-    # Get the events times
-    events_times = np.where(data[-1] != 0)[0]
-    # Create the MNE-like events array
-    events_array = np.zeros((events.size, 3))
-    events_array[:, 0] = events_times
-    events_array[:, 2] = events
-
-    # Save the raw data in BIDS format
-    write_raw_bids(raw, bids_path, format='BrainVision', allow_preload=True, events=events_array, event_id=markers_dict, overwrite=True)
-        
-        
-   
\ No newline at end of file
+import datetime
+import json
+import numpy as np
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:   # Windows
+    fcntl = None
+    import msvcrt
+
+from src.brainvision import write_brainvision
+from src.event_index import read_event_index
+from src.spool import read_spool
+
+@contextmanager
+def dataset_lock(root, timeout=600, poll_interval=0.05):
+    """
+    Exclusive lock of a BIDS dataset folder, held while a run is written, because write_raw_bids also updates
+    the dataset files (participants.tsv, dataset_description.json, scans.tsv) of all the runs. The lock is an
+    OS lock of the file .bids_lock in root (with the pid of its owner), so it works between the processes that
+    write to the dataset, and it is released by the OS when its process dies, e.g. killed while writing a run.
+    The file is kept, removing it would let another process lock a new file while the old one is locked.
+    """
+    os.makedirs(root, exist_ok=True)
+    lock_path = os.path.join(root, '.bids_lock')
+    deadline = time.monotonic() + timeout
+    with open(lock_path, 'a+') as file:
+        while True:
+            try:
+                lock_file(file)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"The BIDS dataset {root} is locked by another process (see the pid in {lock_path})")
+                time.sleep(poll_interval)
+        try:
+            file.seek(0)
+            file.truncate()
+            file.write(str(os.getpid()))
+            file.flush()
+            yield
+        finally:
+            unlock_file(file)
+
+def lock_file(file):
+    # Non-blocking exclusive lock of an open file, raises OSError if another process holds it
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+
+def unlock_file(file):
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def save_raw_bids(data, exg_channels, markers_dict, mne_info, info, save_data_path, session_type, extra_channels=None,
+                  stream_stats=None, fmt='binary_float32', resolution=0.1, event_index=None, temp_folder=None): 
+    """
+    Save the raw data in BIDS format.
+    data is the board data array, or the memory-mapped data of a spool. The BrainVision files are written
+    in chunks from it (see src.brainvision), so the recording is never loaded in memory, and write_raw_bids
+    copies them to the dataset and writes the BIDS sidecars. fmt and resolution are the format of the
+    .eeg file, float32 by default as write_raw_bids, or int16 in units of resolution uV.
+    extra_channels is a list of (data in uV, mne info) of other boards aligned to the samples of data,
+    as returned by MultiBoardSession.get_aligned_channels (e.g. the EMG of a Ganglion).
+    stream_stats are the statistics of a StreamHealthMonitor, saved next to the EEG file as
+    *_streamhealth.json.
+    event_index is the EventIndex of the run (src.event_index), the events are taken from it instead of
+    scanning the marker channel, at the onsets used by the online decoders (the back-dated samples of the
+    stimuli), and it is saved next to the EEG file as *_eventindex.tsv, with the recorded samples too.
+    temp_folder is the folder where the BrainVision files are written before write_raw_bids copies them
+    (e.g. the folder of the spool). By default, the sourcedata folder of the dataset, which is removed
+    afterwards if it was created for them.
+    """
+    # mne and mne_bids are only imported when the run is saved, at the end of the session
+    import mne
+    from mne_bids import write_raw_bids
+    from mne_bids import BIDSPath
+    
+    # The IDs can be given as numbers in the scripts, mne_bids needs strings, and BIDS does not allow
+    # '-' or '_' in the task (MI_testing_online is saved as task MItestingonline)
+    bids_path = BIDSPath(subject=str(info['subject_ID']),
+                         session=str(info['session_ID']),
+                         task=session_type.replace('_', '').replace('-', ''),
+                         run=str(info['run_ID']),
+                         root=os.path.join(save_data_path, info['project_name']),
+                         datatype='eeg',   # the EMG of other boards is saved with the EEG
+                         suffix='eeg',
+                         extension='.vhdr')
+    
+    n_samples = data.shape[1]
+    chunk_samples = 100000
+    if event_index is not None:
+        # The events of a partial spool can be indexed after its last written sample
+        events_array = event_index.events_array()
+        events_array = events_array[events_array[:, 0] < n_samples]
+    else:
+        # Get the events times and codes from the marker channel
+        events_times = [start + np.flatnonzero(np.asarray(data[-1, start:start + chunk_samples]))
+                        for start in range(0, n_samples, chunk_samples)]
+        events_times = np.concatenate(events_times) if events_times else np.zeros(0, dtype=int)
+        events = np.asarray(data[-1, events_times]).astype(int)
+        # Create the MNE-like events array
+        events_array = np.zeros((events.size, 3), dtype=int)
+        events_array[:, 0] = events_times
+        events_array[:, 2] = events
+
+    # Write the BrainVision files
+    sources = [(data, exg_channels)]
+    ch_names = list(mne_info['ch_names'])
+    ch_types = {}
+    for extra_data, extra_info in extra_channels or []:
+        sources.append((extra_data, np.arange(len(extra_data))))
+        ch_names += extra_info['ch_names']
+        ch_types.update(zip(extra_info['ch_names'], extra_info.get_channel_types()))
+    # They are written in temp_folder before write_raw_bids copies them
+    if temp_folder is None:
+        temp_folder = os.path.join(bids_path.root, 'sourcedata')
+    created_folder = not os.path.isdir(temp_folder)
+    os.makedirs(temp_folder, exist_ok=True)
+    try:
+        with tempfile.TemporaryDirectory(dir=temp_folder) as folder:
+            vhdr_path = write_brainvision(sources, mne_info['sfreq'], ch_names, bids_path.copy().update(extension=None).basename, folder,
+                                          events_array[:, [0, 2]], fmt, resolution, chunk_samples)
+            # Raw of the files, not loaded in memory, with the events in events_array instead of annotations
+            raw = mne.io.read_raw_brainvision(vhdr_path, preload=False)
+            raw.set_annotations(None)
+            if ch_types:
+                raw.set_channel_types(ch_types)
+    
+            # Measurement date
+            meas_date = datetime.datetime.now(datetime.timezone.utc)
+            raw.set_meas_date(meas_date)
+            raw.info['line_freq'] = 50
+    
+            # Gender
+            gender = info['gender']
+            if (gender == 'masculine'):
+                gen = 1
+            elif (gender == 'female'):
+                gen = 2
+            else:
+                gen = 0
+    
+            # Dominance
+            dominance = info['dominance']
+            if (dominance == 'right'):
+                domi = 1
+            elif (dominance == 'left'):
+                domi = 2
+            else:
+                domi = 3
+    
+            raw.info['subject_info'] = {'sex': gen, 'birthday': None, 'hand': domi}
+
+            # Save the raw data in BIDS format, the files are copied
+            with dataset_lock(bids_path.root):
+                if bids_path.fpath.exists():
+                    # Removed first, write_raw_bids would load the raw in memory to overwrite it
+                    bids_path.fpath.unlink()
+                write_raw_bids(raw, bids_path, events=events_array, event_id=markers_dict, overwrite=True)
+
+                if stream_stats is not None:
+                    stats_path = bids_path.copy().update(suffix='streamhealth', extension='.json', check=False).fpath
+                    with open(stats_path, 'w') as file:
+                        json.dump(stream_stats, file, indent=4, default=float)
+                if event_index is not None:
+                    event_index.save(bids_path.copy().update(suffix='eventindex', extension='.tsv', check=False).fpath)
+    finally:
+        if created_folder and not os.listdir(temp_folder):
+            os.rmdir(temp_folder)
+    return bids_path.fpath
+
+def save_raw_bids_from_spool(spool_path, save_data_path=None, extra_channels=None, stream_stats=None):
+    """
+    Save in BIDS format the run of an acquisition spool (see src.spool), complete or partial.
+    The spool header has the arguments of save_raw_bids, save_data_path overrides the one of the acquisition.
+    The events are taken from the event index of the spool (<spool_path>.events.tsv) when it has one.
+    """
+    import mne
+
+    header, data = read_spool(spool_path)
+    metadata = header['metadata']
+    mne_info = mne.create_info(ch_names=metadata['ch_names'], sfreq=metadata['sfreq'], ch_types='eeg')
+    events_path = spool_path + '.events.tsv'
+    event_index = read_event_index(events_path) if os.path.exists(events_path) else None
+    return save_raw_bids(data, metadata['exg_channels'], metadata['markers_dict'], mne_info, metadata['info'],
+                         save_data_path or metadata['save_data_path'], metadata['session_type'], extra_channels, stream_stats,
+                         event_index=event_index, temp_folder=os.path.dirname(os.path.abspath(spool_path)))
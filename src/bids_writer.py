@@ -0,0 +1,113 @@
+import os
+import pickle
+import subprocess
+import sys
+import threading
+import traceback
+
+class BidsWriter():
+    """
+    Writes the runs to BIDS in a background process, so the end of a run does not wait for write_raw_bids.
+
+    The process is started with the writer, and imports mne and mne_bids while the run is acquired. submit
+    queues a run, given by its closed acquisition spool (see src.spool) and the extra arguments of
+    save_raw_bids, and returns its job ID. The runs are written one after the other in the order they were
+    submitted, so the writes to the same BIDS path are ordered, and the dataset files are updated under
+    the dataset lock (see src.bids_files.dataset_lock).
+    The result of each run is (True, path of the written file) or (False, traceback of the error), given by
+    wait, and it is also printed by the process. The error of a run is also written next to its spool
+    (<spool_path>.bids_error.txt), and reported when the next run is spooled (see src.spool.create_run_spool). close waits for the queued runs and stops the process, or
+    with wait=False lets the process finish them after the script has finished, so the next run can be started.
+
+    The process is a python -m src.bids_writer subprocess that receives the pickled jobs in its stdin and
+    sends back the pickled results in its stdout, instead of a multiprocessing process, which on Windows
+    would import the script again.
+    """
+    def __init__(self):
+        repository_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        self.process = subprocess.Popen([sys.executable, '-m', 'src.bids_writer'], cwd=repository_path,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.results = {}   # job ID: (success, path or error)
+        self.n_jobs = 0
+        self._condition = threading.Condition()
+        self._reader = threading.Thread(target=self._read_results, daemon=True)
+        self._reader.start()
+
+    def _read_results(self):
+        while True:
+            try:
+                job_id, result = pickle.load(self.process.stdout)
+            except EOFError:   # the process has finished
+                break
+            with self._condition:
+                self.results[job_id] = result
+                self._condition.notify_all()
+        with self._condition:
+            for job_id in range(self.n_jobs):
+                self.results.setdefault(job_id, (False, 'The BIDS writer process finished before writing the run'))
+            self._condition.notify_all()
+
+    def submit(self, spool_path, save_data_path=None, extra_channels=None, stream_stats=None):
+        # Queues the run of a closed spool, with the arguments of save_raw_bids_from_spool, returns its job ID
+        with self._condition:
+            job_id = self.n_jobs
+            self.n_jobs += 1
+        job = dict(spool_path=os.path.abspath(spool_path), save_data_path=save_data_path,
+                   extra_channels=extra_channels, stream_stats=stream_stats)
+        pickle.dump((job_id, job), self.process.stdin)
+        self.process.stdin.flush()
+        return job_id
+
+    def wait(self, job_id, timeout=None):
+        # Waits for the run of job_id to be written, returns its result, or None on timeout
+        with self._condition:
+            self._condition.wait_for(lambda: job_id in self.results, timeout)
+            return self.results.get(job_id)
+
+    def close(self, wait=True):
+        # Stops the process after the queued runs, and with wait returns the results of all the jobs
+        if not self.process.stdin.closed:
+            pickle.dump(None, self.process.stdin)
+            self.process.stdin.close()
+        if wait:
+            self.process.wait()
+            self._reader.join()
+        return self.results
+
+def run_writer(jobs, results):
+    # Loop of the writer process: writes the jobs of the jobs file until it receives None
+    import mne
+    import mne_bids   # imported before the first run, while it is acquired
+    from src.bids_files import save_raw_bids_from_spool
+    from src.spool import write_bids_error
+
+    mne.set_log_level('WARNING')
+    while True:
+        try:
+            message = pickle.load(jobs)
+        except EOFError:   # the parent process has finished
+            break
+        if message is None:
+            break
+        job_id, job = message
+        try:
+            result = (True, str(save_raw_bids_from_spool(**job)))
+            write_bids_error(job['spool_path'])
+            print(f"BIDS writer: run saved to {result[1]}")
+        except Exception:
+            result = (False, traceback.format_exc())
+            # The parent may have finished (close with wait=False), the error is also kept next to the spool
+            write_bids_error(job['spool_path'], result[1])
+            print(f"BIDS writer: the run could not be saved, it can be recovered with python -m src.spool {job['spool_path']}\n"
+                  f"{result[1]}")
+        try:
+            pickle.dump((job_id, result), results)
+            results.flush()
+        except OSError:   # the parent process has finished (close with wait=False), the result was printed
+            pass
+
+if __name__ == '__main__':
+    # The results are written to the original stdout, and everything else written to stdout goes to stderr
+    results = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    run_writer(sys.stdin.buffer, results)
@@ -1,21 +1,658 @@
-import mne
-from brainflow.board_shim import BoardShim, BrainFlowInputParams
-
-def setup_and_prepare_board(board_config):
-    """
-    Set up the board and prepare it for the experiment.
-    """
-    board_id = board_config['board_ID']
-    port = board_config['port']
-    ch_list = board_config['ch_list']
-
-    # BoardShim.enable_dev_board_logger()  #  To show the logs in the console
-    params = BrainFlowInputParams()
-    params.serial_port = port
-    board = BoardShim(board_id, params)
-    exg_channels = BoardShim.get_exg_channels(board_id)
-    sampling_rate = BoardShim.get_sampling_rate(board_id)
-    info = mne.create_info(ch_names=ch_list, sfreq=sampling_rate, ch_types='eeg')
-    board.prepare_session()
-
-    return board, info, exg_channels
\ No newline at end of file
+import os
+import threading
+import time
+import numpy as np
+from brainflow.board_shim import BoardShim, BrainFlowInputParams
+
+from src.clock_sync import ClockSync
+from src.event_index import EventIndex
+
+def setup_and_prepare_board(board_config, ring_buffer=False):
+    """
+    Set up the board and prepare it for the experiment.
+    With ring_buffer=True, the board is wrapped in a BoardRingBuffer, which starts its consumer thread
+    when the stream is started. board_config can set its 'buffer_seconds' and 'poll_interval'. The ring buffer
+    back-dates the markers inserted with a sender_clock with a ClockSync, at most 'max_backdating' seconds.
+    When board_config has a 'replay_file' (a recorded *_eeg.vhdr run, relative to the repository folder),
+    a ReplayBoard streams it at 'replay_speed' times real time instead of the board of board_ID.
+    When board_config has 'secondary_boards' (a list of board configs, with a 'name' and a 'ch_type' such as
+    'emg'), the boards are acquired together in a MultiBoardSession, which needs ring_buffer=True. The
+    returned info and exg_channels are the ones of the principal board.
+    """
+    board_id = board_config['board_ID']
+    port = board_config['port']
+    ch_list = board_config['ch_list']
+
+    if board_config.get('replay_file'):
+        board = ReplayBoard(board_config['replay_file'], board_id, ch_list, board_config.get('replay_speed', 1))
+    else:
+        # BoardShim.enable_dev_board_logger()  #  To show the logs in the console
+        params = BrainFlowInputParams()
+        params.serial_port = port
+        board = BoardShim(board_id, params)
+    exg_channels = BoardShim.get_exg_channels(board_id)
+    sampling_rate = BoardShim.get_sampling_rate(board_id)
+    board.prepare_session()
+    # mne is imported once the board is prepared, so the session is not delayed by its import time
+    import mne
+    info = mne.create_info(ch_names=ch_list, sfreq=sampling_rate, ch_types='eeg')
+
+    if ring_buffer:
+        board = BoardRingBuffer(board, board_config.get('buffer_seconds', 60), board_config.get('poll_interval', 0.02),
+                                clock_sync=ClockSync(sampling_rate), max_backdating=board_config.get('max_backdating', 0.5))
+
+    if board_config.get('secondary_boards'):
+        if not ring_buffer:
+            raise ValueError("Secondary boards are only supported with ring_buffer=True")
+        secondaries = {}
+        for secondary_config in board_config['secondary_boards']:
+            secondary_board, _, secondary_exg = setup_and_prepare_board(secondary_config, ring_buffer=True)
+            secondary_info = mne.create_info(ch_names=secondary_config['ch_list'], sfreq=secondary_board.sampling_rate,
+                                             ch_types=secondary_config.get('ch_type', 'misc'))
+            secondaries[secondary_config['name']] = (secondary_board, secondary_info, secondary_exg[:len(secondary_config['ch_list'])])
+        board = MultiBoardSession(board, secondaries)
+
+    return board, info, exg_channels
+
+class BoardRingBuffer():
+    """
+    Background consumer of a BrainFlow board.
+
+    A thread drains the board every poll_interval seconds into a preallocated ring buffer of the last
+    buffer_seconds, so the BrainFlow buffer does not grow during the run. Every sample gets an absolute
+    index (0 is the first sample of the stream), and the markers are indexed by the sample where they were
+    recorded, so the decoders can request the exact window [marker_sample + a, marker_sample + b).
+    The markers are kept in events (src.event_index.EventIndex) as they are drained, with the receive time
+    given to insert_marker, so they are found without scanning the marker channel.
+    Each sample is written twice in a buffer of twice the capacity, so any window is a contiguous view,
+    without copies. The views are valid until the samples are buffer_seconds old.
+
+    The wrapper has the methods of BoardShim that the scripts use. The memory is bounded by the ring buffer:
+    get_board_data returns the last buffer_seconds, or the whole run when keep_history is True (opt-in, every
+    drained chunk is kept until it is read). The whole run is better saved from the chunk callbacks (see
+    add_chunk_callback), which receive every chunk as it is drained, e.g. to an acquisition spool
+    (src.spool). Other attributes are taken from the wrapped BoardShim.
+
+    With a clock_sync (src.clock_sync.ClockSync), the markers inserted with the sender_clock of their stimulus
+    are back-dated: wait_for_marker, and so the marker windows, return the sample of the stimulus instead of
+    the sample where the marker was recorded, at most max_backdating seconds before it.
+    """
+    def __init__(self, board, buffer_seconds=60, poll_interval=0.02, keep_history=False, clock_sync=None,
+                 max_backdating=0.5):
+        self.board = board
+        board_id = board.get_board_id()
+        self.sampling_rate = BoardShim.get_sampling_rate(board_id)
+        self.marker_channel = BoardShim.get_marker_channel(board_id)
+        self.n_rows = BoardShim.get_num_rows(board_id)
+        self.capacity = int(buffer_seconds * self.sampling_rate)
+        self.poll_interval = poll_interval
+        self.keep_history = keep_history
+
+        self.buffer = np.zeros((self.n_rows, 2 * self.capacity))
+        self.n_samples = 0   # absolute index of the next sample
+        self.events = EventIndex()
+        self.history = []
+        self.chunk_callbacks = []
+        self._inserted = {}   # first possible sample of the last inserted marker of each code
+        self.clock_sync = clock_sync
+        self.max_backdating = int(max_backdating * self.sampling_rate)
+        self._pending = {}   # code: (sender clock, receive time) of the inserted markers that have not been drained yet
+        self._condition = threading.Condition()
+        self._drain_lock = threading.Lock()   # keeps the chunks in order when drain is called from two threads
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def __getattr__(self, name):
+        return getattr(self.board, name)
+
+    def add_chunk_callback(self, callback):
+        # callback(chunk, first_sample) is called from the consumer thread with every new chunk
+        self.chunk_callbacks.append(callback)
+
+    def start_stream(self, *args, **kwargs):
+        self.board.start_stream(*args, **kwargs)
+        self.start()
+
+    def stop_stream(self):
+        self.stop()
+        self.board.stop_stream()
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.drain()
+
+    def _run(self):
+        next_time = time.perf_counter()
+        while not self._stop_event.is_set():
+            self.drain()
+            next_time += self.poll_interval
+            self._stop_event.wait(max(next_time - time.perf_counter(), 0))
+
+    def drain(self):
+        # Moves the samples of the BrainFlow buffer to the ring buffer
+        with self._drain_lock:
+            self._drain()
+
+    def _drain(self):
+        chunk = self.board.get_board_data()
+        n_new = chunk.shape[1]
+        if n_new == 0:
+            return
+        with self._condition:
+            first_sample = self.n_samples
+            kept = chunk[:, -self.capacity:]
+            positions = (first_sample + n_new - kept.shape[1] + np.arange(kept.shape[1])) % self.capacity
+            self.buffer[:, positions] = kept
+            self.buffer[:, positions + self.capacity] = kept
+            for position in np.flatnonzero(chunk[self.marker_channel]):
+                self._index_marker(first_sample + int(position), int(chunk[self.marker_channel, position]))
+            if self.keep_history:
+                self.history.append(chunk)
+            self.n_samples += n_new
+            self._condition.notify_all()
+        for callback in self.chunk_callbacks:
+            callback(chunk, first_sample)
+
+    def insert_marker(self, value, *args, sender_clock=None, receive_time=-1, **kwargs):
+        # sender_clock is the clock (ns) of the stimulus in the stimulation protocol, to back-date the marker,
+        # and receive_time the time.monotonic_ns() when the marker was received, kept in the event index
+        with self._condition:
+            self._inserted[int(value)] = self.n_samples
+            self._pending.setdefault(int(value), []).append((sender_clock, receive_time))
+        self.board.insert_marker(value, *args, **kwargs)
+
+    def _index_marker(self, sample, code):
+        # Called with the condition held, for every drained marker. The markers inserted by other means
+        # (e.g. by the board itself) have no receive time
+        pending = self._pending.get(code)
+        sender_clock, receive_time = pending.pop(0) if pending else (None, -1)
+        onset = sample
+        if self.clock_sync is not None and sender_clock is not None:
+            self.clock_sync.add(sender_clock, sample)
+            onset = min(max(self.clock_sync.sample_of(sender_clock), sample - self.max_backdating), sample)
+            self.clock_sync.corrections.append(sample - onset)
+        self.events.append(sample, code, receive_time, onset)
+
+    def get_board_data_count(self, *args, **kwargs):
+        # Number of samples of the stream, it does not saturate as the BrainFlow count does
+        return self.n_samples
+
+    def get_window(self, start, stop):
+        """
+        Returns the (n_rows, stop - start) view of the samples with absolute indices [start, stop).
+        Raises ValueError when the samples are no longer in the buffer or have not been acquired yet.
+        """
+        with self._condition:
+            if stop - start > self.capacity or start < self.n_samples - self.capacity:
+                raise ValueError(f"Samples [{start}, {stop}) are no longer in the ring buffer")
+            if stop > self.n_samples or start < 0:
+                raise ValueError(f"Samples [{start}, {stop}) are not available, the stream has {self.n_samples} samples")
+            position = start % self.capacity
+            return self.buffer[:, position:position + stop - start]
+
+    def wait_for_sample(self, sample, timeout=None):
+        # Waits until all the samples with absolute index lower than sample have been acquired
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.n_samples >= sample, timeout):
+                raise TimeoutError(f"Sample {sample} was not acquired in {timeout} s")
+
+    def wait_for_marker(self, marker_code, timeout=None):
+        """
+        Returns the sample index of the last inserted marker with marker_code, waiting until it is drained.
+        The sample of its stimulus is returned instead for the back-dated markers (see clock_sync).
+        """
+        def find_marker():
+            return self.events.last(marker_code, after=self._inserted.get(marker_code, 0))
+        with self._condition:
+            if not self._condition.wait_for(lambda: find_marker() is not None, timeout):
+                raise TimeoutError(f"Marker {marker_code} was not received in {timeout} s")
+            return find_marker()[3]   # onset
+
+    def get_marker_window(self, marker_code, start, stop, timeout=None):
+        """
+        Waits for the samples [marker_sample + start, marker_sample + stop) of the last inserted marker with
+        marker_code (start and stop in samples) and returns their view.
+        """
+        marker_sample = self.wait_for_marker(marker_code, timeout)
+        self.wait_for_sample(marker_sample + stop, timeout)
+        return self.get_window(marker_sample + start, marker_sample + stop)
+
+    def get_current_board_data(self, num_samples, *args, **kwargs):
+        # Last num_samples samples (fewer at the start of the stream), as BoardShim.get_current_board_data
+        with self._condition:
+            num_samples = min(num_samples, self.n_samples, self.capacity)
+            return self.get_window(self.n_samples - num_samples, self.n_samples)
+
+    def get_current_window(self, num_samples):
+        # Copy of the last num_samples samples and the absolute index of the next sample, read together, so
+        # a chunk drained meanwhile does not shift the indices of the samples
+        with self._condition:
+            return self.get_current_board_data(num_samples).copy(), self.n_samples
+
+    def get_board_data(self, *args, **kwargs):
+        # Whole data of the run since the last call (only the ring buffer without keep_history), and clears it
+        if self._thread is not None:   # stop() drains the board for the last time
+            self.drain()
+        with self._condition:
+            if not self.keep_history:
+                n_samples = min(self.n_samples, self.capacity)
+                return self.get_window(self.n_samples - n_samples, self.n_samples).copy()
+            data = np.concatenate(self.history, axis=1) if self.history else np.zeros((self.n_rows, 0))
+            self.history = []
+            return data
+
+class ReplayBoard():
+    """
+    Board that streams a recorded BIDS run (*_eeg.vhdr) as the board of board_id would do, at speed times
+    real time, with the methods of BoardShim used by the scripts. The channels of ch_list are placed in the
+    EXG rows of the board, and the samples become available as time goes by after start_stream.
+
+    The events of the run are replayed by a ReplayMarkerSource, which takes the place of the stimulation
+    protocol. The stream is held at the sample of each event until the script inserts its marker, so the
+    markers are recorded at the same samples as in the original run.
+    """
+    def __init__(self, file_path, board_id, ch_list, speed=1):
+        if not os.path.isabs(file_path):
+            file_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), file_path)
+        self.file_path = file_path
+        self.board_id = board_id
+        self.ch_list = ch_list
+        self.speed = speed
+        self.sampling_rate = BoardShim.get_sampling_rate(board_id)
+        self.marker_channel = BoardShim.get_marker_channel(board_id)
+        self.data = None
+        self.start_time = None
+        self.n_read = 0   # samples already returned by get_board_data
+        self.next_event = 0
+        self.held_sample = None   # sample of the replayed event that waits for its marker
+
+    def get_board_id(self):
+        return self.board_id
+
+    def prepare_session(self):
+        import mne
+        import pandas as pd
+
+        raw = mne.io.read_raw_brainvision(self.file_path, preload=True, verbose=False)
+        if raw.info['sfreq'] != self.sampling_rate:
+            raise ValueError(f"The run was recorded at {raw.info['sfreq']} Hz and the board {self.board_id} "
+                             f"samples at {self.sampling_rate} Hz")
+        self.data = np.zeros((BoardShim.get_num_rows(self.board_id), raw.n_times))
+        exg_channels = BoardShim.get_exg_channels(self.board_id)
+        for row, ch in zip(exg_channels, self.ch_list):
+            if ch in raw.ch_names:
+                self.data[row] = raw.get_data(picks=[ch])[0] * 1000000   # V to uV, as BrainFlow returns them
+        self.data[BoardShim.get_package_num_channel(self.board_id)] = np.arange(raw.n_times) % 256
+        events = pd.read_csv(self.file_path[:-8] + 'events.tsv', sep='\t')
+        self.events = list(zip(events['sample'].astype(int), events['value'].astype(int)))
+
+    def is_prepared(self):
+        return self.data is not None
+
+    def start_stream(self, *args, **kwargs):
+        self.start_time = time.perf_counter()
+        self.data[BoardShim.get_timestamp_channel(self.board_id)] = (
+            time.time() + np.arange(self.data.shape[1]) / (self.sampling_rate * self.speed))
+
+    def stop_stream(self):
+        self.start_time = None
+
+    def release_session(self):
+        self.data = None
+
+    def n_available(self):
+        # Samples acquired since the start of the stream
+        if self.start_time is None:
+            return self.n_read
+        n_samples = min(int((time.perf_counter() - self.start_time) * self.sampling_rate * self.speed), self.data.shape[1])
+        if self.held_sample is not None:
+            n_samples = min(n_samples, self.held_sample)
+        elif self.next_event < len(self.events):
+            n_samples = min(n_samples, self.events[self.next_event][0])
+        return max(n_samples, self.n_read)
+
+    def finished(self):
+        return self.n_available() == self.data.shape[1] and self.next_event == len(self.events)
+
+    def seconds_to_next_event(self):
+        # Seconds until the sample of the next event (or the end of the run) is reached, None before start_stream
+        if self.start_time is None:
+            return None
+        sample = self.events[self.next_event][0] if self.next_event < len(self.events) else self.data.shape[1]
+        return max(sample / (self.sampling_rate * self.speed) - (time.perf_counter() - self.start_time), 0)
+
+    def pop_event(self):
+        # Returns the next (sample, marker code) event once its sample is reached, and holds the stream there
+        self.held_sample = None
+        if self.next_event == len(self.events) or self.n_available() < self.events[self.next_event][0]:
+            return None
+        event = self.events[self.next_event]
+        self.next_event += 1
+        self.held_sample = event[0]
+        return event
+
+    def insert_marker(self, value, *args, **kwargs):
+        sample = self.n_available()
+        self.held_sample = None
+        if sample < self.data.shape[1]:
+            self.data[self.marker_channel, sample] = value
+
+    def get_board_data_count(self, *args, **kwargs):
+        return self.n_available() - self.n_read
+
+    def get_board_data(self, num_samples=None, *args, **kwargs):
+        n_available = self.n_available()
+        stop = n_available if num_samples is None else min(self.n_read + num_samples, n_available)
+        data = self.data[:, self.n_read:stop].copy()
+        self.n_read = stop
+        return data
+
+    def get_current_board_data(self, num_samples, *args, **kwargs):
+        n_available = self.n_available()
+        return self.data[:, max(n_available - num_samples, 0):n_available].copy()
+
+class ReplayMarkerSource():
+    """
+    Replaces the UDP socket of the stimulation protocol when a ReplayBoard is used: ReceiveData returns the
+    events of the recorded run as "marker_code-time stamp" strings when the stream reaches them, and the
+    end_marker when the run is over. As in UdpComms, the callbacks are called with each string before it is
+    returned, and with a protocol (src.markers.MarkerProtocol) the strings are decoded to MarkerEvents.
+    The data sent to the protocol is kept in sent_data.
+    """
+    def __init__(self, board, end_marker, protocol=None):
+        # board is the ReplayBoard, or the BoardRingBuffer that wraps it
+        self.ring_buffer = board if isinstance(board, BoardRingBuffer) else None
+        self.board = board.board if isinstance(board, BoardRingBuffer) else board
+        # ReceiveData waits on the condition of the ring buffer, notified with every drained chunk
+        self._condition = threading.Condition() if self.ring_buffer is None else self.ring_buffer._condition
+        self.end_marker = end_marker
+        self.protocol = protocol
+        self.end_sent = False
+        self.sent_data = []
+        self.callbacks = []
+        self.dispatch_latencies = []
+        self.n_received = 0
+        self.n_overflow = 0
+
+    def AddCallback(self, callback):
+        self.callbacks.append(callback)
+
+    def ReceiveData(self, timeout=None):
+        """
+        Blocks until the next event is reached, or until timeout seconds, as UdpComms.ReceiveData.
+        Returns None on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            data = self._next_data()
+            if data is not None:
+                break
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            # The stream reaches the next event after seconds_to_next_event, the ring buffer notifies the
+            # drained chunks before (e.g. the stream was held at the previous event until its marker)
+            wait = None if self.end_sent else self.board.seconds_to_next_event()
+            if wait is None or (remaining is not None and remaining < wait):
+                wait = remaining
+            with self._condition:
+                self._condition.wait(wait)
+        if self.protocol is not None:
+            data, = self.protocol.decode(data.encode('utf-8'))
+        receive_time, read_time = time.monotonic_ns(), time.perf_counter()
+        self.n_received += 1
+        for callback in self.callbacks:
+            callback(data, receive_time)
+        self.dispatch_latencies.append(time.perf_counter() - read_time)
+        return data
+
+    def _next_data(self):
+        # String of the next event if the stream has reached it, or None
+        event = self.board.pop_event()
+        if event is not None:
+            return f"{event[1]}-{time.time()}"
+        if self.board.finished() and not self.end_sent:
+            self.end_sent = True
+            return f"{self.end_marker}-{time.time()}"
+        return None
+
+    def CloseSocket(self):
+        # Nothing to close, as UdpComms.CloseSocket
+        pass
+
+    def SendData(self, strToSend):
+        self.sent_data.append(strToSend)
+
+    def SendBytes(self, bytesToSend):
+        self.sent_data.append(bytes(bytesToSend))
+
+class MultiBoardSession():
+    """
+    Several BrainFlow boards acquired together, e.g. the Cyton Daisy EEG (principal board) and a Ganglion EMG.
+
+    Each board is a BoardRingBuffer, drained by its own consumer thread, so a slow board does not make the
+    others drop samples. The markers are inserted in all the boards, and the boards are aligned on the
+    timeline of the principal board: the timestamps of each board are smoothed with a linear fit of
+    timestamp against sample index, and the offset between the boards (e.g. the latency of the Bluetooth
+    link) is the median difference of the fitted times of the same markers.
+
+    The session is used as the principal BoardRingBuffer by the decoders and the scripts.
+    get_aligned_window and get_aligned_channels give the secondary channels resampled at the principal
+    samples, for the decoders and the BIDS writer.
+    """
+    def __init__(self, principal, secondaries):
+        # secondaries is a dict name: (BoardRingBuffer, mne info of its channels, exg channel rows)
+        self.principal = principal
+        self.secondaries = secondaries
+        for secondary, _, _ in secondaries.values():
+            secondary.keep_history = True   # needed to align the whole run at the end
+
+    def __getattr__(self, name):
+        return getattr(self.principal, name)
+
+    @property
+    def keep_history(self):
+        return self.principal.keep_history
+
+    @keep_history.setter
+    def keep_history(self, value):
+        self.principal.keep_history = value
+
+    def _boards(self):
+        return [self.principal] + [secondary for secondary, _, _ in self.secondaries.values()]
+
+    def start_stream(self, *args, **kwargs):
+        for board in self._boards():
+            board.start_stream(*args, **kwargs)
+
+    def stop_stream(self):
+        for board in self._boards():
+            board.stop_stream()
+
+    def release_session(self):
+        for board in self._boards():
+            board.release_session()
+
+    def insert_marker(self, value, *args, **kwargs):
+        for board in self._boards():
+            board.insert_marker(value, *args, **kwargs)
+
+    @staticmethod
+    def _fit_timeline(samples, timestamps):
+        # Linear fit timestamp = a + b * sample, robust to the packet jitter of the timestamps
+        if len(samples) < 2:
+            return timestamps[0] if len(timestamps) else 0.0, 0.0
+        slope, intercept = np.polyfit(samples - samples[0], timestamps, 1)
+        return intercept - slope * samples[0], slope
+
+    @staticmethod
+    def _pair_markers(principal_events, secondary_events):
+        """
+        Pairs the markers recorded by two boards (EventIndex), returns the list of (principal sample, secondary
+        sample). A marker is inserted in all the boards with the same receive time, so the markers are paired
+        by code and receive time, and the markers without receive time by code and order among them. The
+        markers dropped or duplicated by one board have no match and are discarded, instead of shifting the
+        pairs of the next markers.
+        """
+        secondary_samples = {}
+        for sample, code, receive_time in zip(secondary_events.samples, secondary_events.codes,
+                                              secondary_events.receive_times):
+            secondary_samples.setdefault((int(code), int(receive_time)), []).append(int(sample))
+        pairs = []
+        n_paired = {}
+        for sample, code, receive_time in zip(principal_events.samples, principal_events.codes,
+                                              principal_events.receive_times):
+            key = (int(code), int(receive_time))
+            candidates = secondary_samples.get(key, [])
+            n = n_paired.get(key, 0)
+            if n < len(candidates):
+                pairs.append((int(sample), candidates[n]))
+                n_paired[key] = n + 1
+        return pairs
+
+    def _offset(self, secondary, principal_fit, secondary_fit):
+        # Median difference of the fitted times of the markers recorded by both boards
+        differences = [principal_fit[0] + principal_fit[1] * principal_sample
+                       - secondary_fit[0] - secondary_fit[1] * secondary_sample
+                       for principal_sample, secondary_sample in self._pair_markers(self.principal.events, secondary.events)]
+        return float(np.median(differences)) if differences else 0.0
+
+    def _align(self, principal_samples, principal_timestamps, secondary, secondary_exg, secondary_samples, secondary_data):
+        timestamp_channel = BoardShim.get_timestamp_channel(secondary.get_board_id())
+        principal_fit = self._fit_timeline(principal_samples, principal_timestamps)
+        secondary_fit = self._fit_timeline(secondary_samples, secondary_data[timestamp_channel])
+        offset = self._offset(secondary, principal_fit, secondary_fit)
+        principal_times = principal_fit[0] + principal_fit[1] * principal_samples
+        secondary_times = secondary_fit[0] + secondary_fit[1] * secondary_samples + offset
+        return np.array([np.interp(principal_times, secondary_times, secondary_data[row]) for row in secondary_exg])
+
+    def get_aligned_window(self, start, stop):
+        """
+        Secondary channels resampled at the principal samples [start, stop), from the ring buffers.
+        Returns a dict name: (n_channels, stop - start) array, in uV.
+        """
+        timestamp_channel = BoardShim.get_timestamp_channel(self.principal.get_board_id())
+        principal_samples = np.arange(start, stop)
+        principal_timestamps = self.principal.get_window(start, stop)[timestamp_channel]
+        aligned = {}
+        for name, (secondary, _, secondary_exg) in self.secondaries.items():
+            secondary_data, end_sample = secondary.get_current_window(secondary.capacity)
+            secondary_samples = np.arange(end_sample - secondary_data.shape[1], end_sample)
+            aligned[name] = self._align(principal_samples, principal_timestamps, secondary, secondary_exg,
+                                        secondary_samples, secondary_data)
+        return aligned
+
+    def get_aligned_channels(self, principal_data):
+        """
+        Secondary channels of the whole run resampled at the samples of principal_data, the board data of
+        the principal board since the start of the stream (e.g. the data of its spool).
+        Returns a list of (data in uV, mne info) per secondary board, as save_raw_bids takes them.
+        """
+        timestamp_channel = BoardShim.get_timestamp_channel(self.principal.get_board_id())
+        principal_samples = np.arange(principal_data.shape[1])
+        principal_timestamps = np.asarray(principal_data[timestamp_channel])
+        extra_channels = []
+        for secondary, secondary_info, secondary_exg in self.secondaries.values():
+            secondary_data = secondary.get_board_data()
+            secondary_samples = np.arange(secondary_data.shape[1])
+            extra_channels.append((self._align(principal_samples, principal_timestamps, secondary, secondary_exg,
+                                               secondary_samples, secondary_data), secondary_info))
+        return extra_channels
+
+class StreamHealthMonitor():
+    """
+    Checks the health of a board stream, chunk by chunk, with vectorized operations only.
+
+    - Package counter gaps: the package number channel increments by a fixed step per sample (1 for the
+      Cyton, 2 for the Cyton Daisy, inferred from the first chunk when step is None) and wraps at 256.
+      Every jump of the counter is recorded as a gap with the number of lost samples.
+    - Effective sampling rate, from the timestamp channel, compared with BoardShim.get_sampling_rate.
+    - Read latency: time between the timestamp of the last sample of a chunk and the moment it is read.
+
+    update has the signature of the BoardRingBuffer chunk callbacks. stats() returns the statistics of the
+    run, that save_raw_bids writes next to the BIDS files.
+    """
+    def __init__(self, board_id, step=None, verbose=True, max_latencies=10000):
+        self.board_id = board_id
+        self.nominal_sampling_rate = BoardShim.get_sampling_rate(board_id)
+        self.package_channel = BoardShim.get_package_num_channel(board_id)
+        self.timestamp_channel = BoardShim.get_timestamp_channel(board_id)
+        self.step = step
+        self.verbose = verbose
+        self.n_samples = 0
+        self.n_chunks = 0
+        self.n_lost = 0
+        self.gaps = []   # (sample index after the gap, lost samples)
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.last_package = None
+        self.latencies = np.zeros(max_latencies)   # circular record of the last read latencies
+        self.max_latency = 0
+
+    def update(self, chunk, first_sample=None):
+        read_time = time.time()
+        n_new = chunk.shape[1]
+        if n_new == 0:
+            return
+        first_sample = self.n_samples if first_sample is None else first_sample
+        packages = chunk[self.package_channel]
+        if self.step is None and n_new > 1:
+            steps = np.diff(packages) % 256
+            self.step = int(np.bincount(steps.astype(int)).argmax()) or 1
+        if self.step is not None:
+            previous = packages[:1] if self.last_package is None else [self.last_package]
+            steps = np.diff(packages, prepend=previous) % 256
+            if self.last_package is None:
+                steps[0] = self.step
+            gap_positions = np.flatnonzero(steps != self.step)
+            if gap_positions.size:
+                lost = ((steps[gap_positions] - self.step) % 256) // self.step
+                for position, n_lost in zip(gap_positions, lost):
+                    self.gaps.append((first_sample + int(position), int(n_lost)))
+                    if self.verbose:
+                        print(f"Stream: {int(n_lost)} samples lost before sample {first_sample + int(position)}")
+                self.n_lost += int(lost.sum())
+            self.last_package = packages[-1]
+
+        timestamps = chunk[self.timestamp_channel]
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamps[0]
+        self.last_timestamp = timestamps[-1]
+        latency = read_time - timestamps[-1]
+        self.latencies[self.n_chunks % len(self.latencies)] = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.n_samples += n_new
+        self.n_chunks += 1
+
+    def effective_sampling_rate(self):
+        if self.n_samples < 2 or self.last_timestamp == self.first_timestamp:
+            return None
+        return (self.n_samples - 1) / (self.last_timestamp - self.first_timestamp)
+
+    def stats(self):
+        latencies = self.latencies[:min(self.n_chunks, len(self.latencies))]
+        effective_sampling_rate = self.effective_sampling_rate()
+        return dict(board_id=self.board_id,
+                    nominal_sampling_rate=self.nominal_sampling_rate,
+                    effective_sampling_rate=effective_sampling_rate,
+                    sampling_rate_error=None if effective_sampling_rate is None
+                    else effective_sampling_rate / self.nominal_sampling_rate - 1,
+                    n_samples=self.n_samples,
+                    n_lost_samples=self.n_lost,
+                    lost_fraction=self.n_lost / max(self.n_samples + self.n_lost, 1),
+                    n_gaps=len(self.gaps),
+                    gaps=[[sample, n_lost] for sample, n_lost in self.gaps[:1000]],
+                    package_step=self.step,
+                    n_chunks=self.n_chunks,
+                    read_latency_mean=float(latencies.mean()) if latencies.size else None,
+                    read_latency_p95=float(np.percentile(latencies, 95)) if latencies.size else None,
+                    read_latency_max=self.max_latency if latencies.size else None)
+
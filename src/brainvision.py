@@ -0,0 +1,102 @@
+import os
+import numpy as np
+
+# BrainVision binary formats: (BinaryFormat of the header, little-endian dtype of the samples)
+FORMATS = {'binary_float32': ('IEEE_FLOAT_32', np.dtype('<f4')), 'binary_int16': ('INT_16', np.dtype('<i2'))}
+
+def write_brainvision(sources, sfreq, ch_names, fname_base, folder, events=None, fmt='binary_float32', resolution=0.1,
+                      chunk_samples=100000):
+    """
+    Writes the .eeg, .vhdr and .vmrk files of a recording in chunks, without loading it in memory.
+
+    sources is a list of (data, rows): data is an (n_rows, n_samples) array in uV, e.g. the board data or the
+    memory-mapped data of a spool, and rows are the rows of its channels. The channels of all the sources are
+    written in order, with the names ch_names, so the extra boards of a session are written with the EEG.
+    events is an (n_events, 2) array of (sample, marker code), written as the Stimulus markers of the .vmrk.
+    The data is written multiplexed, as float32 or int16 (fmt) in units of resolution uV, and converted chunk by
+    chunk with the same operations as pybv, so the files have the same content as the ones of write_raw_bids
+    with format='BrainVision'. Returns the path of the .vhdr file.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown BrainVision format: {fmt}, use one of {list(FORMATS)}")
+    binary_format, dtype = FORMATS[fmt]
+    n_samples = sources[0][0].shape[1]
+    if any(data.shape[1] != n_samples for data, _ in sources):
+        raise ValueError("All the sources must have the same number of samples")
+    if len(ch_names) != sum(len(rows) for _, rows in sources):
+        raise ValueError("ch_names must have a name for each row of the sources")
+    events = np.zeros((0, 2), dtype=int) if events is None else np.asarray(events, dtype=int)
+    if np.any((events[:, 0] < 0) | (events[:, 0] >= n_samples)):
+        raise ValueError(f"The events must be in the samples of the data (0-{n_samples - 1})")
+
+    os.makedirs(folder, exist_ok=True)
+    eeg_path = os.path.join(folder, fname_base + '.eeg')
+    vmrk_path = os.path.join(folder, fname_base + '.vmrk')
+    vhdr_path = os.path.join(folder, fname_base + '.vhdr')
+    # uV are converted to V, as in the MNE raw, and scaled to units of resolution, as pybv does
+    scale = 1e6 * (1 / resolution)
+    limits = np.iinfo(dtype) if dtype.kind == 'i' else np.finfo(dtype)
+    with open(eeg_path, 'wb') as file:
+        for start in range(0, n_samples, chunk_samples):
+            chunk = np.concatenate([np.asarray(data[rows, start:start + chunk_samples]) / 1000000
+                                    for data, rows in sources]) * scale
+            if chunk.min() <= limits.min or chunk.max() >= limits.max:
+                raise ValueError(f"The data can not be written as {fmt} with resolution {resolution} uV")
+            chunk.T.astype(dtype).tofile(file)   # multiplexed: the channels of each sample are consecutive
+
+    with open(vmrk_path, 'w', encoding='utf-8') as file:
+        file.write(vmrk_text(os.path.basename(eeg_path), events))
+    with open(vhdr_path, 'w', encoding='utf-8') as file:
+        file.write(vhdr_text(os.path.basename(eeg_path), os.path.basename(vmrk_path), sfreq, ch_names,
+                             binary_format, resolution))
+    return vhdr_path
+
+def vhdr_text(eeg_name, vmrk_name, sfreq, ch_names, binary_format, resolution):
+    # Header file, in the layout of pybv
+    resolution = np.format_float_positional(resolution, trim='-')
+    lines = ["Brain Vision Data Exchange Header File Version 1.0",
+             "; Written in chunks by src.brainvision",
+             "",
+             "[Common Infos]",
+             "Codepage=UTF-8",
+             f"DataFile={eeg_name}",
+             f"MarkerFile={vmrk_name}",
+             "DataFormat=BINARY",
+             "; Data orientation: MULTIPLEXED=ch1,pt1, ch2,pt1 ...",
+             "DataOrientation=MULTIPLEXED",
+             f"NumberOfChannels={len(ch_names)}",
+             "; Sampling interval in microseconds",
+             f"SamplingInterval={1e6 / float(sfreq)}",
+             "",
+             "[Binary Infos]",
+             f"BinaryFormat={binary_format}",
+             "",
+             "[Channel Infos]",
+             "; Each entry: Ch<Channel number>=<Name>,<Reference channel name>,",
+             '; <Resolution in "Unit">,<Unit>, Future extensions..',
+             "; Fields are delimited by commas, some fields might be omitted (empty).",
+             r'; Commas in channel names are coded as "\1".']
+    names = [name.replace(',', r'\1') for name in ch_names]
+    lines += [f"Ch{idx + 1}={name},,{resolution},µV" for idx, name in enumerate(names)]
+    lines += ["", "[Comment]", ""]
+    return '\n'.join(lines) + '\n'
+
+def vmrk_text(eeg_name, events):
+    # Marker file, in the layout of pybv: a Stimulus marker of 1 sample for all the channels per event
+    width = max(3, int(np.ceil(np.log10(max([1] + [int(code) for code in events[:, 1]])))))
+    lines = ["Brain Vision Data Exchange Marker File, Version 1.0",
+             "; Written in chunks by src.brainvision",
+             "",
+             "[Common Infos]",
+             "Codepage=UTF-8",
+             f"DataFile={eeg_name}",
+             "",
+             "[Marker Infos]",
+             "; Each entry: Mk<Marker number>=<Type>,<Description>,<Position in data points>,",
+             ";             <Size in data points>, <Channel number (0 = marker is related to all channels)>",
+             ";             <Date (YYYYMMDDhhmmssuuuuuu)>",
+             "; Fields are delimited by commas, some fields might be omitted (empty).",
+             r'; Commas in type or description text are coded as "\1".']
+    # The positions are 1-based
+    lines += [f"Mk{idx + 1}=Stimulus,S{code:>{width}},{sample + 1},1,0" for idx, (sample, code) in enumerate(events)]
+    return '\n'.join(lines) + '\n'
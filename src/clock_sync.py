@@ -0,0 +1,84 @@
+from collections import deque
+import numpy as np
+
+class ClockSync():
+    """
+    Offset and drift between the clock of the stimulation protocol and the samples of the board.
+
+    Each marker sent with the clock of the stimulus (MarkerEvent.sender_clock, in ns) is recorded by the board
+    some time later, at sample s = offset + slope * clock + delay, where the delay (UDP, Python, BrainFlow) is
+    always positive. The line is fitted to the lower envelope of the last window pairs (clock, sample): a least
+    squares fit is repeated on the pairs with the lowest residuals (quantile), and the line is moved down to the
+    lowest of them, so the pairs delayed by a busy main loop or a slow packet do not bias it. slope is the
+    sampling rate of the board measured with the stimulator clock, so the drift between the clocks is fitted too.
+
+    sample_of back-dates a marker to the sample of its stimulus: the sample at the minimum delay, minus
+    fixed_latency seconds, the minimum delay between the stimulus and its marker if it has been measured
+    (e.g. with a photodiode).
+    """
+    def __init__(self, sampling_rate, window=200, min_points=5, quantile=0.25, fixed_latency=0):
+        self.sampling_rate = sampling_rate
+        self.min_points = min_points
+        self.quantile = quantile
+        self.fixed_latency = fixed_latency
+        self.pairs = deque(maxlen=window)
+        self.clock_origin = None
+        self.n_pairs = 0
+        self._fit = None
+        self.corrections = []   # samples that each back-dated marker was moved back
+
+    def add(self, sender_clock, sample):
+        # Pair of the clock (ns) of a stimulus and the sample where its marker was recorded
+        if self.clock_origin is None:
+            self.clock_origin = sender_clock
+        self.pairs.append(((sender_clock - self.clock_origin) / 1e9, sample))
+        self.n_pairs += 1
+        self._fit = None
+
+    def fit(self):
+        # Returns the (offset, slope) of the sample against the clock in seconds since the first pair
+        if self._fit is not None:
+            return self._fit
+        clocks, samples = np.array(self.pairs, dtype=float).T
+        if len(clocks) < self.min_points or np.ptp(clocks) == 0:
+            # Too few pairs to fit the drift: nominal sampling rate, and offset of the lowest delay
+            slope = self.sampling_rate
+            offset = np.min(samples - slope * clocks)
+        else:
+            keep = np.ones(len(clocks), dtype=bool)
+            for _ in range(3):
+                slope, offset = np.polyfit(clocks[keep], samples[keep], 1)
+                residuals = samples - (offset + slope * clocks)
+                keep = residuals <= np.quantile(residuals, self.quantile)
+                if np.ptp(clocks[keep]) == 0:
+                    break
+            offset += np.min(residuals)
+        self._fit = (offset, slope)
+        return self._fit
+
+    def sample_of(self, sender_clock):
+        # Sample of the stimulus with the clock sender_clock (ns), None before the first pair
+        if not self.pairs:
+            return None
+        offset, slope = self.fit()
+        clock = (sender_clock - self.clock_origin) / 1e9
+        return int(round(offset + slope * (clock - self.fixed_latency)))
+
+    @property
+    def drift_ppm(self):
+        # Drift of the board sampling clock relative to the stimulator clock, in parts per million
+        return 1e6 * (self.fit()[1] / self.sampling_rate - 1)
+
+    def stats(self):
+        # Summary of the synchronization, to be saved with the run
+        if not self.pairs:
+            return {'n_pairs': 0}
+        offset, slope = self.fit()
+        clocks, samples = np.array(self.pairs, dtype=float).T
+        delays = (samples - (offset + slope * clocks)) / self.sampling_rate
+        corrections = np.array(self.corrections) / self.sampling_rate
+        return {'n_pairs': self.n_pairs,
+                'drift_ppm': float(self.drift_ppm),
+                'median_marker_delay': float(np.median(delays)),
+                'max_marker_delay': float(np.max(delays)),
+                'mean_backdating': float(np.mean(corrections)) if len(corrections) else 0.0}
@@ -0,0 +1,293 @@
+import numpy as np
+
+class FusedCSPLDA():
+    """
+    Motor imagery CSP+LDA decoder reduced to its linear algebra.
+
+    The trained {'csp', 'lda'} pipeline is mathematically a spatial-filter matmul, the log of the average
+    power of the CSP sources (or its standardization when the CSP was trained with log=False) and a dot
+    product with the LDA coefficients. This class holds only those arrays, so that single trials and batches
+    are classified without the Python overhead and input validation of the MNE and sklearn objects.
+    It gives the same results as csp.transform followed by the lda methods.
+
+    During closed-loop runs, adapt() updates the LDA class means, shared covariance and bias with each
+    labelled trial (see its docstring), so the decoder follows the drift of the session.
+    """
+    def __init__(self, filters, coef, intercept, classes, log=True, mean=None, std=None, means=None, priors=None,
+                 covariance=None):
+        self.filters = np.asarray(filters, dtype=float)       # (n_components, n_channels)
+        self.coef = np.atleast_2d(np.asarray(coef, dtype=float))   # (1 or n_classes, n_components)
+        self.intercept = np.atleast_1d(np.asarray(intercept, dtype=float))
+        self.classes = np.asarray(classes)
+        self.log = bool(log)
+        self.mean = None if mean is None else np.asarray(mean, dtype=float)
+        self.std = None if std is None else np.asarray(std, dtype=float)
+        # LDA class means and priors, in the CSP feature space
+        self.means = None if means is None else np.array(means, dtype=float)   # copied, adapt() updates it
+        self.priors = None if priors is None else np.asarray(priors, dtype=float)
+        # LDA shared covariance and its inverse, only available when the LDA was trained with store_covariance
+        self.covariance = None if covariance is None else np.asarray(covariance, dtype=float)
+        self.precision = None if covariance is None else np.linalg.inv(self.covariance)
+
+    @classmethod
+    def from_pipeline(cls, trained_pipeline):
+        # Exports the {'csp': mne.decoding.CSP, 'lda': LinearDiscriminantAnalysis} pipeline saved by the training script
+        csp = trained_pipeline['csp']
+        lda = trained_pipeline['lda']
+        log = True if csp.log is None else csp.log
+        mean = None if log else csp.mean_
+        std = None if log else csp.std_
+        return cls(csp.filters_[:csp.n_components], lda.coef_, lda.intercept_, lda.classes_, log, mean, std,
+                   getattr(lda, 'means_', None), getattr(lda, 'priors_', None), getattr(lda, 'covariance_', None))
+
+    @classmethod
+    def load(cls, file_path):
+        model = np.load(file_path)
+        optional = {key: model[key] for key in ('mean', 'std', 'means', 'priors', 'covariance') if key in model}
+        return cls(model['filters'], model['coef'], model['intercept'], model['classes'], bool(model['log']), **optional)
+
+    def save(self, file_path):
+        arrays = dict(filters=self.filters, coef=self.coef, intercept=self.intercept, classes=self.classes, log=self.log)
+        for key in ('mean', 'std', 'means', 'priors', 'covariance'):
+            if getattr(self, key) is not None:
+                arrays[key] = getattr(self, key)
+        np.savez(file_path, **arrays)
+
+    def transform(self, X):
+        """
+        CSP features of the trials. X is one trial (n_channels, n_samples) or a batch
+        (n_trials, n_channels, n_samples). Returns (n_trials, n_components).
+        """
+        X = np.asarray(X, dtype=float)
+        if X.ndim == 2:
+            X = X[None]
+        sources = self.filters @ X
+        features = np.mean(sources**2, axis=-1)
+        if self.log:
+            return np.log(features)
+        return (features - self.mean) / self.std
+
+    def decision_function(self, X):
+        # LDA scores of the trials, (n_trials,) for two classes and (n_trials, n_classes) otherwise
+        scores = self.transform(X) @ self.coef.T + self.intercept
+        return scores[:, 0] if scores.shape[1] == 1 else scores
+
+    def predict(self, X):
+        scores = self.decision_function(X)
+        if scores.ndim == 1:
+            return self.classes[(scores > 0).astype(int)]
+        return self.classes[np.argmax(scores, axis=1)]
+
+    def predict_proba(self, X):
+        # Class probabilities, (n_trials, n_classes)
+        scores = self.decision_function(X)
+        if scores.ndim == 1:
+            proba = 1 / (1 + np.exp(-scores))
+            return np.column_stack((1 - proba, proba))
+        scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return scores / scores.sum(axis=1, keepdims=True)
+
+    def adapt(self, X, y, rate=0.05):
+        """
+        Updates the LDA with one labelled trial X, of class y, by exponential forgetting with the given rate.
+
+        The mean of class y moves towards the CSP features of the trial. When the shared covariance is
+        available, it is updated with the rank-one term of the trial and its inverse with the
+        Sherman-Morrison formula, and the LDA coefficients and bias are recomputed from them. Otherwise
+        only the bias of a two-class LDA is recomputed, with the coefficients fixed.
+        All the updates are O(n_components²), the CSP filters are not changed.
+        """
+        if self.means is None or self.priors is None:
+            raise ValueError("The decoder has no LDA class means, it can not be adapted")
+        if y not in self.classes:
+            raise ValueError(f"Unknown class {y}, the decoder classes are {self.classes}")
+        features = self.transform(X)[0]
+        k = int(np.flatnonzero(self.classes == y)[0])
+        self.means[k] = (1 - rate) * self.means[k] + rate * features
+
+        if self.covariance is not None:
+            residual = features - self.means[k]
+            self.covariance = (1 - rate) * self.covariance + rate * np.outer(residual, residual)
+            # Sherman-Morrison update of the inverse of (1 - rate) * covariance + rate * residual residual^T
+            precision = self.precision / (1 - rate)
+            projected = precision @ residual
+            self.precision = precision - rate * np.outer(projected, projected) / (1 + rate * residual @ projected)
+            coef = self.means @ self.precision
+            intercept = -0.5 * np.sum(coef * self.means, axis=1) + np.log(self.priors)
+            if len(self.classes) == 2:
+                coef = coef[1:] - coef[:1]
+                intercept = intercept[1:] - intercept[:1]
+            self.coef, self.intercept = coef, intercept
+        elif len(self.classes) == 2:
+            self.intercept = np.array([-0.5 * (self.means[0] + self.means[1]) @ self.coef[0]
+                                       + np.log(self.priors[1] / self.priors[0])])
+        else:
+            raise ValueError("The bias of a multiclass LDA can not be adapted without its covariance")
+
+class ProbabilitySmoother():
+    """
+    Smooths the class probabilities of consecutive overlapping windows.
+
+    'exponential' - exponential moving average of the probabilities, p = (1 - alpha) * p + alpha * p_window
+    'evidence' - leaky accumulation of the log-probabilities, e = (1 - leak) * e + log(p_window), returned
+                 through a softmax. The evidence of a sustained class keeps growing, so the control signal
+                 saturates faster than with the moving average
+    """
+    def __init__(self, n_classes=2, method='exponential', alpha=0.1, leak=0.05):
+        if method not in ('exponential', 'evidence'):
+            raise ValueError(f"Unknown smoothing method: {method}")
+        self.n_classes = n_classes
+        self.method = method
+        self.alpha = alpha
+        self.leak = leak
+        self.reset()
+
+    def reset(self):
+        self.state = None
+
+    def update(self, proba):
+        # Adds the probabilities of a new window and returns the smoothed probabilities
+        proba = np.asarray(proba, dtype=float).ravel()
+        if self.method == 'exponential':
+            self.state = proba if self.state is None else (1 - self.alpha) * self.state + self.alpha * proba
+            return self.state
+        evidence = np.log(np.clip(proba, 1e-6, 1))
+        self.state = evidence if self.state is None else (1 - self.leak) * self.state + evidence
+        smoothed = np.exp(self.state - self.state.max())
+        return smoothed / smoothed.sum()
+
+# Ridge added to the covariances, relative to their mean eigenvalue (trace / n_channels)
+COVARIANCE_RIDGE = 1e-3
+# Smallest eigenvalue of a positive definite matrix, relative to its largest one
+EIGENVALUE_FLOOR = 1e-10
+
+def regularize_covariance(covariances, ridge=COVARIANCE_RIDGE):
+    """
+    Returns C + ridge * trace(C) / n * I for one (n, n) covariance matrix or a batch. The covariances of
+    band-passed windows can be rank-deficient, and they have to be positive definite for the matrix
+    logarithms and square roots of the tangent space. The training covariances and the ones of the
+    StreamingCovariance are regularized with the same ridge.
+    """
+    covariances = np.asarray(covariances, dtype=float)
+    n_channels = covariances.shape[-1]
+    scale = ridge * np.trace(covariances, axis1=-2, axis2=-1) / n_channels
+    return covariances + scale[..., None, None] * np.eye(n_channels)
+
+def _eig_function(matrices, function, positive=True):
+    """
+    Applies function to the eigenvalues of symmetric matrices (..., n, n). The matrices are positive definite
+    unless positive is False: their eigenvalues are clipped to EIGENVALUE_FLOOR times the largest one, so the
+    rounding errors of nearly singular matrices do not give NaNs in the logarithms and inverse square roots.
+    """
+    eigvals, eigvecs = np.linalg.eigh(matrices)
+    if positive:
+        floor = EIGENVALUE_FLOOR * np.max(np.abs(eigvals), axis=-1, keepdims=True)
+        eigvals = np.maximum(eigvals, np.maximum(floor, np.finfo(float).tiny))
+    return (eigvecs * function(eigvals)[..., None, :]) @ np.swapaxes(eigvecs, -1, -2)
+
+def riemannian_mean(covariances, max_iter=50, tol=1e-8):
+    """
+    Geometric mean of (n_matrices, n_channels, n_channels) covariance matrices under the affine-invariant
+    Riemannian metric, by gradient descent starting from the arithmetic mean.
+    """
+    mean = np.mean(covariances, axis=0)
+    for _ in range(max_iter):
+        sqrt_mean = _eig_function(mean, np.sqrt)
+        isqrt_mean = _eig_function(mean, lambda eigvals: 1 / np.sqrt(eigvals))
+        gradient = np.mean(_eig_function(isqrt_mean @ covariances @ isqrt_mean, np.log), axis=0)
+        mean = sqrt_mean @ _eig_function(gradient, np.exp, positive=False) @ sqrt_mean
+        if np.linalg.norm(gradient) < tol:
+            break
+    return mean
+
+def tangent_space(covariances, reference):
+    """
+    Tangent space vectors of covariance matrices at the reference matrix: upper triangle of
+    log(reference^-1/2 C reference^-1/2), with the off-diagonal terms scaled by sqrt(2).
+    covariances is one (n_channels, n_channels) matrix or a batch. Returns (n_matrices, n_features).
+    """
+    covariances = np.asarray(covariances, dtype=float)
+    if covariances.ndim == 2:
+        covariances = covariances[None]
+    isqrt_reference = _eig_function(reference, lambda eigvals: 1 / np.sqrt(eigvals))
+    tangent = _eig_function(isqrt_reference @ covariances @ isqrt_reference, np.log)
+    rows, cols = np.triu_indices(reference.shape[0])
+    weights = np.where(rows == cols, 1, np.sqrt(2))
+    return tangent[:, rows, cols] * weights
+
+class TangentSpaceLDA():
+    """
+    Motor imagery decoder on the covariance matrices of the trials: the covariances are projected to the
+    tangent space at their Riemannian mean, and classified with a linear discriminant.
+
+    The whitening of the reference is computed once, so classifying one covariance matrix costs one
+    eigendecomposition and a dot product.
+    The covariances are regularized with regularize_covariance(ridge) before they are given to the decoder,
+    in training and by the StreamingCovariance, with the ridge saved in the model.
+    """
+    def __init__(self, reference, coef, intercept, classes, ch_names=None, l_freq=8, h_freq=30,
+                 ridge=COVARIANCE_RIDGE):
+        self.reference = np.asarray(reference, dtype=float)    # (n_channels, n_channels)
+        self.coef = np.atleast_2d(np.asarray(coef, dtype=float))   # (1 or n_classes, n_features)
+        self.intercept = np.atleast_1d(np.asarray(intercept, dtype=float))
+        self.classes = np.asarray(classes)
+        # Channels, band-pass filter and ridge of the training covariances
+        self.ch_names = None if ch_names is None else [str(ch) for ch in ch_names]
+        self.l_freq = float(l_freq)
+        self.h_freq = float(h_freq)
+        self.ridge = float(ridge)
+        self.isqrt_reference = _eig_function(self.reference, lambda eigvals: 1 / np.sqrt(eigvals))
+        rows, cols = np.triu_indices(self.reference.shape[0])
+        self._triu = (rows, cols)
+        self._weights = np.where(rows == cols, 1, np.sqrt(2))
+
+    @classmethod
+    def fit(cls, covariances, labels, ch_names=None, l_freq=8, h_freq=30, ridge=COVARIANCE_RIDGE):
+        # Trains the decoder on (n_trials, n_channels, n_channels) covariance matrices, regularized with ridge
+        from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+        reference = riemannian_mean(covariances)
+        lda = LinearDiscriminantAnalysis(solver='lsqr', shrinkage='auto')
+        lda.fit(tangent_space(covariances, reference), labels)
+        return cls(reference, lda.coef_, lda.intercept_, lda.classes_, ch_names, l_freq, h_freq, ridge)
+
+    @classmethod
+    def load(cls, file_path):
+        model = np.load(file_path)
+        ch_names = list(model['ch_names']) if 'ch_names' in model else None
+        # The models saved before the ridge was added are used with the default one
+        ridge = float(model['ridge']) if 'ridge' in model else COVARIANCE_RIDGE
+        return cls(model['reference'], model['coef'], model['intercept'], model['classes'], ch_names,
+                   float(model['l_freq']), float(model['h_freq']), ridge)
+
+    def save(self, file_path):
+        arrays = dict(reference=self.reference, coef=self.coef, intercept=self.intercept, classes=self.classes,
+                      l_freq=self.l_freq, h_freq=self.h_freq, ridge=self.ridge)
+        if self.ch_names is not None:
+            arrays['ch_names'] = np.array(self.ch_names)
+        np.savez(file_path, **arrays)
+
+    def transform(self, covariances):
+        # Tangent space features, (n_matrices, n_features)
+        covariances = np.asarray(covariances, dtype=float)
+        if covariances.ndim == 2:
+            covariances = covariances[None]
+        tangent = _eig_function(self.isqrt_reference @ covariances @ self.isqrt_reference, np.log)
+        return tangent[:, self._triu[0], self._triu[1]] * self._weights
+
+    def decision_function(self, covariances):
+        scores = self.transform(covariances) @ self.coef.T + self.intercept
+        return scores[:, 0] if scores.shape[1] == 1 else scores
+
+    def predict(self, covariances):
+        scores = self.decision_function(covariances)
+        if scores.ndim == 1:
+            return self.classes[(scores > 0).astype(int)]
+        return self.classes[np.argmax(scores, axis=1)]
+
+    def predict_proba(self, covariances):
+        scores = self.decision_function(covariances)
+        if scores.ndim == 1:
+            proba = 1 / (1 + np.exp(-scores))
+            return np.column_stack((1 - proba, proba))
+        scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return scores / scores.sum(axis=1, keepdims=True)
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+class EpochCache():
+    """
+    On-disk cache of preprocessed epochs, so the trainings of the same runs skip their loading and filtering.
+
+    Entries are content-addressed: the key is the SHA-256 of the content of the source files of the epochs
+    (e.g. the .vhdr, .vmrk, .eeg and events.tsv of a run), the preprocessing parameters and the version of
+    mne, so an entry is not used anymore when a run is written again or a parameter changes. params must
+    describe everything that preprocess does, e.g. the filters and the epoching window.
+    Each entry is a folder with the epochs data (epochs.npy, which other tools can memory-map with np.load),
+    the events (events.npy), the mne info (info.fif) and the metadata (metadata.json: tmin, event_id, the
+    sources and the parameters). When an entry is stored, the entries of the same source files and parameters with
+    another key (the files were written again, or mne was updated) are removed.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, sources, params):
+        import mne
+
+        content = {'sources': [file_hash(source) for source in sources], 'params': params, 'mne': mne.__version__}
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def get(self, sources, params, preprocess):
+        """
+        Returns the epochs (mne EpochsArray) of sources preprocessed with params, from the cache, or computes
+        them with preprocess() (returns mne Epochs) and stores them.
+        """
+        key = self.key(sources, params)
+        epochs = self.load(key)
+        if epochs is not None:
+            self.hits += 1
+            return epochs
+        self.misses += 1
+        self.store(key, preprocess(), sources, params)
+        return self.load(key)
+
+    def load(self, key):
+        # Epochs of an entry, or None if it is not in the cache
+        import mne
+
+        entry = os.path.join(self.folder, key)
+        if not os.path.isdir(entry):
+            return None
+        with open(os.path.join(entry, 'metadata.json')) as file:
+            metadata = json.load(file)
+        data = np.load(os.path.join(entry, 'epochs.npy'), mmap_mode='r')
+        events = np.load(os.path.join(entry, 'events.npy'))
+        info = mne.io.read_info(os.path.join(entry, 'info.fif'))
+        return mne.EpochsArray(data, info, events=events, tmin=metadata['tmin'], event_id=metadata['event_id'],
+                               baseline=None)
+
+    def store(self, key, epochs, sources, params):
+        import mne
+
+        os.makedirs(self.folder, exist_ok=True)
+        # The entry is written in a temporary folder and renamed, so an interrupted write leaves no entry
+        temporary = tempfile.mkdtemp(dir=self.folder, prefix='.tmp_')
+        np.save(os.path.join(temporary, 'epochs.npy'), epochs.get_data())
+        np.save(os.path.join(temporary, 'events.npy'), epochs.events)
+        mne.io.write_info(os.path.join(temporary, 'info.fif'), epochs.info)
+        sources = [os.path.abspath(source) for source in sources]
+        metadata = dict(tmin=epochs.tmin, event_id=epochs.event_id, sources=sources, params=params)
+        with open(os.path.join(temporary, 'metadata.json'), 'w') as file:
+            json.dump(metadata, file, indent=4)
+        self.remove_entries(sources, params)
+        try:
+            os.rename(temporary, os.path.join(self.folder, key))
+        except OSError:   # stored meanwhile by another process
+            shutil.rmtree(temporary)
+
+    def remove_entries(self, sources, params):
+        # Removes the entries of the same source files and parameters, they are outdated
+        params = json.loads(json.dumps(params))   # as read from metadata.json
+        for key in os.listdir(self.folder):
+            metadata_path = os.path.join(self.folder, key, 'metadata.json')
+            if key.startswith('.tmp_') or not os.path.exists(metadata_path):
+                continue
+            with open(metadata_path) as file:
+                metadata = json.load(file)
+            if metadata['sources'] == sources and metadata['params'] == params:
+                # On Windows, the data of an entry can not be removed while it is memory-mapped
+                shutil.rmtree(os.path.join(self.folder, key), ignore_errors=True)
+
+def file_hash(path, chunk_size=1 << 20):
+    # SHA-256 of the content of a file, read in chunks
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,104 @@
+import numpy as np
+
+COLUMNS = ('sample', 'code', 'receive_time', 'onset')
+
+class EventIndex():
+    """
+    Append-only index of the markers of a run: the sample where each marker was recorded, its code, the
+    time.monotonic_ns() when it was received (-1 when unknown) and the onset, the sample of its stimulus
+    (the recorded sample unless the marker was back-dated, see src.clock_sync).
+
+    The BoardRingBuffer appends the markers as they are drained, so the decoders find the last marker of a
+    code (last) and the BIDS writer gets the events of the run (events_array) without scanning the marker
+    channel. With persist, every event is also appended to a TSV file when it is indexed, so the events of a
+    run, complete or not, can be read without its signal data (read_event_index).
+    """
+    def __init__(self, capacity=1024):
+        self.data = np.zeros((capacity, len(COLUMNS)), dtype=np.int64)
+        self.n_events = 0
+        self._by_code = {}   # code: rows of its events
+        self.file = None
+
+    def __len__(self):
+        return self.n_events
+
+    def append(self, sample, code, receive_time=-1, onset=None):
+        if self.n_events == len(self.data):
+            self.data = np.concatenate([self.data, np.zeros_like(self.data)])
+        row = (sample, code, receive_time, sample if onset is None else onset)
+        self.data[self.n_events] = row
+        self._by_code.setdefault(int(code), []).append(self.n_events)
+        self.n_events += 1
+        if self.file is not None:
+            write_rows(self.file, [row])
+            self.file.flush()
+
+    @property
+    def samples(self):
+        return self.data[:self.n_events, 0]
+
+    @property
+    def codes(self):
+        return self.data[:self.n_events, 1]
+
+    @property
+    def receive_times(self):
+        return self.data[:self.n_events, 2]
+
+    @property
+    def onsets(self):
+        return self.data[:self.n_events, 3]
+
+    def last(self, code, after=0):
+        # (sample, code, receive time, onset) of the last event of code recorded at sample >= after, or None
+        rows = self._by_code.get(int(code))
+        if not rows or self.data[rows[-1], 0] < after:
+            return None
+        return tuple(int(value) for value in self.data[rows[-1]])
+
+    def events_array(self):
+        """
+        MNE events array (onset, 0, code), in order of onset. The onsets are the samples that the online
+        decoders align their windows to (BoardRingBuffer.wait_for_marker), so the epochs of the training
+        are aligned as the online windows.
+        """
+        order = np.argsort(self.onsets, kind='stable')
+        events = np.zeros((self.n_events, 3), dtype=int)
+        events[:, 0] = self.onsets[order]
+        events[:, 2] = self.codes[order]
+        return events
+
+    def persist(self, path):
+        # Writes the events to the TSV file path, and appends the next ones as they are indexed
+        self.file = open(path, 'w')
+        self.file.write('\t'.join(COLUMNS) + '\n')
+        write_rows(self.file, self.data[:self.n_events])
+        self.file.flush()
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            file.write('\t'.join(COLUMNS) + '\n')
+            write_rows(file, self.data[:self.n_events])
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def write_rows(file, rows):
+    # The unknown receive times are written as n/a, as in the BIDS tables
+    for sample, code, receive_time, onset in rows:
+        file.write(f"{sample}\t{code}\t{receive_time if receive_time >= 0 else 'n/a'}\t{onset}\n")
+
+def read_event_index(path):
+    # EventIndex of a TSV file, the last line is ignored if it was not completely written
+    index = EventIndex()
+    with open(path) as file:
+        next(file)
+        for line in file:
+            fields = line.rstrip('\n').split('\t')
+            if not line.endswith('\n') or len(fields) != len(COLUMNS):
+                break
+            sample, code, receive_time, onset = fields
+            index.append(int(sample), int(code), -1 if receive_time == 'n/a' else int(receive_time), int(onset))
+    return index
@@ -0,0 +1,55 @@
+import argparse
+import subprocess
+import sys
+from collections import defaultdict
+
+# Modules imported by the online scripts before the board is prepared
+DEFAULT_MODULES = ['src.UdpComms', 'src.boards', 'src.processing', 'src.decoders', 'src.bids_files', 'src.spool']
+
+def import_times(modules):
+    """
+    Imports the modules in a fresh interpreter with python -X importtime.
+    Returns the (module, self time, cumulative time, depth) of every import, times in seconds.
+    """
+    code = '; '.join(f'import {module}' for module in modules)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative_time, name = line[len('import time:'):].split('|')
+        # The names are indented by 1 space for the imports of the command, and 2 more per nesting level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((name.strip(), int(self_time) / 1e6, int(cumulative_time) / 1e6, depth))
+    return times
+
+def package_times(times):
+    # Self time summed by top-level package (numpy, scipy, mne, ...), sorted from the most expensive
+    packages = defaultdict(float)
+    for name, self_time, _, _ in times:
+        packages[name.split('.')[0]] += self_time
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)
+
+if __name__ == '__main__':
+    # Usage: python -m src.import_budget [--budget seconds] [--top n] [module ...]
+    parser = argparse.ArgumentParser(description='Reports the import time of modules, and checks it against a budget.')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--budget', type=float, default=None, help='maximum total import time, in seconds')
+    parser.add_argument('--top', type=int, default=10, help='number of packages to report')
+    args = parser.parse_args()
+
+    times = import_times(args.modules)
+    print('Cumulative import time of each module:')
+    for name, _, cumulative_time, _ in times:
+        if name in args.modules:
+            print(f'  {name:<30} {cumulative_time:7.3f} s')
+    print('Most expensive packages (self time):')
+    for package, package_time in package_times(times)[:args.top]:
+        print(f'  {package:<30} {package_time:7.3f} s')
+    total = sum(cumulative_time for _, _, cumulative_time, depth in times if depth == 0)
+    print(f'Total: {total:.3f} s')
+    if args.budget is not None and total > args.budget:
+        print(f'Over the budget of {args.budget:.3f} s')
+        sys.exit(1)
@@ -0,0 +1,162 @@
+import struct
+from collections import OrderedDict, deque, namedtuple
+
+# Binary marker protocol, version 1. A datagram is a header followed by n_records records, little-endian:
+#   header: magic b'BM', version (uint8), kind (uint8), n_records (uint16)
+#   record: sequence number (uint32), code (uint16), flags (uint16), sender clock (int64, ns)
+# Events (kind KIND_EVENT) are sent by the stimulation protocol, several of them can be batched in one datagram.
+# Decisions (kind KIND_DECISION) are sent back by the decoder: the sequence number is the trial ID, and the
+# sender clock is the echo of the clock of the event that started the decoding, so the stimulation protocol
+# can measure the round-trip decode latency with its own clock.
+MAGIC = b'BM'
+VERSION = 1
+KIND_EVENT = 0
+KIND_DECISION = 1
+FLAG_RESET = 1   # first event of a sender, its sequence numbers start again
+HEADER = struct.Struct('<2sBBH')
+RECORD = struct.Struct('<IHHq')
+MAX_RECORDS = (1024 - HEADER.size) // RECORD.size   # records that fit in the 1024 bytes read by UdpComms
+
+# seq and sender_clock are None for the events of the ASCII protocol
+MarkerEvent = namedtuple('MarkerEvent', ['code', 'seq', 'sender_clock', 'flags'])
+
+class MarkerProtocol():
+    """
+    Encoder and decoder of the binary marker protocol, with fallback to the ASCII "marker_code-time stamp" strings.
+
+    decode is used by UdpComms (protocol argument) to turn each datagram into MarkerEvents. The sequence numbers
+    are checked: the duplicated events are dropped and counted in n_duplicates, the missing ones are counted in
+    n_lost, and the ones that arrive late are delivered and counted in n_reordered.
+    encode_decision returns the message of a decision: the binary record with the trial ID when binary_decisions
+    is True, otherwise the ASCII string of decision_strings (str(code) by default), encoded once.
+    encode_events is the sender side of the events, used by stimulation protocols written in Python.
+    """
+    def __init__(self, binary_decisions=False, decision_strings=None, history=256):
+        self.binary_decisions = binary_decisions
+        self.decision_strings = {code: str(text).encode('utf-8') for code, text in (decision_strings or {}).items()}
+        self.decision_buffer = bytearray(HEADER.size + RECORD.size)
+        HEADER.pack_into(self.decision_buffer, 0, MAGIC, VERSION, KIND_DECISION, 1)
+        # Receiver state
+        self.expected_seq = None
+        self.recent_events = deque(maxlen=history)   # (seq, sender clock), to recognize duplicates
+        self.missing = OrderedDict()   # the last history sequence numbers counted in n_lost, to recognize late events
+        self.history = history
+        self.n_events = 0
+        self.n_ascii = 0
+        self.n_lost = 0
+        self.n_duplicates = 0
+        self.n_reordered = 0
+        # Sender state
+        self.next_seq = 0
+
+    def decode(self, datagram):
+        # Returns the list of new MarkerEvents of a datagram (bytes)
+        if datagram[:2] != MAGIC:
+            return self.decode_ascii(datagram)
+        if len(datagram) < HEADER.size:
+            raise ValueError(f"Invalid marker datagram: {len(datagram)} bytes")
+        _, version, kind, n_records = HEADER.unpack_from(datagram)
+        if version != VERSION or kind != KIND_EVENT or len(datagram) < HEADER.size + n_records * RECORD.size:
+            raise ValueError(f"Invalid marker datagram: version {version}, kind {kind}, {len(datagram)} bytes")
+        events = []
+        for seq, code, flags, sender_clock in RECORD.iter_unpack(datagram[HEADER.size:HEADER.size + n_records * RECORD.size]):
+            if self.check_sequence(seq, flags, sender_clock):
+                events.append(MarkerEvent(code, seq, sender_clock, flags))
+        self.n_events += len(events)
+        return events
+
+    def decode_ascii(self, datagram):
+        # "marker_code-time stamp" string of the current stimulation protocols
+        code = int(datagram.decode('utf-8').split('-')[0])
+        self.n_ascii += 1
+        self.n_events += 1
+        return [MarkerEvent(code, None, None, 0)]
+
+    def check_sequence(self, seq, flags, sender_clock):
+        """
+        Returns False if the event is a duplicate, and updates the counters of lost and late events.
+        A duplicate has the sequence number and the sender clock of a recent event, so the first event of a
+        sender that started again (FLAG_RESET) is not taken as a duplicate of the first event of the previous one.
+        An event older than the expected one is late only if it was counted as lost, otherwise it is a stale
+        duplicate (e.g. sent again after it left recent_events, or sent before the reset of the sender).
+        """
+        if (seq, sender_clock) in self.recent_events:
+            self.n_duplicates += 1
+            return False
+        if self.expected_seq is None or flags & FLAG_RESET:
+            self.recent_events.clear()
+            self.missing.clear()
+        elif (seq - self.expected_seq) % 2**32 >= 2**31:   # older than the expected one
+            if seq not in self.missing:
+                self.n_duplicates += 1
+                return False
+            del self.missing[seq]
+            self.n_lost -= 1
+            self.n_reordered += 1
+            self.recent_events.append((seq, sender_clock))
+            return True
+        else:
+            n_missing = (seq - self.expected_seq) % 2**32
+            self.n_lost += n_missing
+            # Only the last history missing events are kept, the older ones stay counted as lost
+            for missing_seq in range(seq - min(n_missing, self.history), seq):
+                self.missing[missing_seq % 2**32] = None
+            while len(self.missing) > self.history:
+                self.missing.popitem(last=False)
+        self.expected_seq = (seq + 1) % 2**32
+        self.recent_events.append((seq, sender_clock))
+        return True
+
+    def encode_events(self, events):
+        """
+        events is a list of (code, sender clock in ns) or (code, sender clock, flags). Returns the list of datagrams,
+        with up to MAX_RECORDS events each, and numbers the events with the next sequence numbers.
+        """
+        datagrams = []
+        for start in range(0, len(events), MAX_RECORDS):
+            batch = events[start:start + MAX_RECORDS]
+            datagram = bytearray(HEADER.size + len(batch) * RECORD.size)
+            HEADER.pack_into(datagram, 0, MAGIC, VERSION, KIND_EVENT, len(batch))
+            for idx, event in enumerate(batch):
+                code, sender_clock, flags = event if len(event) == 3 else (*event, 0)
+                if self.next_seq == 0:
+                    flags |= FLAG_RESET
+                RECORD.pack_into(datagram, HEADER.size + idx * RECORD.size, self.next_seq, code, flags, sender_clock)
+                self.next_seq = (self.next_seq + 1) % 2**32
+            datagrams.append(bytes(datagram))
+        return datagrams
+
+    def encode_decision(self, trial_id, code, echo_clock=None):
+        """
+        Returns the message of the decision code of trial trial_id. echo_clock is the sender clock of the event
+        that started the decoding (MarkerEvent.sender_clock), None for the events of the ASCII protocol.
+        The binary message is written in a preallocated buffer, it is valid until the next call.
+        """
+        if not self.binary_decisions:
+            if code not in self.decision_strings:
+                self.decision_strings[code] = str(code).encode('utf-8')
+            return self.decision_strings[code]
+        RECORD.pack_into(self.decision_buffer, HEADER.size, trial_id % 2**32, code, 0,
+                         -1 if echo_clock is None else echo_clock)
+        return self.decision_buffer
+
+def decode_decision(datagram):
+    # Stimulation protocol side: returns the (trial ID, code, echoed sender clock) of a binary decision
+    _, version, kind, _ = HEADER.unpack_from(datagram)
+    if version != VERSION or kind != KIND_DECISION:
+        raise ValueError(f"Invalid decision datagram: version {version}, kind {kind}")
+    trial_id, code, _, echo_clock = RECORD.unpack_from(datagram, HEADER.size)
+    return trial_id, code, echo_clock
+
+def marker_inserter(board, end_marker):
+    """
+    Returns the callback of the marker socket (AddCallback of UdpComms or ReplayMarkerSource) that inserts the
+    received markers, except end_marker, in the board. It runs in the receiving thread, so the markers are inserted
+    as soon as they are received. With the binary protocol, the clock of the stimulus is used to back-date the
+    marker (see src.clock_sync), and the markers are indexed with their receive time in board.events, saved with
+    the run (see src.event_index).
+    """
+    def insert_received_marker(event, receive_time):
+        if event.code != end_marker:
+            board.insert_marker(event.code, sender_clock=event.sender_clock, receive_time=receive_time)
+    return insert_received_marker
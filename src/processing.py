@@ -1,104 +1,674 @@
-import time
-import mne
-import numpy as np
-from sklearn.cross_decomposition import CCA
-
-def predict_one_trial_MI(board, exg_channels_indices, mne_info, trained_pipeline):
-    """
-    Predicts the class of the motor imagery task for one trial.
-    """
-    time.sleep(2.5)
-
-    # Get data from -2 s to 2.5 s
-    sampling_rate = mne_info['sfreq']
-    n_samples = int(4.5*sampling_rate)
-    data = board.get_current_board_data(n_samples)
-    data = data[exg_channels_indices]   # Keep only the EEG channels
-    
-    # Process trial
-    data = data/1000000   # Convert from uV to V for MNE
-    data = data.reshape(1, data.shape[0], data.shape[1])
-
-    trial_epoch = mne.EpochsArray(data, mne_info)
-    # Remove last channel
-    trial_epoch.drop_channels(['NA'])
-    trial_epoch.filter(8, 30)
-    # Crop from 0.5 s to 2.5 s post go cue.
-    # Here time is referenced to the trial indication marker
-    trial_epoch.crop(2.5, 4.5)
-    trial_array = trial_epoch.get_data()
-
-    # CSP transformation
-    csp = trained_pipeline['csp']
-    Gte = csp.transform(trial_array)
-
-    # LDA classification
-    lda = trained_pipeline['lda']
-    y_pred = lda.predict(Gte)
-
-    return trial_array, y_pred
-
-def generate_reference_signals(target_freq, sampling_rate, n_samples, n_harmonics=6):
-    # Generate sinusoidal reference templates for CCA for the given flicker frequency and number of harmonics
-    reference_signals = []
-    t = np.arange(0, (n_samples/(sampling_rate)), step=1.0/(sampling_rate))
-    for i in range(1, n_harmonics+1):
-        reference_signals.append(np.sin(2*np.pi*i*target_freq*t))
-        reference_signals.append(np.cos(2*np.pi*i*target_freq*t))
-    return reference_signals
-            
-def find_corr(n_components, eeg_data, freq):
-    # Perform Canonical correlation analysis (CCA)
-    # eeg_data - consists of the EEG
-    # freq - set of sinusoidal reference templates corresponding to the flicker frequency
-    cca = CCA(n_components)
-    corr = np.zeros(n_components)
-    result = np.zeros((freq.shape)[0])
-    for freq_idx in range((freq.shape)[0]):
-        # Fit the CCA model to the EEG data and reference signals
-        cca.fit(np.squeeze(eeg_data.T), np.squeeze(freq[freq_idx]).T)
-        # Transform the EEG data and reference signals into the canonical space
-        O1_a, O1_b = cca.transform(np.squeeze(eeg_data.T), np.squeeze(freq[freq_idx]).T)
-        for ind_val in range(n_components):
-            corr[ind_val] = np.corrcoef(O1_a[:, ind_val], O1_b[:, ind_val])[0, 1]
-        result[freq_idx] = np.max(corr)
-    return result
-
-def predict_one_trial_SSVEP(board, exg_channels_indices, mne_info):
-    """
-    Predicts the class of SSVEP for one trial.
-    """
-    window_length = 3  # seconds
-    n_CCA_components = 1
-    n_harmonics = 6
-    frequencies = [8.5, 10, 12, 15] # left: 8.5 Hz, right: 10 Hz, up: 12Hz, down: 15Hz
-    time.sleep(window_length + 2)
-
-    sampling_rate = mne_info['sfreq']
-    # Get data from 0 s to window_length + 1 s data
-    n_samples = int((window_length+2)*sampling_rate)
-    data = board.get_current_board_data(n_samples)
-    data = data[exg_channels_indices]   # Keep only the EEG channels
-    
-    # Process trial
-    data = data/1000000   # Convert from uV to V for MNE
-    data = data.reshape(1, data.shape[0], data.shape[1])
-
-    trial_epoch = mne.EpochsArray(data, mne_info)
-    # Pick only O1 and O2 channels
-    trial_epoch.pick(['Fp1', 'Fp2'])
-    # Bandpass filter from 1 to 40 Hz
-    trial_epoch.filter(1, 20)
-    # Crop from 1 s to window_length + 1 s post go cue.
-    # Here time is referenced to the trial indication marker
-    trial_epoch.crop(1, window_length + 1)
-    trial_array = trial_epoch.get_data()
-
-    # Generate a vector of sinusoidal reference templates for all SSVEP flicker frequencies
-    freq = np.array([generate_reference_signals(f, sampling_rate, trial_array.shape[2], n_harmonics) for f in frequencies])
-    # Compute CCA 
-    CCA_output = find_corr(n_CCA_components, trial_array, freq)
-    # Find the maximum canonical correlation coefficient and corresponding class for the given SSVEP/EEG data
-    y_pred = np.argmax(CCA_output)
-
-    return trial_array, y_pred
+import time
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+
+# mne and scipy are imported in the functions that use them, so that importing this module is fast and
+# they are only loaded by the decoders of the session (see src/import_budget.py)
+from src.decoders import FusedCSPLDA, ProbabilitySmoother, COVARIANCE_RIDGE, regularize_covariance
+
+# SSVEP stimulation frequencies, in the order of the decoded classes
+# left: 8.5 Hz / 0 , right: 10 Hz / 1 , up: 12Hz / 2 ,  down: 15Hz / 3
+SSVEP_FREQUENCIES = [8.5, 10, 12, 15]
+# Channels used by the SSVEP decoders
+SSVEP_CHANNELS = ['Fp1', 'Fp2']
+
+class MITrialPreprocessor():
+    """
+    NumPy-only preprocessing of the motor imagery trials, without building MNE objects on every trial.
+
+    Does the same as the MNE steps it replaces (drop the 'NA' channel, band-pass filter and crop), and its
+    output matches them within numerical tolerance: the FIR filter is designed once per session with the
+    defaults of mne Epochs.filter, applied with the same edge padding, and the crop is done by sample index.
+    """
+    def __init__(self, mne_info, l_freq=8, h_freq=30, tmin=2.5, tmax=4.5, drop_channels=('NA',)):
+        import mne
+
+        self.sfreq = mne_info['sfreq']
+        self.picks = [idx for idx, ch in enumerate(mne_info['ch_names']) if ch not in drop_channels]
+        self.ch_names = [mne_info['ch_names'][idx] for idx in self.picks]
+        self.fir = mne.filter.create_filter(None, self.sfreq, l_freq, h_freq, method='fir', phase='zero',
+                                            fir_window='hamming', fir_design='firwin', verbose=False)
+        # Crop limits in samples, tmax included as in mne crop
+        self.start = int(round(tmin * self.sfreq))
+        self.stop = int(round(tmax * self.sfreq)) + 1
+
+    def __call__(self, data):
+        """
+        Preprocesses one trial. data is the (n_channels, n_samples) array of EEG channels, in V.
+        Returns the (1, n_picks, n_window) trial array.
+        """
+        from scipy.signal import oaconvolve
+
+        data = data[self.picks]
+        n_times = data.shape[-1]
+        start, stop = min(self.start, n_times), min(self.stop, n_times)
+        # Edge padding of the FIR length on each side, as mne does for epochs
+        n_edge = max(min(len(self.fir), n_times) - 1, 0)
+        padded = np.pad(data, ((0, 0), (n_edge, n_edge)), mode='edge')
+        # Trials shorter than the filter are further padded with zeros
+        half = (len(self.fir) - 1) // 2
+        n_zeros = max(half - n_edge, 0)
+        padded = np.pad(padded, ((0, 0), (n_zeros, n_zeros)))
+        # Zero-phase filtering, computed only for the samples kept by the crop
+        offset = n_edge + n_zeros
+        segment = padded[:, start + offset - half:stop + offset + half]
+        trial_array = oaconvolve(segment, self.fir[None], mode='valid', axes=-1)
+        return trial_array[None]
+
+def get_trial_data(board, sampling_rate, tmin, tmax, marker_code=None):
+    """
+    Waits for the trial and returns the int((tmax - tmin) * sampling_rate) samples of board data from tmin
+    to tmax seconds after the go cue.
+    With a BoardRingBuffer and the marker_code of the go cue, the window is aligned to the exact sample of
+    the last inserted marker with that code. Otherwise, the go cue is the time of the call: the function
+    sleeps tmax seconds and returns the last samples of the board.
+    """
+    n_samples = int((tmax - tmin)*sampling_rate)
+    if marker_code is not None and hasattr(board, 'get_marker_window'):
+        start = int(round(tmin*sampling_rate))
+        return board.get_marker_window(marker_code, start, start + n_samples, timeout=tmax + 5)
+    time.sleep(tmax)
+    return board.get_current_board_data(n_samples)
+
+def predict_one_trial_MI(board, exg_channels_indices, mne_info, trained_pipeline, preprocessor=None, marker_code=None):
+    """
+    Predicts the class of the motor imagery task for one trial.
+    trained_pipeline is a FusedCSPLDA decoder, or the {'csp', 'lda'} pipeline saved by the training script.
+    preprocessor is the MITrialPreprocessor of the session, one is created if it is not given.
+    marker_code is the go cue, to align the trial to its sample with a BoardRingBuffer (see get_trial_data).
+    """
+    # Get data from -2 s to 2.5 s
+    data = get_trial_data(board, mne_info['sfreq'], -2, 2.5, marker_code)
+    data = data[exg_channels_indices]   # Keep only the EEG channels
+    
+    # Process trial
+    data = data/1000000   # Convert from uV to V for MNE
+
+    # Remove last channel, filter from 8 to 30 Hz and
+    # crop from 0.5 s to 2.5 s post go cue.
+    # Here time is referenced to the trial indication marker
+    if preprocessor is None:
+        preprocessor = MITrialPreprocessor(mne_info)
+    trial_array = preprocessor(data)
+
+    # CSP transformation and LDA classification
+    if isinstance(trained_pipeline, dict):
+        trained_pipeline = FusedCSPLDA.from_pipeline(trained_pipeline)
+    y_pred = trained_pipeline.predict(trial_array)
+
+    return trial_array, y_pred
+
+class ContinuousMIDecoder():
+    """
+    Continuous motor imagery decoding.
+
+    Between start() and stop(), a background thread classifies the last window_length seconds of the live
+    stream every hop seconds, smooths the class probabilities with a ProbabilitySmoother and sends the
+    smoothed probability of the last decoder class (MI) to the stimulation protocol as "MI:<probability>".
+    The windows are preprocessed like the trials of predict_one_trial_MI, with margin seconds of extra data
+    before each window for the filter. With a TangentSpaceLDA decoder, the windows are instead the
+    covariances of a StreamingCovariance. The cost of every window is measured, and it has to stay well
+    under the hop.
+    """
+    def __init__(self, board, exg_channels_indices, mne_info, decoder, sock=None, window_length=2, hop=0.0625,
+                 margin=2.5, smoother=None, streaming_covariance=None):
+        self.board = board
+        self.streaming_covariance = streaming_covariance
+        self.exg_channels_indices = exg_channels_indices
+        self.decoder = decoder
+        self.sock = sock
+        self.hop = hop
+        self.n_samples = int((margin + window_length) * mne_info['sfreq'])
+        self.preprocessor = MITrialPreprocessor(mne_info, tmin=margin, tmax=margin + window_length)
+        self.smoother = ProbabilitySmoother(len(decoder.classes)) if smoother is None else smoother
+        self.proba = None
+        self.n_windows = 0
+        self.total_cost = 0
+        self.max_cost = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        self.smoother.reset()
+        self.proba = None
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # Stops the decoding and returns the last smoothed probabilities
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self.proba
+
+    def decode_window(self):
+        # Classifies the last window of the stream and returns the smoothed probabilities
+        if self.streaming_covariance is not None:
+            covariance = self.streaming_covariance.update()
+            if covariance is None:
+                return self.proba
+            return self.smoother.update(self.decoder.predict_proba(covariance))
+        data = self.board.get_current_board_data(self.n_samples)
+        data = data[self.exg_channels_indices]/1000000   # Keep only the EEG channels, in V
+        if data.shape[1] < self.n_samples:
+            return self.proba
+        proba = self.decoder.predict_proba(self.preprocessor(data))
+        return self.smoother.update(proba)
+
+    def _run(self):
+        next_time = time.perf_counter()
+        while not self._stop_event.is_set():
+            window_start = time.perf_counter()
+            proba = self.decode_window()
+            if proba is not None:
+                self.proba = proba
+                if self.sock is not None:
+                    self.sock.SendData(f"MI:{proba[-1]:.3f}")
+            cost = time.perf_counter() - window_start
+            self.n_windows += 1
+            self.total_cost += cost
+            self.max_cost = max(self.max_cost, cost)
+            # Wait for the next hop, without drifting
+            next_time += self.hop
+            self._stop_event.wait(max(next_time - time.perf_counter(), 0))
+
+class StreamingBandpass():
+    """
+    Causal band-pass filtering of a stream. The Butterworth filter keeps its state between calls, so each
+    call only filters the new samples, and the output equals sosfilt over the whole stream.
+    """
+    def __init__(self, n_channels, sampling_rate, l_freq=8, h_freq=30, order=4):
+        self.sos = design_bandpass(sampling_rate, l_freq, h_freq, order)
+        self.n_channels = n_channels
+        self.zi = None
+
+    def __call__(self, data):
+        # Filters the new (n_channels, n_samples) samples of the stream
+        from scipy.signal import sosfilt, sosfilt_zi
+
+        if self.zi is None:
+            # Start in steady state with the first sample, to avoid the step transient
+            self.zi = sosfilt_zi(self.sos)[:, None, :] * data[None, :, :1]
+        filtered, self.zi = sosfilt(self.sos, data, axis=-1, zi=self.zi)
+        return filtered
+
+class StreamingCovariance():
+    """
+    Covariance of the last window_length seconds of the band-passed EEG stream, updated incrementally.
+
+    Each update() reads only the samples acquired since the previous call, filters them with a
+    StreamingBandpass and updates the sum of outer products with the rank-one terms of the samples that
+    enter and leave the window, so the per-window cost does not depend on the window length. The sum is
+    recomputed from the window every recompute_every samples to bound the rounding drift.
+    New samples are counted with board.get_board_data_count, so the board buffer must not be full.
+    The covariance is regularized with the ridge of the decoder (see src.decoders.regularize_covariance),
+    since the covariance of a band-passed window can be rank-deficient.
+    """
+    def __init__(self, board, exg_channels_indices, mne_info, window_length=2, l_freq=8, h_freq=30,
+                 drop_channels=('NA',), recompute_every=10000, ridge=COVARIANCE_RIDGE):
+        self.board = board
+        picks = [idx for idx, ch in enumerate(mne_info['ch_names']) if ch not in drop_channels]
+        self.ch_names = [mne_info['ch_names'][idx] for idx in picks]
+        self.rows = [exg_channels_indices[idx] for idx in picks]
+        self.sampling_rate = mne_info['sfreq']
+        self.n_window = int(window_length * mne_info['sfreq'])
+        self.recompute_every = recompute_every
+        self.ridge = ridge
+        self.bandpass = StreamingBandpass(len(picks), mne_info['sfreq'], l_freq, h_freq)
+        # Circular buffer of the filtered samples in the window
+        self.window = np.zeros((len(picks), self.n_window))
+        self.position = 0
+        self.n_seen = 0
+        self.outer_sum = np.zeros((len(picks), len(picks)))
+        self.since_recompute = 0
+        self.board_count = 0
+
+    def push(self, data):
+        # Adds new (n_channels, n_samples) samples of the picked channels, in V
+        filtered = self.bandpass(data)
+        n_new = filtered.shape[1]
+        if n_new >= self.n_window:
+            self.window = np.ascontiguousarray(filtered[:, -self.n_window:])
+            self.position = 0
+            self.outer_sum = self.window @ self.window.T
+            self.since_recompute = 0
+        else:
+            indices = (self.position + np.arange(n_new)) % self.n_window
+            leaving = self.window[:, indices]
+            self.outer_sum += filtered @ filtered.T - leaving @ leaving.T
+            self.window[:, indices] = filtered
+            self.position = (self.position + n_new) % self.n_window
+            self.since_recompute += n_new
+            if self.since_recompute >= self.recompute_every:
+                self.outer_sum = self.window @ self.window.T
+                self.since_recompute = 0
+        self.n_seen += n_new
+
+    def update(self, stop=None):
+        """
+        Reads the new samples of the board and returns the covariance of the window.
+        With a BoardRingBuffer, stop is the absolute index where the window ends (all the samples by default).
+        """
+        if stop is not None:
+            if stop > self.board_count:
+                # Samples older than the ring buffer are skipped
+                start = max(self.board_count, stop - self.board.capacity // 2)
+                data = self.board.get_window(start, stop)[self.rows]/1000000   # uV to V
+                self.push(data)
+                self.board_count = stop
+            return self.covariance()
+        board_count = self.board.get_board_data_count()
+        n_new = board_count - self.board_count
+        if n_new > 0:
+            data = self.board.get_current_board_data(n_new)[self.rows]/1000000   # uV to V
+            self.push(data)
+            self.board_count = board_count
+        return self.covariance()
+
+    def covariance(self):
+        if self.n_seen < self.n_window:
+            return None
+        return regularize_covariance(self.outer_sum / self.n_window, self.ridge)
+
+def predict_one_trial_MI_riemannian(streaming_covariance, decoder, marker_code=None):
+    """
+    Predicts the class of the motor imagery task for one trial with a TangentSpaceLDA decoder,
+    from the covariance of the last 2 s, 2.5 s after the go cue.
+    marker_code is the go cue, to align the window to its sample with a BoardRingBuffer.
+    """
+    board = streaming_covariance.board
+    if marker_code is not None and hasattr(board, 'get_marker_window'):
+        stop = board.wait_for_marker(marker_code, timeout=10) + int(round(2.5*streaming_covariance.sampling_rate))
+        board.wait_for_sample(stop, timeout=10)
+        covariance = streaming_covariance.update(stop)
+    else:
+        time.sleep(2.5)
+        covariance = streaming_covariance.update()
+    y_pred = decoder.predict(covariance)
+    return covariance, y_pred
+
+def generate_reference_signals(target_freq, sampling_rate, n_samples, n_harmonics=6):
+    # Generate sinusoidal reference templates for CCA for the given flicker frequency and number of harmonics
+    reference_signals = []
+    t = np.arange(0, (n_samples/(sampling_rate)), step=1.0/(sampling_rate))
+    for i in range(1, n_harmonics+1):
+        reference_signals.append(np.sin(2*np.pi*i*target_freq*t))
+        reference_signals.append(np.cos(2*np.pi*i*target_freq*t))
+    return reference_signals
+
+def reference_templates(frequencies, sampling_rate, n_samples, n_harmonics=6):
+    # Sinusoidal reference templates of all the target frequencies at once, (n_targets, 2*n_harmonics, n_samples).
+    # Rows follow the same sin/cos order as generate_reference_signals
+    t = np.arange(n_samples) / sampling_rate
+    harmonics = np.arange(1, n_harmonics + 1)
+    phase = 2*np.pi * np.asarray(frequencies, dtype=float)[:, None, None] * harmonics[None, :, None] * t
+    templates = np.stack((np.sin(phase), np.cos(phase)), axis=2)
+    return templates.reshape(len(frequencies), 2*n_harmonics, n_samples)
+
+def window_n_samples(window_length, sampling_rate):
+    # Number of samples of a window of window_length seconds, as returned by mne crop (tmax included)
+    return int(round(window_length*sampling_rate)) + 1
+
+def orthonormal_basis(signals):
+    # Orthonormal basis of the column space of the centered signals (samples along the second-to-last axis).
+    # Stacked inputs (..., n_samples, n_signals) are factorized in a single batched QR call
+    signals = signals - signals.mean(axis=-2, keepdims=True)
+    basis, _ = np.linalg.qr(signals)
+    return basis
+
+def canonical_correlations(eeg_basis, reference_bases, n_components=1):
+    # Closed-form CCA: the canonical correlations between two sets of signals are the singular
+    # values of Qx^T Qy, where Qx and Qy are orthonormal bases of the centered signals.
+    # eeg_basis - (n_samples, n_channels) basis of the EEG window
+    # reference_bases - (n_targets, n_samples, 2*n_harmonics) bases of the reference templates
+    # Returns the first n_components canonical correlations for every target, (n_targets, n_components)
+    products = np.swapaxes(eeg_basis, -1, -2) @ reference_bases
+    corr = np.linalg.svd(products, compute_uv=False)
+    return np.clip(corr[..., :n_components], 0, 1)
+
+def find_corr(n_components, eeg_data, freq, reference_bases=None):
+    # Perform Canonical correlation analysis (CCA)
+    # eeg_data - consists of the EEG
+    # freq - set of sinusoidal reference templates corresponding to the flicker frequency
+    # reference_bases - optional precomputed orthonormal bases of freq (see ReferenceTemplateCache)
+    # The QR of the EEG window is computed once and reused for all target frequencies
+    eeg_data = np.reshape(eeg_data, (-1, np.shape(eeg_data)[-1]))   # (n_channels, n_samples)
+    eeg_basis = orthonormal_basis(eeg_data.T)
+    if reference_bases is None:
+        reference_bases = orthonormal_basis(np.swapaxes(np.asarray(freq), -1, -2))
+    corr = canonical_correlations(eeg_basis, reference_bases, n_components)
+    result = np.max(corr, axis=-1)
+    return result
+
+class ReferenceTemplateCache():
+    """
+    LRU cache of the SSVEP reference templates and their orthonormal bases.
+
+    Entries are keyed by (frequencies, sampling_rate, n_samples, n_harmonics). The cache is meant to be
+    warmed up at session start with the window lengths that the decoders will ask for, and it is bounded
+    both in number of entries and in bytes: the least recently used entries are evicted first.
+    """
+    def __init__(self, max_entries=64, max_bytes=64*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, frequencies, sampling_rate, n_samples, n_harmonics=6):
+        """
+        Returns the templates (n_targets, 2*n_harmonics, n_samples) and their orthonormal bases
+        (n_targets, n_samples, 2*n_harmonics). Both arrays are read-only since they are shared.
+        """
+        key = (tuple(float(f) for f in frequencies), float(sampling_rate), int(n_samples), int(n_harmonics))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        templates = reference_templates(key[0], key[1], key[2], key[3])
+        bases = orthonormal_basis(np.swapaxes(templates, -1, -2))
+        templates.setflags(write=False)
+        bases.setflags(write=False)
+        entry = (templates, bases)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = entry
+                self.nbytes += templates.nbytes + bases.nbytes
+                self._evict()
+        return entry
+
+    def warm_up(self, frequencies, sampling_rate, window_lengths, n_harmonics=6):
+        # Precompute the entries for the window lengths (in seconds) that the decoders will use
+        for window_length in window_lengths:
+            self.get(frequencies, sampling_rate, window_n_samples(window_length, sampling_rate), n_harmonics)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        # Drop least recently used entries, always keeping the newest one
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.nbytes > self.max_bytes):
+            _, (templates, bases) = self._entries.popitem(last=False)
+            self.nbytes -= templates.nbytes + bases.nbytes
+
+# Reference templates shared by the SSVEP decoders of the session
+reference_cache = ReferenceTemplateCache()
+
+@lru_cache(maxsize=8)
+def design_filter_bank(sampling_rate, n_bands=5, band_width=8, max_freq=88, order=4, ripple=0.5):
+    """
+    Designs the Chebyshev type I band-pass filter bank used by FBCCA. The design is cached, so it is
+    done only once per sampling rate. Sub-band m (1..n_bands) has its passband from m*band_width Hz up to
+    max_freq Hz (limited to 90% of the Nyquist frequency).
+    Returns the second-order sections of all the sub-bands, (n_bands, order, 6).
+    """
+    from scipy.signal import cheby1
+
+    high = min(max_freq, 0.9 * sampling_rate / 2)
+    sos_bank = []
+    for m in range(1, n_bands + 1):
+        low = m * band_width
+        if low >= high:
+            raise ValueError(f"Sub-band {m} starts at {low} Hz, above the {high} Hz upper edge for sfreq={sampling_rate} Hz")
+        sos_bank.append(cheby1(order, ripple, [low, high], btype='bandpass', fs=sampling_rate, output='sos'))
+    return np.array(sos_bank)
+
+def filter_bank_weights(n_bands, a=1.25, b=0.25):
+    # Weights of the sub-band correlations, w(m) = m^-a + b
+    return np.arange(1, n_bands + 1, dtype=float)**(-a) + b
+
+def apply_filter_bank(data, sos_bank):
+    # Zero-phase filtering of the data (..., n_samples) with every sub-band filter, (n_bands, ..., n_samples)
+    from scipy.signal import sosfiltfilt
+
+    return np.stack([sosfiltfilt(sos, data, axis=-1) for sos in sos_bank])
+
+def fbcca_scores(subband_data, reference_bases, weights, n_components=1):
+    # Filter-bank CCA scores of every target
+    # subband_data - (n_bands, n_channels, n_samples) sub-band components of the EEG window
+    # reference_bases - (n_targets, n_samples, 2*n_harmonics) bases of the reference templates
+    # The bases of all the sub-bands are computed in one batched QR, and all (sub-band, target) pairs in one SVD
+    eeg_bases = orthonormal_basis(np.swapaxes(subband_data, -1, -2))
+    corr = canonical_correlations(eeg_bases[:, None], reference_bases[None], n_components)
+    rho = np.max(corr, axis=-1)   # (n_bands, n_targets)
+    return weights @ rho**2
+
+@lru_cache(maxsize=8)
+def design_bandpass(sampling_rate, l_freq, h_freq, order=4):
+    # Butterworth band-pass filter (second-order sections), designed once per sampling rate and band
+    from scipy.signal import butter
+
+    return butter(order, [l_freq, h_freq], btype='bandpass', fs=sampling_rate, output='sos')
+
+def train_trca(trials, labels):
+    """
+    Trains an ensemble TRCA decoder.
+    trials - (n_trials, n_channels, n_samples) preprocessed calibration windows
+    labels - (n_trials,) class of each trial
+    Returns the spatial filters (n_channels, n_classes), one column per class, and the averaged
+    templates (n_classes, n_channels, n_samples), with the classes sorted by label.
+    """
+    from scipy.linalg import eigh
+
+    filters, templates = [], []
+    for label in np.unique(labels):
+        class_trials = trials[labels == label]
+        class_trials = class_trials - class_trials.mean(axis=2, keepdims=True)
+        # Covariance of the concatenated trials and sum of the cross-covariances between different trials
+        trials_sum = class_trials.sum(axis=0)
+        Q = np.einsum('tcs,tds->cd', class_trials, class_trials)
+        S = trials_sum @ trials_sum.T - Q
+        # The TRCA filter is the leading generalized eigenvector of (S, Q)
+        _, eigenvectors = eigh(S, Q)
+        filters.append(eigenvectors[:, -1])
+        templates.append(class_trials.mean(axis=0))
+    return np.array(filters).T, np.array(templates)
+
+class TRCADecoder():
+    """
+    Ensemble TRCA SSVEP decoder trained with decoding_pipeline_TRCA.py.
+
+    Holds the spatial filters and the averaged templates of each class together with the preprocessing
+    that was used to compute them (channels, band-pass and sampling rate). Windows shorter than the
+    templates are scored against the first samples of the templates.
+    """
+    def __init__(self, filters, templates, sfreq, channels, l_freq, h_freq):
+        self.filters = np.asarray(filters, dtype=float)
+        self.templates = np.asarray(templates, dtype=float)
+        self.sfreq = float(sfreq)
+        self.channels = list(channels)
+        self.l_freq = float(l_freq)
+        self.h_freq = float(h_freq)
+        self._projected_templates = {}
+
+    @classmethod
+    def load(cls, file_path):
+        model = np.load(file_path)
+        return cls(model['filters'], model['templates'], model['sfreq'], model['channels'].tolist(),
+                   model['l_freq'], model['h_freq'])
+
+    def save(self, file_path):
+        # Filters and templates are stored in float32 to keep the model file compact
+        np.savez(file_path, filters=self.filters.astype(np.float32), templates=self.templates.astype(np.float32),
+                 sfreq=self.sfreq, channels=np.array(self.channels), l_freq=self.l_freq, h_freq=self.h_freq)
+
+    def preprocess(self, data):
+        # Band-pass filtering of (..., n_channels, n_samples) data of the model channels
+        from scipy.signal import sosfiltfilt
+
+        return sosfiltfilt(design_bandpass(self.sfreq, self.l_freq, self.h_freq), data, axis=-1)
+
+    def projected_templates(self, n_samples):
+        # Centered and normalized projection of the first n_samples of every template, (n_classes, n_filters*n_samples)
+        if n_samples not in self._projected_templates:
+            if n_samples > self.templates.shape[-1]:
+                raise ValueError(f"The TRCA templates have {self.templates.shape[-1]} samples, the window has {n_samples}")
+            projected = np.einsum('cf,kcs->kfs', self.filters, self.templates[..., :n_samples])
+            projected = projected - projected.mean(axis=-1, keepdims=True)
+            projected = projected.reshape(len(projected), -1)
+            self._projected_templates[n_samples] = projected / np.linalg.norm(projected, axis=-1, keepdims=True)
+        return self._projected_templates[n_samples]
+
+    def scores(self, trials):
+        # Correlation between the filtered trials (..., n_channels, n_samples) and the filtered template of every class,
+        # (..., n_classes)
+        projected = np.einsum('cf,...cs->...fs', self.filters, trials)
+        projected = projected - projected.mean(axis=-1, keepdims=True)
+        projected = projected.reshape(projected.shape[:-2] + (-1,))
+        projected = projected / np.linalg.norm(projected, axis=-1, keepdims=True)
+        return projected @ self.projected_templates(trials.shape[-1]).T
+
+def ssvep_scores(data, mne_info, window_length, templates_cache=None, method='cca', n_harmonics=6, n_bands=5, trca_model=None):
+    """
+    Scores every SSVEP target on the window from 1 s to window_length + 1 s after the go cue.
+    data is the (1, n_channels, n_samples) trial starting at the go cue, in V.
+    method is 'cca' (1-20 Hz band-pass + CCA), 'fbcca' (filter-bank CCA) or 'trca' (trained TRCA decoder,
+    given in trca_model).
+    Returns the trial array of the window and the score of each target.
+    """
+    n_CCA_components = 1
+    frequencies = SSVEP_FREQUENCIES
+    sampling_rate = mne_info['sfreq']
+    if templates_cache is None:
+        templates_cache = reference_cache
+
+    if method == 'trca':
+        picks = [mne_info['ch_names'].index(ch) for ch in trca_model.channels]
+        # Band-pass filtering of the whole trial, as in training, then crop from 1 s to window_length + 1 s post go cue
+        filtered = trca_model.preprocess(data[0, picks])
+        start = int(round(1 * sampling_rate))
+        stop = start + window_n_samples(window_length, sampling_rate)
+        trial_array = filtered[None, :, start:stop]
+        return trial_array, trca_model.scores(trial_array[0])
+
+    if method == 'fbcca':
+        picks = [mne_info['ch_names'].index(ch) for ch in SSVEP_CHANNELS]
+        # Sub-band filtering of the whole trial, so that the filter transients fall outside the window
+        subbands = apply_filter_bank(data[0, picks], design_filter_bank(sampling_rate, n_bands))
+        # Crop from 1 s to window_length + 1 s post go cue
+        start = int(round(1 * sampling_rate))
+        stop = start + window_n_samples(window_length, sampling_rate)
+        subbands = subbands[..., start:stop]
+        trial_array = data[:, picks, start:stop]
+
+        _, reference_bases = templates_cache.get(frequencies, sampling_rate, subbands.shape[-1], n_harmonics)
+        scores = fbcca_scores(subbands, reference_bases, filter_bank_weights(n_bands), n_CCA_components)
+        return trial_array, scores
+
+    import mne
+
+    trial_epoch = mne.EpochsArray(data, mne_info)
+    # Pick only O1 and O2 channels
+    trial_epoch.pick(SSVEP_CHANNELS)
+    # Bandpass filter from 1 to 40 Hz
+    trial_epoch.filter(1, 20)
+    # Crop from 1 s to window_length + 1 s post go cue.
+    # Here time is referenced to the trial indication marker
+    trial_epoch.crop(1, window_length + 1)
+    trial_array = trial_epoch.get_data()
+
+    # Sinusoidal reference templates for all SSVEP flicker frequencies
+    freq, reference_bases = templates_cache.get(frequencies, sampling_rate, trial_array.shape[2], n_harmonics)
+    # Compute CCA 
+    CCA_output = find_corr(n_CCA_components, trial_array, freq, reference_bases)
+
+    return trial_array, CCA_output
+
+def ssvep_confidence(scores, criterion='margin', temperature=0.05):
+    # Confidence of the best scoring target
+    # margin - relative difference between the best and the second best scores
+    # softmax - probability of the best target after a softmax of the scores with the given temperature
+    scores = np.asarray(scores, dtype=float)
+    if criterion == 'margin':
+        best, second = np.sort(scores)[-1:-3:-1]
+        return (best - second) / best if best > 0 else 0.0
+    elif criterion == 'softmax':
+        probabilities = np.exp((scores - scores.max()) / temperature)
+        return probabilities.max() / probabilities.sum()
+    raise ValueError(f"Unknown confidence criterion: {criterion}")
+
+def predict_one_trial_SSVEP(board, exg_channels_indices, mne_info, window_length=3, templates_cache=None, method='cca', trca_model=None,
+                            marker_code=None):
+    """
+    Predicts the class of SSVEP for one trial.
+    window_length is given in seconds. The reference templates are taken from templates_cache
+    (the module reference_cache by default). method is 'cca' (1-20 Hz band-pass + CCA), 'fbcca'
+    (filter-bank CCA) or 'trca' (trained TRCA decoder, given in trca_model).
+    marker_code is the go cue, to align the trial to its sample with a BoardRingBuffer (see get_trial_data).
+    """
+    # Get data from 0 s to window_length + 2 s
+    data = get_trial_data(board, mne_info['sfreq'], 0, window_length + 2, marker_code)
+    data = data[exg_channels_indices]   # Keep only the EEG channels
+    
+    # Process trial
+    data = data/1000000   # Convert from uV to V for MNE
+    data = data.reshape(1, data.shape[0], data.shape[1])
+
+    trial_array, scores = ssvep_scores(data, mne_info, window_length, templates_cache, method, trca_model=trca_model)
+    # Find the maximum canonical correlation coefficient and corresponding class for the given SSVEP/EEG data
+    y_pred = np.argmax(scores)
+
+    return trial_array, y_pred
+
+def predict_one_trial_SSVEP_dynamic(board, exg_channels_indices, mne_info, min_window=1, max_window=3, step=0.25,
+                                    criterion='margin', threshold=0.2, templates_cache=None, method='fbcca', trca_model=None,
+                                    marker_code=None, margin=1):
+    """
+    Predicts the class of SSVEP for one trial with a dynamic window and early stopping.
+    Must be called at the go cue. The window, starting 1 s after the go cue, is re-scored every step seconds
+    from min_window on as the samples arrive. The decision is emitted as soon as the confidence of the best
+    target (see ssvep_confidence) reaches threshold, or when the window reaches max_window (hard timeout).
+    method, trca_model and marker_code are the same as in predict_one_trial_SSVEP.
+    Each window is filtered with margin seconds of data after it, so the edge transient of the filters falls
+    outside the window. With the default 1 s, as in predict_one_trial_SSVEP, the window of max_window is the
+    one of predict_one_trial_SSVEP with window_length=max_window, and the decisions are delayed by margin.
+    Returns the trial array, the predicted class and the decision time in seconds after the go cue.
+    """
+    go_cue_time = time.perf_counter()
+    sampling_rate = mne_info['sfreq']
+    window_length = min_window
+    while True:
+        # Get data from the go cue to margin seconds after the end of the window, as get_trial_data
+        tmax = window_length + 1 + margin
+        n_samples = max(int(tmax*sampling_rate), int(round(sampling_rate)) + window_n_samples(window_length, sampling_rate))
+        if marker_code is not None and hasattr(board, 'get_marker_window'):
+            data = board.get_marker_window(marker_code, 0, n_samples, timeout=max_window + margin + 5)
+        else:
+            # Wait until the window and its margin are complete
+            remaining = go_cue_time + tmax - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+            data = board.get_current_board_data(n_samples)
+        data = data[exg_channels_indices]   # Keep only the EEG channels
+        data = data/1000000   # Convert from uV to V for MNE
+        data = data.reshape(1, data.shape[0], data.shape[1])
+
+        trial_array, scores = ssvep_scores(data, mne_info, window_length, templates_cache, method, trca_model=trca_model)
+        if window_length >= max_window or ssvep_confidence(scores, criterion) >= threshold:
+            break
+        window_length = min(window_length + step, max_window)
+
+    decision_time = time.perf_counter() - go_cue_time
+    y_pred = np.argmax(scores)
+
+    return trial_array, y_pred, decision_time
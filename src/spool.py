@@ -0,0 +1,205 @@
+import argparse
+import json
+import os
+import threading
+import time
+import numpy as np
+
+# Written next to a spool when the BIDS writer could not save its run
+BIDS_ERROR_SUFFIX = '.bids_error.txt'
+
+class AcquisitionSpool():
+    """
+    Crash-safe on-disk spool of the raw board data of a run.
+
+    The samples are appended to a raw binary file, sample-major (n_samples, n_rows), in fixed-size chunks of
+    chunk_seconds, so the file can be memory-mapped at any time and a crash loses at most the chunk being
+    filled. The layout and the information needed to save the run (channels, markers, subject info...) are
+    written to the <path>.json header when the spool is created.
+
+    fsync sets when the chunks are forced to disk: 'chunk' after every chunk, 'interval' at most every
+    fsync_interval seconds, or 'close' only when the spool is closed.
+    append has the signature of the BoardRingBuffer chunk callbacks.
+    The event index of the board (src.event_index.EventIndex), if given, is persisted to <path>.events.tsv,
+    so the events of the run are recovered with the data.
+    """
+    def __init__(self, path, n_rows, sampling_rate, metadata=None, chunk_seconds=1, fsync='chunk', fsync_interval=5,
+                 dtype='float64', event_index=None):
+        if fsync not in ('chunk', 'interval', 'close'):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.path = path
+        self.n_rows = n_rows
+        self.dtype = np.dtype(dtype)
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.chunk = np.zeros((max(int(chunk_seconds * sampling_rate), 1), n_rows), dtype=self.dtype)
+        self.n_buffered = 0
+        self.n_samples = 0   # samples written to the file
+        self.last_fsync = time.monotonic()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.header = dict(n_rows=n_rows, sampling_rate=sampling_rate, dtype=self.dtype.str, layout='sample-major',
+                           chunk_samples=len(self.chunk), created=time.time(), complete=False,
+                           metadata=metadata or {})
+        write_spool_header(path, self.header)
+        self.file = open(path, 'wb')
+        self.event_index = event_index
+        if event_index is not None:
+            event_index.persist(path + '.events.tsv')
+
+    def append(self, chunk, first_sample=None):
+        # Adds the (n_rows, n_samples) board data
+        with self._lock:
+            position = 0
+            n_new = chunk.shape[1]
+            while position < n_new:
+                n_copy = min(len(self.chunk) - self.n_buffered, n_new - position)
+                self.chunk[self.n_buffered:self.n_buffered + n_copy] = chunk[:, position:position + n_copy].T
+                self.n_buffered += n_copy
+                position += n_copy
+                if self.n_buffered == len(self.chunk):
+                    self._write()
+
+    def _write(self, force_fsync=False):
+        self.file.write(self.chunk[:self.n_buffered].tobytes())
+        self.file.flush()
+        self.n_samples += self.n_buffered
+        self.n_buffered = 0
+        now = time.monotonic()
+        if force_fsync or self.fsync == 'chunk' or (self.fsync == 'interval' and now - self.last_fsync >= self.fsync_interval):
+            os.fsync(self.file.fileno())
+            self.last_fsync = now
+
+    def close(self):
+        # Writes the last partial chunk and marks the spool as complete
+        with self._lock:
+            if self.file.closed:
+                return
+            self._write(force_fsync=True)
+            self.file.close()
+            if self.event_index is not None:
+                self.event_index.close()
+            self.header.update(complete=True, n_samples=self.n_samples)
+            write_spool_header(self.path, self.header)
+
+    @property
+    def data(self):
+        # (n_rows, n_samples) memory-mapped view of the samples written to the file
+        return read_spool(self.path)[1]
+
+def write_spool_header(path, header):
+    # The header is replaced atomically, so it is never left half written
+    with open(path + '.json.tmp', 'w') as file:
+        json.dump(header, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.json.tmp', path + '.json')
+
+def read_spool(path):
+    """
+    Opens a spool, complete or not. Returns its header and the (n_rows, n_samples) memory-mapped data.
+    The samples of a partially written last row are ignored.
+    """
+    with open(path + '.json') as file:
+        header = json.load(file)
+    dtype = np.dtype(header['dtype'])
+    n_samples = os.path.getsize(path) // (header['n_rows'] * dtype.itemsize)
+    if n_samples == 0:
+        return header, np.zeros((header['n_rows'], 0), dtype=dtype)
+    data = np.memmap(path, dtype=dtype, mode='r', shape=(n_samples, header['n_rows']))
+    return header, data.T
+
+def write_bids_error(spool_path, error=None):
+    # Writes the error of the BIDS conversion of a spool to <spool_path>.bids_error.txt, or removes it with error=None
+    error_path = spool_path + BIDS_ERROR_SUFFIX
+    if error is not None:
+        with open(error_path, 'w') as file:
+            file.write(error)
+    elif os.path.exists(error_path):
+        os.remove(error_path)
+
+def failed_spools(folder):
+    # Spools of folder whose BIDS conversion failed, with a <spool_path>.bids_error.txt file
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, name[:-len(BIDS_ERROR_SUFFIX)]) for name in os.listdir(folder)
+                  if name.endswith(BIDS_ERROR_SUFFIX))
+
+def create_run_spool(board, exg_channels, markers_dict, mne_info, info, save_data_path, session_type, **kwargs):
+    """
+    Creates the spool of a run, with the arguments of save_raw_bids, so the run can be saved or recovered
+    from it with save_raw_bids_from_spool. The spool is stored in the sourcedata/spool folder of the project,
+    and kwargs are passed to AcquisitionSpool. The event index of the board is persisted with the spool.
+    The spools of the folder that could not be saved in BIDS (see failed_spools) are reported.
+    """
+    from brainflow.board_shim import BoardShim
+
+    board_id = board.get_board_id()
+    file_name = (f"sub-{info['subject_ID']}_ses-{info['session_ID']}_task-{session_type}_run-{info['run_ID']}"
+                 f"_{time.strftime('%Y%m%d-%H%M%S')}.spool")
+    path = os.path.join(save_data_path, info['project_name'], 'sourcedata', 'spool', file_name)
+    for spool_path in failed_spools(os.path.dirname(path)):
+        print(f"The run of {spool_path} could not be saved in BIDS (see {spool_path + BIDS_ERROR_SUFFIX}), "
+              f"recover it with python -m src.spool {spool_path}")
+    metadata = dict(exg_channels=[int(ch) for ch in exg_channels], markers_dict=markers_dict,
+                    ch_names=list(mne_info['ch_names']), sfreq=mne_info['sfreq'], info=info,
+                    save_data_path=save_data_path, session_type=session_type, board_id=board_id)
+    return AcquisitionSpool(path, BoardShim.get_num_rows(board_id), BoardShim.get_sampling_rate(board_id), metadata,
+                            event_index=getattr(board, 'events', None), **kwargs)
+
+def finish_run(board, spool, sock, stream_health, bids_writer, board_config):
+    """
+    End of a run of the acquisition and online scripts: stops the board and closes the spool and the marker
+    socket, prints the statistics of the markers and the stream, and queues the run in the BIDS writer
+    (src.bids_writer), without waiting for it, so the next run can be started. The channels of the secondary
+    boards (secondary_boards in board_config.json) are saved aligned to the EEG samples.
+    Returns the stream statistics saved with the run.
+    """
+    # Stop the board streaming, the last samples are written to the spool
+    board.stop_stream()
+    board.release_session()
+    spool.close()
+    sock.CloseSocket()
+    latencies = list(sock.dispatch_latencies)
+    if latencies:
+        print(f"Marker insertion latency: mean {1000 * sum(latencies) / len(latencies):.3f} ms, max {1000 * max(latencies):.3f} ms")
+    # The markers dropped from the queue of the socket or lost by the protocol are saved with the stream statistics
+    marker_stats = dict(n_received=sock.n_received, n_dropped=sock.n_overflow)
+    if sock.n_overflow:
+        print(f"{sock.n_overflow} received markers were dropped because the queue was full")
+    marker_protocol = sock.protocol
+    if marker_protocol is not None:
+        marker_stats.update(n_lost=marker_protocol.n_lost, n_duplicates=marker_protocol.n_duplicates,
+                            n_reordered=marker_protocol.n_reordered)
+        if marker_protocol.n_lost or marker_protocol.n_duplicates:
+            print(f"Marker protocol: {marker_protocol.n_lost} markers lost, {marker_protocol.n_duplicates} duplicated")
+    stream_stats = stream_health.stats()
+    stream_stats['markers'] = marker_stats
+    if board.clock_sync.n_pairs:
+        stream_stats['clock_sync'] = board.clock_sync.stats()
+        print(f"Clock sync: drift {stream_stats['clock_sync']['drift_ppm']:.1f} ppm, markers back-dated by "
+              f"{1000 * stream_stats['clock_sync']['mean_backdating']:.1f} ms on average")
+    print(f"Stream: {stream_stats['n_lost_samples']} samples lost in {stream_stats['n_gaps']} gaps, "
+          f"effective sampling rate {stream_stats['effective_sampling_rate']} Hz")
+
+    extra_channels = board.get_aligned_channels(spool.data) if board_config.get('secondary_boards') else None
+    # The writer prints when the run is saved
+    bids_writer.submit(spool.path, extra_channels=extra_channels, stream_stats=stream_stats)
+    bids_writer.close(wait=False)
+    return stream_stats
+
+if __name__ == '__main__':
+    # Recovery: python -m src.spool <spool file> [--save_data_path <path>]
+    from src.bids_files import save_raw_bids_from_spool
+
+    parser = argparse.ArgumentParser(description='Saves a run in BIDS format from its acquisition spool, complete or partial.')
+    parser.add_argument('spool_path', help='path of the .spool file')
+    parser.add_argument('--save_data_path', default=None, help='BIDS folder, the one of the acquisition by default')
+    args = parser.parse_args()
+
+    header, data = read_spool(args.spool_path)
+    print(f"{data.shape[1]} samples ({data.shape[1] / header['sampling_rate']:.1f} s), "
+          f"{'complete' if header['complete'] else 'partial'} spool")
+    save_raw_bids_from_spool(args.spool_path, args.save_data_path)
+    write_bids_error(args.spool_path)
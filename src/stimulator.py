@@ -0,0 +1,169 @@
+import argparse
+import json
+import socket
+import threading
+import time
+import numpy as np
+
+from src.markers import MarkerProtocol, MAGIC, decode_decision
+
+# Seconds from each marker of a trial to the next one
+DEFAULT_DURATIONS = {'start_trial': 1, 'indicator': 2, 'attention_cue': 1, 'go_cue': 4, 'start_feedback': 1,
+                     'end_feedback': 0.5, 'end_trial': 1}
+
+class HeadlessStimulator():
+    """
+    Python stand-in for the Unity stimulation protocols, to run the acquisition and online scripts without them.
+
+    It sends the markers of markers_dict (stim_protocol_config*.json) to the scripts as the Unity applications do:
+    start_game, then for each trial start_trial, indicator_<class> and attention_cue (when the protocol has them),
+    go_cue_<class>, start_feedback_<class>, end_feedback_<class> and end_trial, and end_game. The classes are the
+    names of the go_cue_<class> markers, each of them is cued n_trials times in random order.
+    The markers are sent with the binary marker protocol (src.markers), or as "marker_code-time stamp" strings.
+    durations overrides the seconds from each marker to the next (DEFAULT_DURATIONS). With wait_for_decision, the
+    go cue lasts until the decision of the trial is received (at most the go_cue duration).
+
+    The messages of the scripts are recorded in decisions, with the latency from the go cue of the trial (from the
+    echoed clock of the go cue for the binary decisions). summary reports the cue-to-decision latency and the
+    trials per minute. The stimulator runs in a thread, started with start and stopped with kill, as the
+    subprocess of the Unity application.
+    """
+    def __init__(self, markers_dict, n_trials=10, binary=True, durations=None, wait_for_decision=False, seed=None,
+                 udpIP="127.0.0.1", portTX=8001, portRX=8000):
+        self.markers_dict = markers_dict
+        self.classes = [name[len('go_cue_'):] for name in markers_dict if name.startswith('go_cue_')]
+        self.trials = np.random.default_rng(seed).permutation(np.repeat(self.classes, n_trials)).tolist()
+        self.binary = binary
+        self.durations = dict(DEFAULT_DURATIONS, **(durations or {}))
+        self.wait_for_decision = wait_for_decision
+        self.protocol = MarkerProtocol()
+        self.address = (udpIP, portTX)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((udpIP, portRX))
+        self.decisions = []   # dicts with the trial, its class, the message and its latency from the go cue
+        self.n_feedback = 0   # continuous feedback messages ("MI:<probability>")
+        self.sent = []   # (marker code, time.monotonic_ns() when it was sent)
+        self.trial = 0
+        self.go_cue_clock = None
+        self.start_time = None
+        self.end_time = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def kill(self):
+        # Stops the protocol (it sends end_game if it was not sent yet) and closes the socket
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.sock.close()
+
+    def poll(self):
+        # None while the protocol is running, as Popen.poll
+        return None if self._thread is not None and self._thread.is_alive() else 0
+
+    def send_marker(self, name):
+        code = self.markers_dict[name]
+        clock = time.monotonic_ns()
+        if self.binary:
+            datagram, = self.protocol.encode_events([(code, clock)])
+        else:
+            datagram = f"{code}-{time.time()}".encode('utf-8')
+        self.sock.sendto(datagram, self.address)
+        self.sent.append((code, clock))
+        return clock
+
+    def wait(self, duration, until_decision=False):
+        # Receives the messages of the scripts for duration seconds, or until the decision of the trial
+        deadline = time.perf_counter() + duration
+        while not self._stop_event.is_set():
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return
+            self.sock.settimeout(min(remaining, 0.1))   # short enough to notice kill
+            try:
+                data = self.sock.recv(1024)
+            except socket.timeout:
+                continue
+            except OSError:   # the socket was closed
+                return
+            if self.receive(data, time.monotonic_ns()) and until_decision:
+                return
+
+    def receive(self, data, receive_time):
+        # Records a message of the scripts, returns True if it is the decision of the current trial
+        if data.startswith(b'MI:'):
+            self.n_feedback += 1
+            return False
+        if data[:2] == MAGIC:
+            trial, code, echo_clock = decode_decision(data)
+            cue_clock = echo_clock if echo_clock >= 0 else self.go_cue_clock
+            message = code
+        else:
+            trial, cue_clock, message = self.trial, self.go_cue_clock, data.decode('utf-8')
+        latency = None if cue_clock is None else (receive_time - cue_clock) / 1e9
+        self.decisions.append({'trial': trial, 'class': self.trials[trial - 1] if 0 < trial <= len(self.trials) else None,
+                               'message': message, 'latency': latency})
+        return trial == self.trial
+
+    def run(self):
+        self.start_time = time.perf_counter()
+        self.send_marker('start_game')
+        self.wait(self.durations['start_trial'])
+        for self.trial, cls in enumerate(self.trials, start=1):
+            if self._stop_event.is_set():
+                break
+            self.send_marker('start_trial')
+            self.wait(self.durations['start_trial'])
+            if f'indicator_{cls}' in self.markers_dict:
+                self.send_marker(f'indicator_{cls}')
+                self.wait(self.durations['indicator'])
+            if 'attention_cue' in self.markers_dict:
+                self.send_marker('attention_cue')
+                self.wait(self.durations['attention_cue'])
+            self.go_cue_clock = self.send_marker(f'go_cue_{cls}')
+            self.wait(self.durations['go_cue'], until_decision=self.wait_for_decision)
+            self.send_marker(f'start_feedback_{cls}')
+            self.wait(self.durations['start_feedback'])
+            self.send_marker(f'end_feedback_{cls}')
+            self.wait(self.durations['end_feedback'])
+            self.send_marker('end_trial')
+            self.wait(self.durations['end_trial'])
+        self.end_time = time.perf_counter()
+        self.send_marker('end_game')
+
+    def summary(self):
+        # Cue-to-decision latency (s) of the decisions, and trials per minute of the run
+        latencies = np.array([decision['latency'] for decision in self.decisions if decision['latency'] is not None])
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        n_decided = len({decision['trial'] for decision in self.decisions})
+        return {'n_trials': self.trial,
+                'n_decided_trials': n_decided,
+                'n_feedback': self.n_feedback,
+                'median_latency': float(np.median(latencies)) if len(latencies) else None,
+                'max_latency': float(np.max(latencies)) if len(latencies) else None,
+                'trials_per_minute': 60 * self.trial / (end_time - self.start_time) if self.start_time is not None else None}
+
+if __name__ == '__main__':
+    # Usage: python -m src.stimulator <stim_protocol_config.json> [--trials n] [--ascii] [--wait-for-decision]
+    parser = argparse.ArgumentParser(description='Runs a headless stimulation protocol against the acquisition or online scripts.')
+    parser.add_argument('config', help='stim_protocol_config*.json with the markers_dict of the protocol')
+    parser.add_argument('--trials', type=int, default=10, help='trials of each class')
+    parser.add_argument('--ascii', action='store_true', help='send "marker_code-time stamp" strings instead of binary markers')
+    parser.add_argument('--wait-for-decision', action='store_true', help='end the go cue when the decision is received')
+    parser.add_argument('--go-cue', type=float, default=DEFAULT_DURATIONS['go_cue'], help='duration of the go cue (s)')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.config) as file:
+        markers_dict = json.load(file)['markers_dict']
+    stimulator = HeadlessStimulator(markers_dict, args.trials, binary=not args.ascii, durations={'go_cue': args.go_cue},
+                                    wait_for_decision=args.wait_for_decision, seed=args.seed)
+    stimulator.run()
+    stimulator.kill()
+    print(json.dumps(stimulator.summary(), indent=4))
@@ -1,134 +1,229 @@
-import numpy as np
-import os
-import json
-import mne
-import time
-import pickle
-from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
-from mne.decoding import CSP
-
-import pandas as pd
-
-import subprocess
-
-from src.UdpComms import UdpComms
-from src.boards import setup_and_prepare_board
-from src.processing import predict_one_trial_MI
-from src.bids_files import save_raw_bids
-
-# Import the parent directory and the src to system
-actual_path = os.path.dirname(os.path.realpath(__file__))
-parent_path = os.path.abspath(os.path.join(actual_path, os.pardir))
-os.sys.path.append(parent_path)
-os.sys.path.append(os.path.join(parent_path, 'src'))
-
-# Import the path to save the data
-from global_config import PATH_TO_SAVE_DATA_EEG_MI, PATH_TO_SAVE_MODELS_EEG_MI
-
-
-########################## THIS INFORMATION MUST BE DEFINED EVERY TIME THAT YOU HAVE TO ADQUIRE DATA ##########################
-# SELECT THE SUBJECT, SESSION, RUNS AND TASK TO TRAIN THE DECODING PIPELINE
-info_eeg_online = {
-        "subject_ID": "001",
-        "session_ID": 0,
-        "run_ID": 0,
-        "task": "MI_testing_online", # Esto tampoco se tiene que modificar
-        "project_name": "MIBCIproject",
-        "gender": "femenine",
-        "dominance": "right"
-    }
-
-info_to_load_model = {
-    "training_subject_ID":  "001",
-    "training_session_ID": "0",
-    "training_task": "MI",
-    "project_name": "MIBCIproject"
-}
-
-
-# Obtain the path of the script
-script_folder = os.path.dirname(os.path.realpath(__file__))
-
-#################### LOAD CONFIG FILES ####################
-# Load the board configuration file
-with open(os.path.join(script_folder, 'configs', 'board_config.json')) as file:
-    board_config = json.load(file)  # Python dictionary
-
-# Load the stimulation protocol configuration file
-with open(os.path.join(script_folder, 'configs', 'stim_protocol_config.json')) as file:
-    stim_protocol_config = json.load(file)  # Python dictionary
-
-file_name = stim_protocol_config['file_name']
-markers_dict = stim_protocol_config['markers_dict']
-stim_protocol_file_path = os.path.join(script_folder, 'stimulation_protocol',stim_protocol_config['file_name'])
-
-load_model_path = os.path.join(PATH_TO_SAVE_MODELS_EEG_MI,info_to_load_model['project_name'], 'sub-' + info_to_load_model['training_subject_ID'], 'ses-' + info_to_load_model['training_session_ID'])
-   
-# Load the trained decoding pipeline
-with open(os.path.join(load_model_path,  'CSP_LDA.pkl.pkl'), 'rb') as file:
-    trained_pipeline = pickle.load(file)
-
-
-########################### SETUP AND START STREAMING ###########################
-# Set up the board, prepare it and start streaming
-board, mne_info, exg_channels = setup_and_prepare_board(board_config)
-board.start_stream()
-
-# Create UDP socket to use for receiving data from Unity application (necessary if a Unity application is used as stimulation protocol)
-sock = UdpComms(udpIP="127.0.0.1", portTX=8000, portRX=8001, enableRX=True, suppressWarnings=False)
-time.sleep(1.5)
-
-# Execute the stimulation protocol file (in this case, a Unity application but it could be any other)
-protocol = subprocess.Popen(stim_protocol_file_path)
-
-markers_time_list = []
-markers_code_list = []
-trials_arrays_list = []
-y_true_list = []
-y_pred_list = []
-trials_counter = 0
-
-while True:   # Until the end_game marker is received
-    # Check if new data has been received from the Unity application
-    received_data = sock.ReceiveData()
-    if received_data: # if NEW data has been received since last ReadReceivedData function call
-        # Received data is a string with the format "marker_code-time stamp"
-        markers_time_list.append(received_data)
-        marker_code = int(received_data.split('-')[0])
-        markers_code_list.append(marker_code)
-        if marker_code != markers_dict['end_game']:
-            # Insert marker in the board
-            board.insert_marker(int(marker_code))
-            if marker_code == markers_dict['start_trial']:
-                trials_counter += 1
-                print ("Trial number: " + str(trials_counter))   # Just to see the progress of the calibration in the console
-            elif marker_code in [markers_dict['go_cue_MI'], markers_dict['go_cue_rest']]:
-                trial_array, y_pred = predict_one_trial(board, exg_channels, mne_info, trained_pipeline)
-                if marker_code == markers_dict['go_cue_rest']:
-                    y_true = 0
-                elif marker_code == markers_dict['go_cue_MI']:
-                    y_true = 1
-                
-                if y_true == y_pred:
-                    # This line is to send a marker to the Unity application
-                    # Acá tenemos que eliminarla y reemplazarla por el código que controla el robotito
-                    sock.SendData("5")
-                    
-                trials_arrays_list.append(trial_array)
-                y_true_list.append(y_true)
-                y_pred_list.append(y_pred)
-        else:
-            break
-
-
-time.sleep(3)
-protocol.kill()
-
-# Get the full data from the board
-data = board.get_board_data()
-# Stop the board streaming
-board.stop_stream()
-board.release_session()
-
-# Save the markers and the data following BIDS format
-save_raw_bids(data, exg_channels, markers_dict, mne_info, info_eeg_online, PATH_TO_SAVE_DATA_EEG_MI, session_type='MI_testing_online')
\ No newline at end of file
+import numpy as np
+import os
+import json
+import time
+import pickle
+# sklearn and mne are only imported when a pickled CSP+LDA pipeline is loaded
+
+import subprocess
+
+from src.UdpComms import UdpComms
+from src.markers import MarkerProtocol, marker_inserter
+from src.boards import setup_and_prepare_board, ReplayMarkerSource, StreamHealthMonitor
+from src.processing import predict_one_trial_MI, MITrialPreprocessor, ContinuousMIDecoder, StreamingCovariance, predict_one_trial_MI_riemannian
+from src.decoders import FusedCSPLDA, TangentSpaceLDA
+from src.bids_writer import BidsWriter
+from src.spool import create_run_spool, finish_run
+from src.stimulator import HeadlessStimulator
+
+# Import the parent directory and the src to system
+actual_path = os.path.dirname(os.path.realpath(__file__))
+parent_path = os.path.abspath(os.path.join(actual_path, os.pardir))
+os.sys.path.append(parent_path)
+os.sys.path.append(os.path.join(parent_path, 'src'))
+
+# Import the path to save the data
+from global_config import PATH_TO_SAVE_DATA_EEG_MI, PATH_TO_SAVE_MODELS_EEG_MI
+
+
+########################## THIS INFORMATION MUST BE DEFINED EVERY TIME THAT YOU HAVE TO ADQUIRE DATA ##########################
+# SELECT THE SUBJECT, SESSION, RUNS AND TASK TO TRAIN THE DECODING PIPELINE
+info_eeg_online = {
+        "subject_ID": "001",
+        "session_ID": 0,
+        "run_ID": 0,
+        "task": "MI_testing_online", # Esto tampoco se tiene que modificar
+        "project_name": "MIBCIproject",
+        "gender": "femenine",
+        "dominance": "right"
+    }
+
+info_to_load_model = {
+    "training_subject_ID":  "001",
+    "training_session_ID": "0",
+    "training_task": "MI",
+    "project_name": "MIBCIproject",
+    "model_version": None   # None loads the calibration model, n loads CSP_LDA_v<n>.npz saved by an adaptive run
+}
+
+# Decoding mode: "trial" classifies one window 2.5 s after the go cue, "continuous" classifies the last
+# continuous_window seconds every continuous_hop seconds from the go cue to the end of the trial, and sends
+# the smoothed MI probability to the stimulation protocol
+decoding_mode = "trial"
+# Decoder: "csp_lda" (CSP_LDA model) or "riemannian" (TS_LDA model, fed by the incremental covariance of the stream)
+decoder_type = "csp_lda"
+# Adaptive mode: the CSP+LDA decoder is updated after each labelled trial, and saved as a new version at the end of the run
+adaptive = False
+adaptation_rate = 0.05
+continuous_window = 2   # s
+continuous_hop = 0.0625   # s
+# Run a Python stand-in of the stimulation protocol instead of the Unity application (e.g. on Linux, or to benchmark
+# the cue-to-decision latency), with headless_trials trials of each class
+headless_stimulator = False
+headless_trials = 10
+
+
+# Obtain the path of the script
+script_folder = os.path.dirname(os.path.realpath(__file__))
+
+#################### LOAD CONFIG FILES ####################
+# Load the board configuration file
+with open(os.path.join(script_folder, 'configs', 'board_config.json')) as file:
+    board_config = json.load(file)  # Python dictionary
+
+# Load the stimulation protocol configuration file
+with open(os.path.join(script_folder, 'configs', 'stim_protocol_config.json')) as file:
+    stim_protocol_config = json.load(file)  # Python dictionary
+
+file_name = stim_protocol_config['file_name']
+markers_dict = stim_protocol_config['markers_dict']
+stim_protocol_file_path = os.path.join(script_folder, 'stimulation_protocol',stim_protocol_config['file_name'])
+
+load_model_path = os.path.join(PATH_TO_SAVE_MODELS_EEG_MI,info_to_load_model['project_name'], 'sub-' + info_to_load_model['training_subject_ID'], 'ses-' + info_to_load_model['training_session_ID'])
+   
+# Load the trained decoding pipeline, as a fused CSP+LDA decoder
+if decoder_type == "riemannian":
+    trained_pipeline = TangentSpaceLDA.load(os.path.join(load_model_path, 'TS_LDA.npz'))
+elif info_to_load_model['model_version'] is not None:
+    trained_pipeline = FusedCSPLDA.load(os.path.join(load_model_path, f"CSP_LDA_v{info_to_load_model['model_version']}.npz"))
+elif os.path.exists(os.path.join(load_model_path, 'CSP_LDA.npz')):
+    trained_pipeline = FusedCSPLDA.load(os.path.join(load_model_path, 'CSP_LDA.npz'))
+else:
+    with open(os.path.join(load_model_path,  'CSP_LDA.pkl'), 'rb') as file:
+        trained_pipeline = FusedCSPLDA.from_pipeline(pickle.load(file))
+
+
+########################### SETUP AND START STREAMING ###########################
+# Set up the board, prepare it and start streaming. The ring buffer consumer drains the board in the
+# background, so the trials are taken at the exact sample of their go cue
+board, mne_info, exg_channels = setup_and_prepare_board(board_config, ring_buffer=True)
+# The run is spooled to disk as it is acquired, instead of being kept in memory until the end.
+# If the script crashes, the run can be recovered with: python -m src.spool <spool file>
+spool = create_run_spool(board, exg_channels, markers_dict, mne_info, info_eeg_online, PATH_TO_SAVE_DATA_EEG_MI, session_type='MI_testing_online')
+board.add_chunk_callback(spool.append)
+# Background process that saves the run in BIDS format at the end (it loads mne_bids during the run)
+bids_writer = BidsWriter()
+# Package counter gaps, effective sampling rate and read latency of the stream
+stream_health = StreamHealthMonitor(board_config['board_ID'])
+board.add_chunk_callback(stream_health.update)
+board.start_stream()
+
+# Design the trial preprocessing (channel selection, 8-30 Hz filter and crop) once for the whole session
+preprocessor = MITrialPreprocessor(mne_info)
+streaming_covariance = None
+if decoder_type == "riemannian":
+    # Covariance of the last 2 s, with the filter and the ridge of the training
+    streaming_covariance = StreamingCovariance(board, exg_channels, mne_info, 2,
+                                               trained_pipeline.l_freq, trained_pipeline.h_freq,
+                                               ridge=trained_pipeline.ridge)
+
+# When a recorded run is replayed (replay_file in board_config.json), its events take the place of the
+# stimulation protocol
+replay = bool(board_config.get('replay_file'))
+# The markers are received as MarkerEvents, from the binary marker protocol or the ASCII strings. The decisions are
+# sent as binary records with the trial ID when binary_protocol is set in stim_protocol_config.json
+marker_protocol = MarkerProtocol(binary_decisions=stim_protocol_config.get('binary_protocol', False))
+if replay:
+    sock = ReplayMarkerSource(board, markers_dict['end_game'], marker_protocol)
+else:
+    # Create UDP socket to use for receiving data from Unity application (necessary if a Unity application is used as stimulation protocol)
+    sock = UdpComms(udpIP="127.0.0.1", portTX=8000, portRX=8001, enableRX=True, suppressWarnings=False, protocol=marker_protocol)
+    time.sleep(1.5)
+
+# The markers are inserted in the board by the receiving thread of the socket, as soon as they are received
+sock.AddCallback(marker_inserter(board, markers_dict['end_game']))
+
+if decoding_mode == "continuous":
+    continuous_decoder = ContinuousMIDecoder(board, exg_channels, mne_info, trained_pipeline, sock,
+                                             window_length=continuous_window, hop=continuous_hop,
+                                             streaming_covariance=streaming_covariance)
+
+# Execute the stimulation protocol file (in this case, a Unity application but it could be any other)
+if not replay:
+    if headless_stimulator:
+        protocol = HeadlessStimulator(markers_dict, headless_trials)
+        protocol.start()
+    else:
+        protocol = subprocess.Popen(stim_protocol_file_path)
+
+markers_time_list = []
+markers_code_list = []
+trials_arrays_list = []
+y_true_list = []
+y_pred_list = []
+trials_counter = 0
+
+while True:   # Until the end_game marker is received
+    # Check if new data has been received from the Unity application
+    event = sock.ReceiveData()
+    if event is not None: # if NEW data has been received since last ReadReceivedData function call
+        # Received data is a MarkerEvent (code, sequence number, sender clock, flags)
+        markers_time_list.append(event)
+        marker_code = event.code
+        markers_code_list.append(marker_code)
+        if marker_code != markers_dict['end_game']:
+            # The marker has already been inserted in the board by insert_received_marker
+            if marker_code == markers_dict['start_trial']:
+                trials_counter += 1
+                print ("Trial number: " + str(trials_counter))   # Just to see the progress of the calibration in the console
+            elif marker_code in [markers_dict['go_cue_MI'], markers_dict['go_cue_rest']]:
+                if marker_code == markers_dict['go_cue_rest']:
+                    y_true = 0
+                elif marker_code == markers_dict['go_cue_MI']:
+                    y_true = 1
+
+                if decoding_mode == "continuous":
+                    # The windows are decoded in the background until the end of the trial
+                    continuous_decoder.start()
+                    continue
+
+                if decoder_type == "riemannian":
+                    trial_array, y_pred = predict_one_trial_MI_riemannian(streaming_covariance, trained_pipeline, marker_code)
+                else:
+                    trial_array, y_pred = predict_one_trial_MI(board, exg_channels, mne_info, trained_pipeline, preprocessor, marker_code)
+                
+                if y_true == y_pred:
+                    # This line is to send a marker to the Unity application
+                    # Acá tenemos que eliminarla y reemplazarla por el código que controla el robotito
+                    sock.SendBytes(marker_protocol.encode_decision(trials_counter, 5, event.sender_clock))
+                    
+                trials_arrays_list.append(trial_array)
+                y_true_list.append(y_true)
+                y_pred_list.append(y_pred)
+
+                if adaptive and decoder_type == "csp_lda":
+                    trained_pipeline.adapt(trial_array[0], y_true, adaptation_rate)
+            elif marker_code == markers_dict['end_trial'] and decoding_mode == "continuous" and continuous_decoder.running:
+                # The trial is classified with the last smoothed probabilities
+                proba = continuous_decoder.stop()
+                y_pred = None if proba is None else trained_pipeline.classes[np.argmax(proba)]
+                y_true_list.append(y_true)
+                y_pred_list.append(y_pred)
+        else:
+            break
+
+
+if decoding_mode == "continuous":
+    continuous_decoder.stop()
+    if continuous_decoder.n_windows:
+        print(f"Continuous decoding: {continuous_decoder.n_windows} windows, mean cost "
+              f"{1000 * continuous_decoder.total_cost / continuous_decoder.n_windows:.2f} ms, "
+              f"max cost {1000 * continuous_decoder.max_cost:.2f} ms")
+
+# Save the adapted decoder as the next version of the model
+if adaptive and decoder_type == "csp_lda" and y_true_list:
+    version = 1
+    while os.path.exists(os.path.join(load_model_path, f'CSP_LDA_v{version}.npz')):
+        version += 1
+    trained_pipeline.save(os.path.join(load_model_path, f'CSP_LDA_v{version}.npz'))
+    print(f"Adapted model saved as CSP_LDA_v{version}.npz")
+
+if not replay:
+    time.sleep(3)
+    protocol.kill()
+if headless_stimulator:
+    print(f"Headless stimulator: {protocol.summary()}")
+
+# Stop the board, print the statistics of the run and save it in BIDS format in the background process of the
+# BIDS writer. The script does not wait for it: the writer prints when the run is saved, and the next run can be started
+finish_run(board, spool, sock, stream_health, bids_writer, board_config)
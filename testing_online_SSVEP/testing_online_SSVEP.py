@@ -1,12 +1,9 @@
 import numpy as np
 import os
 import json
-import mne
 import time
 import pickle
 
-import pandas as pd
-
 import subprocess
 
 # IMport the parent directory and the src to system
@@ -16,9 +13,12 @@ os.sys.path.append(parent_path)
 os.sys.path.append(os.path.join(parent_path, 'src'))
 
 from src.UdpComms import UdpComms
-from src.boards import setup_and_prepare_board
-from src.processing import predict_one_trial_SSVEP
-from src.bids_files import save_raw_bids
+from src.markers import MarkerProtocol, marker_inserter
+from src.boards import setup_and_prepare_board, ReplayMarkerSource, StreamHealthMonitor
+from src.processing import predict_one_trial_SSVEP, predict_one_trial_SSVEP_dynamic, reference_cache, SSVEP_FREQUENCIES, TRCADecoder
+from src.bids_writer import BidsWriter
+from src.spool import create_run_spool, finish_run
+from src.stimulator import HeadlessStimulator
 
 # Import the path to save the data
 from global_config import PATH_TO_SAVE_DATA_EEG_MI, PATH_TO_SAVE_MODELS_EEG_MI
@@ -35,6 +35,17 @@ logging.getLogger('mne').setLevel(logging.CRITICAL)
 ########################## THIS INFORMATION MUST BE DEFINED EVERY TIME THAT YOU HAVE TO ADQUIRE DATA ##########################
 board_name = "cyton"
 stim_protocol_name = "stim_protocol_config_v2"
+window_length = 3   # seconds of data used to decode each SSVEP trial
+ssvep_method = "cca"   # "cca", "fbcca" (filter-bank CCA, allows shorter windows) or "trca" (trained with decoding_pipeline_TRCA.py)
+# Dynamic window: decide as soon as the decoder is confident enough, between min_window and window_length seconds
+dynamic_window = False
+min_window = 1   # seconds
+window_step = 0.25   # seconds between two re-scorings of the growing window
+confidence_threshold = 0.2   # relative margin between the best and the second best target
+# Run a Python stand-in of the stimulation protocol instead of the Unity application (e.g. on Linux, or to benchmark
+# the cue-to-decision latency), with headless_trials trials of each class
+headless_stimulator = False
+headless_trials = 10
 # SELECT THE SUBJECT, SESSION, RUNS AND TASK TO TRAIN THE DECODING PIPELINE
 info_eeg_online = {
         "subject_ID": "001",
@@ -90,42 +101,81 @@ stim_protocol_file_path = os.path.join(script_folder, 'stimulation_protocol', st
 
 load_model_path = os.path.join(PATH_TO_SAVE_MODELS_EEG_MI,info_to_load_model['project_name'], 'sub-' + info_to_load_model['training_subject_ID'], 'ses-' + info_to_load_model['training_session_ID'])
 
+# Load the subject-specific TRCA spatial filters and templates
+trca_model = None
+if ssvep_method == "trca":
+    trca_model = TRCADecoder.load(os.path.join(load_model_path, 'TRCA.npz'))
+
 ########################### SETUP AND START STREAMING ###########################
-# Set up the board, prepare it and start streaming
-board, mne_info, exg_channels = setup_and_prepare_board(board_config)
+# Set up the board, prepare it and start streaming. The ring buffer consumer drains the board in the
+# background, so the trials are taken at the exact sample of their go cue
+board, mne_info, exg_channels = setup_and_prepare_board(board_config, ring_buffer=True)
+# The run is spooled to disk as it is acquired, instead of being kept in memory until the end.
+# If the script crashes, the run can be recovered with: python -m src.spool <spool file>
+spool = create_run_spool(board, exg_channels, markers_dict, mne_info, info_eeg_online, PATH_TO_SAVE_DATA_EEG_MI, session_type='SSVEP_testing_online')
+board.add_chunk_callback(spool.append)
+# Background process that saves the run in BIDS format at the end (it loads mne_bids during the run)
+bids_writer = BidsWriter()
+# Package counter gaps, effective sampling rate and read latency of the stream
+stream_health = StreamHealthMonitor(board_config['board_ID'])
+board.add_chunk_callback(stream_health.update)
 board.start_stream()
 
-# Create UDP socket to use for receiving data from Unity application (necessary if a Unity application is used as stimulation protocol)
-sock = UdpComms(udpIP="127.0.0.1", portTX=8000, portRX=8001, enableRX=True, suppressWarnings=False)
-time.sleep(1.5)
+# Build the SSVEP reference templates once, before the first trial
+if dynamic_window:
+    window_lengths = np.append(np.arange(min_window, window_length, window_step), window_length)
+else:
+    window_lengths = [window_length]
+reference_cache.warm_up(SSVEP_FREQUENCIES, mne_info['sfreq'], window_lengths)
+
+# When a recorded run is replayed (replay_file in board_config.json), its events take the place of the
+# stimulation protocol
+replay = bool(board_config.get('replay_file'))
+# The markers are received as MarkerEvents, from the binary marker protocol or the ASCII strings. The decisions are
+# sent as binary records with the trial ID when binary_protocol is set in stim_protocol_config.json
+marker_protocol = MarkerProtocol(binary_decisions=stim_protocol_config.get('binary_protocol', False), decision_strings=commands_dict)
+if replay:
+    sock = ReplayMarkerSource(board, markers_dict['end_game'], marker_protocol)
+else:
+    # Create UDP socket to use for receiving data from Unity application (necessary if a Unity application is used as stimulation protocol)
+    sock = UdpComms(udpIP="127.0.0.1", portTX=8000, portRX=8001, enableRX=True, suppressWarnings=False, protocol=marker_protocol)
+    time.sleep(1.5)
+
+# The markers are inserted in the board by the receiving thread of the socket, as soon as they are received
+sock.AddCallback(marker_inserter(board, markers_dict['end_game']))
 
 # Execute the stimulation protocol file (in this case, a Unity application but it could be any other)
-protocol = subprocess.Popen(stim_protocol_file_path)
+if not replay:
+    if headless_stimulator:
+        protocol = HeadlessStimulator(markers_dict, headless_trials)
+        protocol.start()
+    else:
+        protocol = subprocess.Popen(stim_protocol_file_path)
 
 markers_time_list = []
 markers_code_list = []
 trials_arrays_list = []
 y_true_list = []
 y_pred_list = []
+decision_times_list = []
 trials_counter = 0
 
 while True:   # Until the end_game marker is received
     # Check if new data has been received from the Unity application
-    received_data = sock.ReceiveData()
+    event = sock.ReceiveData()
     
-    if received_data: # if NEW data has been received since last ReadReceivedData function call
-        # Received data is a string with the format "marker_code-time stamp"
-        markers_time_list.append(received_data)
+    if event is not None: # if NEW data has been received since last ReadReceivedData function call
+        # Received data is a MarkerEvent (code, sequence number, sender clock, flags)
+        markers_time_list.append(event)
 
-        print(f"received_data: {received_data}")
-        marker_code = int(received_data.split('-')[0])
+        print(f"received_data: {event}")
+        marker_code = event.code
 
         print(f"marker_code: {marker_code}")
         markers_code_list.append(marker_code)
         
         if marker_code != markers_dict['end_game']:
-            # Insert marker in the board
-            board.insert_marker(int(marker_code))
+            # The marker has already been inserted in the board by insert_received_marker
             if marker_code == markers_dict['start_trial']:
 
                 trials_counter += 1
@@ -134,7 +184,15 @@ while True:   # Until the end_game marker is received
             elif marker_code in [markers_dict['go_cue_up'], markers_dict['go_cue_down'],markers_dict['go_cue_left'],markers_dict['go_cue_right'] ]:
                 
                 # Here we have to put the decoding pipeline for SSVEP
-                trial_array, y_pred = predict_one_trial_SSVEP(board, exg_channels, mne_info)
+                if dynamic_window:
+                    trial_array, y_pred, decision_time = predict_one_trial_SSVEP_dynamic(board, exg_channels, mne_info, min_window, window_length,
+                                                                                         window_step, threshold=confidence_threshold, method=ssvep_method,
+                                                                                         trca_model=trca_model, marker_code=marker_code)
+                    print(f"decision_time: {decision_time:.2f} s")
+                    decision_times_list.append(decision_time)
+                else:
+                    trial_array, y_pred = predict_one_trial_SSVEP(board, exg_channels, mne_info, window_length, method=ssvep_method, trca_model=trca_model,
+                                                           marker_code=marker_code)
 
                 # left: 8.5 Hz / 0 , right: 10 Hz / 1 , up: 12Hz / 2 ,  down: 15Hz / 3 
                 if marker_code == markers_dict['go_cue_up']:
@@ -155,7 +213,7 @@ while True:   # Until the end_game marker is received
                 print(f"y_pred:{y_pred}")
 
                 # Move the robot
-                sock.SendData(commands_dict[y_pred])
+                sock.SendBytes(marker_protocol.encode_decision(trials_counter, y_pred, event.sender_clock))
                 print(f"Data enviada: {commands_dict[y_pred]}")
 
                 trials_arrays_list.append(trial_array)
@@ -164,14 +222,12 @@ while True:   # Until the end_game marker is received
         else:
             break
 
-time.sleep(3)
-protocol.kill()
-
-# Get the full data from the board
-data = board.get_board_data()
-# Stop the board streaming
-board.stop_stream()
-board.release_session()
+if not replay:
+    time.sleep(3)
+    protocol.kill()
+if headless_stimulator:
+    print(f"Headless stimulator: {protocol.summary()}")
 
-# Save the markers and the data following BIDS format
-save_raw_bids(data, exg_channels, markers_dict, mne_info, info_eeg_online, PATH_TO_SAVE_DATA_EEG_MI, session_type='SSVEP_testing_online')
\ No newline at end of file
+# Stop the board, print the statistics of the run and save it in BIDS format in the background process of the
+# BIDS writer. The script does not wait for it: the writer prints when the run is saved, and the next run can be started
+finish_run(board, spool, sock, stream_health, bids_writer, board_config)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import the modules of src as the scripts do, from the repository folder
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from src.bids_files import dataset_lock
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+def test_dataset_lock_is_released_when_its_process_is_killed(tmp_path):
+    # Another writer takes the lock and is killed while it holds it
+    code = (f"import time; from src.bids_files import dataset_lock\n"
+            f"with dataset_lock({str(tmp_path)!r}):\n"
+            f"    print('locked', flush=True); time.sleep(60)")
+    writer = subprocess.Popen([sys.executable, '-c', code], cwd=REPOSITORY, stdout=subprocess.PIPE, text=True)
+    try:
+        assert writer.stdout.readline().strip() == 'locked'
+        with pytest.raises(TimeoutError):
+            with dataset_lock(tmp_path, timeout=0.2):
+                pass
+    finally:
+        writer.kill()
+        writer.wait()
+    with dataset_lock(tmp_path, timeout=1):
+        with open(tmp_path / '.bids_lock') as file:
+            assert file.read() == str(os.getpid())
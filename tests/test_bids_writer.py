@@ -0,0 +1,17 @@
+import numpy as np
+
+from src.bids_writer import BidsWriter
+from src.spool import AcquisitionSpool, failed_spools
+
+def test_failed_run_is_recorded_next_to_its_spool(tmp_path):
+    # Spool without the metadata of the run, it can not be saved
+    spool = AcquisitionSpool(str(tmp_path / 'run.spool'), 4, 250)
+    spool.append(np.zeros((4, 500)))
+    spool.close()
+    writer = BidsWriter()
+    writer.submit(spool.path)
+    writer.close(wait=False)   # as the scripts, the error is not received by the parent
+    writer.process.wait()
+    assert failed_spools(str(tmp_path)) == [spool.path]
+    with open(spool.path + '.bids_error.txt') as file:
+        assert 'KeyError' in file.read()
@@ -0,0 +1,102 @@
+import threading
+import time
+import numpy as np
+from brainflow.board_shim import BoardIds, BoardShim
+
+from src.boards import BoardRingBuffer, MultiBoardSession, ReplayBoard, ReplayMarkerSource
+from src.event_index import EventIndex
+
+def test_markers_are_paired_by_receive_time():
+    principal, secondary = EventIndex(), EventIndex()
+    for sample, code, receive_time in [(100, 1, 10), (200, 2, 20), (300, 1, 30), (400, 2, 40)]:
+        principal.append(sample, code, receive_time)
+    # The secondary board dropped the second marker and recorded the third one twice
+    for sample, code, receive_time in [(50, 1, 10), (150, 1, 30), (151, 1, 30), (200, 2, 40)]:
+        secondary.append(sample, code, receive_time)
+    assert MultiBoardSession._pair_markers(principal, secondary) == [(100, 50), (300, 150), (400, 200)]
+
+def test_markers_without_receive_time_are_paired_by_code_order():
+    principal, secondary = EventIndex(), EventIndex()
+    for sample, code in [(100, 1), (200, 2), (300, 1)]:
+        principal.append(sample, code)
+    for sample, code in [(60, 2), (110, 1), (310, 1)]:
+        secondary.append(sample, code)
+    assert MultiBoardSession._pair_markers(principal, secondary) == [(100, 110), (200, 60), (300, 310)]
+
+def replay_board(n_samples, events):
+    # ReplayBoard of the synthetic board (250 Hz) with the data and events set, instead of read from a run
+    board = ReplayBoard('run_eeg.vhdr', BoardIds.SYNTHETIC_BOARD.value, [])
+    board.data = np.zeros((BoardShim.get_num_rows(board.board_id), n_samples))
+    board.events = events
+    return board
+
+def test_replay_marker_source_waits_for_the_events():
+    board = replay_board(100, [(25, 3)])   # the event is reached after 0.1 s
+    source = ReplayMarkerSource(board, end_marker=99)
+    board.start_stream()
+    start = time.perf_counter()
+    assert source.ReceiveData(timeout=0.02) is None
+    assert 0.02 <= time.perf_counter() - start < 0.09
+    assert source.ReceiveData(timeout=1).startswith('3-')
+    assert 0.1 <= time.perf_counter() - start < 0.2
+    board.insert_marker(3)
+    assert source.ReceiveData(timeout=1).startswith('99-')   # end of the run, after 0.4 s
+    assert 0.4 <= time.perf_counter() - start < 0.5
+    assert source.ReceiveData(timeout=0.01) is None
+
+class FakeBoard():
+    # Board of board_id that returns the samples of true times [0, duration) chunk by chunk, as get_board_data.
+    # Its timestamps are late by delay s, the first EXG row is the true time in ms, and marker 1 is recorded every 0.5 s
+    def __init__(self, board_id, duration, delay=0):
+        sampling_rate = BoardShim.get_sampling_rate(board_id)
+        times = np.arange(int(duration * sampling_rate)) / sampling_rate
+        self.board_id = board_id
+        self.data = np.zeros((BoardShim.get_num_rows(board_id), len(times)))
+        self.data[BoardShim.get_timestamp_channel(board_id)] = times + delay
+        self.data[BoardShim.get_exg_channels(board_id)[0]] = 1000 * times
+        self.data[BoardShim.get_marker_channel(board_id), np.round(np.arange(0.5, duration, 0.5) * sampling_rate).astype(int)] = 1
+        self.n_read = 0
+        self.n_available = 0
+
+    def get_board_id(self):
+        return self.board_id
+
+    def feed(self, duration):
+        self.n_available = min(self.n_available + int(duration * BoardShim.get_sampling_rate(self.board_id)), self.data.shape[1])
+
+    def get_board_data(self):
+        data = self.data[:, self.n_read:self.n_available]
+        self.n_read = self.n_available
+        return data
+
+def test_aligned_window_of_a_secondary_board_drained_while_it_is_read():
+    # EEG at 250 Hz, and EMG at 200 Hz whose timestamps are late by 50 ms
+    principal = BoardRingBuffer(FakeBoard(BoardIds.SYNTHETIC_BOARD.value, 4), buffer_seconds=4)
+    secondary = BoardRingBuffer(FakeBoard(BoardIds.GANGLION_BOARD.value, 4, delay=0.05), buffer_seconds=4)
+    session = MultiBoardSession(principal, {'emg': (secondary, None, [1])})
+    for board in (principal, secondary):
+        board.board.feed(2)
+        board.drain()
+
+    # The consumer thread drains a chunk of the secondary board right after its data is read
+    read = secondary.get_current_board_data
+    def read_while_draining(num_samples):
+        data = read(num_samples)
+        secondary.board.feed(0.1)
+        drainer = threading.Thread(target=secondary.drain)
+        drainer.start()
+        drainer.join(0.1)
+        return data
+    secondary.get_current_board_data = read_while_draining
+    window = session.get_aligned_window(300, 450)
+    # The EMG samples are aligned at the EEG samples of the same true time
+    np.testing.assert_allclose(window['emg'][0], 1000 * np.arange(300, 450) / 250, atol=1e-6)
+
+def test_ring_buffer_memory_is_bounded_by_default():
+    board = BoardRingBuffer(FakeBoard(BoardIds.SYNTHETIC_BOARD.value, 10), buffer_seconds=1)
+    for _ in range(10):
+        board.board.feed(1)
+        board.drain()
+    assert board.history == [] and board.buffer.shape[1] == 2 * 250
+    # The last second of the run, with its absolute sample indices
+    assert board.n_samples == 2500 and board.get_board_data().shape[1] == 250
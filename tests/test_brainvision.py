@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from src.brainvision import write_brainvision
+
+CH_NAMES = ['C3', 'Cz', 'C4,ref']   # the comma is coded as "\1"
+EVENTS = np.array([[0, 1], [500, 12], [999, 250]])
+
+def read_files(folder, fname_base):
+    # The files of a recording, without the comment line with the name of the writer
+    files = {}
+    for extension in ['vhdr', 'vmrk', 'eeg']:
+        with open(folder / f'{fname_base}.{extension}', 'rb') as file:
+            files[extension] = file.read()
+        if extension != 'eeg':
+            lines = files[extension].split(b'\n')
+            assert lines[1].startswith(b'; ')
+            files[extension] = b'\n'.join(lines[:1] + lines[2:])
+    return files
+
+@pytest.mark.parametrize('fmt', ['binary_float32', 'binary_int16'])
+def test_chunked_files_match_pybv(fmt, tmp_path):
+    import pybv
+    data = np.random.default_rng(0).normal(0, 50, (3, 1000))   # uV
+    pybv.write_brainvision(data=data / 1e6, sfreq=250, ch_names=CH_NAMES, fname_base='run', folder_out=tmp_path / 'pybv',
+                           events=EVENTS, fmt=fmt, resolution=0.1)
+    # The channels of two sources, in chunks that do not divide the samples
+    write_brainvision([(data[:2], [0, 1]), (data, [2])], 250, CH_NAMES, 'run', tmp_path / 'chunks', events=EVENTS,
+                      fmt=fmt, resolution=0.1, chunk_samples=300)
+    assert read_files(tmp_path / 'chunks', 'run') == read_files(tmp_path / 'pybv', 'run')
+
+def test_invalid_events_and_formats(tmp_path):
+    data = np.zeros((2, 100))
+    with pytest.raises(ValueError, match='events'):
+        write_brainvision([(data, [0, 1])], 250, ['C3', 'C4'], 'run', tmp_path, events=[[100, 1]])
+    with pytest.raises(ValueError, match='format'):
+        write_brainvision([(data, [0, 1])], 250, ['C3', 'C4'], 'run', tmp_path, fmt='binary_int32')
+    with pytest.raises(ValueError, match='int16'):   # 5 mV in units of 0.1 uV
+        write_brainvision([(data + 5000, [0, 1])], 250, ['C3', 'C4'], 'run', tmp_path, fmt='binary_int16')
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from src.decoders import FusedCSPLDA, TangentSpaceLDA, regularize_covariance, riemannian_mean
+
+def rank_deficient_windows(n_trials=40, n_channels=8, n_sources=5, n_samples=500, seed=0):
+    # Windows of n_channels mixed from n_sources sources (in V), with one more source power for class 1
+    rng = np.random.default_rng(seed)
+    mixing = rng.normal(size=(n_channels, n_sources))
+    windows, labels = [], []
+    for trial in range(n_trials):
+        label = trial % 2
+        powers = np.ones(n_sources)
+        powers[0] = 4 if label else 1
+        sources = rng.normal(size=(n_sources, n_samples)) * np.sqrt(powers)[:, None]
+        windows.append(1e-5 * mixing @ sources)
+        labels.append(label)
+    return np.array(windows), np.array(labels)
+
+def test_tangent_space_lda_fits_rank_deficient_windows():
+    windows, labels = rank_deficient_windows()
+    covariances = windows @ np.swapaxes(windows, -1, -2) / windows.shape[-1]
+    assert np.linalg.eigvalsh(covariances)[:, 0].max() < 1e-12 * np.trace(covariances[0])   # singular
+    decoder = TangentSpaceLDA.fit(regularize_covariance(covariances), labels)
+    assert np.all(np.isfinite(decoder.reference))
+    assert np.linalg.eigvalsh(decoder.reference)[0] > 0
+    assert np.mean(decoder.predict(regularize_covariance(covariances)) == labels) > 0.9
+
+def test_riemannian_mean_of_singular_covariances_is_finite():
+    # Without regularization, the eigenvalue floor keeps the matrix logarithms and square roots finite
+    windows, _ = rank_deficient_windows(n_trials=10)
+    covariances = windows @ np.swapaxes(windows, -1, -2) / windows.shape[-1]
+    assert np.all(np.isfinite(riemannian_mean(covariances)))
+
+def test_regularize_covariance_adds_trace_scaled_ridge():
+    covariance = np.diag([4.0, 2.0, 0.0])
+    np.testing.assert_allclose(regularize_covariance(covariance, ridge=0.5), np.diag([5.0, 3.0, 1.0]))
+
+@pytest.mark.parametrize('log', [True, False])
+def test_fused_csp_lda_matches_the_mne_sklearn_pipeline(log, tmp_path):
+    from mne.decoding import CSP
+    from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+
+    windows, labels = rank_deficient_windows(n_sources=8)   # full rank
+    train, test = slice(0, 30), slice(30, None)
+    # CSP of the training script (log=False standardizes the average power instead)
+    csp = CSP(n_components=6, reg='empirical', log=log, norm_trace=True, cov_est='epoch',
+              transform_into='average_power')
+    lda = LinearDiscriminantAnalysis(store_covariance=True)
+    lda.fit(csp.fit_transform(windows[train], labels[train]), labels[train])
+    decoder = FusedCSPLDA.from_pipeline({'csp': csp, 'lda': lda})
+    features = csp.transform(windows[test])
+    np.testing.assert_allclose(decoder.transform(windows[test]), features, rtol=1e-10)
+    np.testing.assert_allclose(decoder.decision_function(windows[test]), lda.decision_function(features), rtol=1e-10)
+    np.testing.assert_allclose(decoder.predict_proba(windows[test]), lda.predict_proba(features), rtol=1e-10)
+    np.testing.assert_array_equal(decoder.predict(windows[test]), lda.predict(features))
+    np.testing.assert_array_equal(decoder.predict(windows[test][0]), lda.predict(features[:1]))   # single trial
+    decoder.save(tmp_path / 'CSP_LDA.npz')
+    np.testing.assert_array_equal(FusedCSPLDA.load(tmp_path / 'CSP_LDA.npz').decision_function(windows[test]),
+                                  decoder.decision_function(windows[test]))
@@ -0,0 +1,20 @@
+import numpy as np
+
+from src.event_index import EventIndex, read_event_index
+
+def test_events_array_uses_backdated_onsets():
+    index = EventIndex(capacity=2)
+    index.append(100, 1, 5000, onset=96)
+    index.append(103, 2, 5100, onset=95)   # back-dated before the previous marker
+    index.append(200, 1)
+    np.testing.assert_array_equal(index.events_array(), [[95, 0, 2], [96, 0, 1], [200, 0, 1]])
+    assert index.last(1) == (200, 1, -1, 200)
+
+def test_persisted_index_is_read_back(tmp_path):
+    index = EventIndex()
+    index.persist(str(tmp_path / 'run.events.tsv'))
+    index.append(10, 3, 123, onset=8)
+    index.append(20, 4)
+    index.close()
+    read = read_event_index(str(tmp_path / 'run.events.tsv'))
+    np.testing.assert_array_equal(read.data[:len(read)], index.data[:len(index)])
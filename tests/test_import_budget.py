@@ -0,0 +1,12 @@
+from src.import_budget import DEFAULT_MODULES, import_times, package_times
+
+HEAVY_PACKAGES = {'mne', 'mne_bids', 'sklearn', 'scipy', 'pandas'}
+
+def test_online_script_modules_do_not_import_heavy_packages():
+    # The modules imported by the scripts before the board is prepared load only numpy and brainflow
+    modules = DEFAULT_MODULES + ['src.markers', 'src.bids_writer', 'src.stimulator']
+    times = import_times(modules)
+    imported = {name for name, _, _, _ in times}
+    assert set(modules) <= imported
+    assert not {name.split('.')[0] for name in imported} & HEAVY_PACKAGES
+    assert 'numpy' in dict(package_times(times))
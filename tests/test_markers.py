@@ -0,0 +1,48 @@
+from src.markers import MarkerProtocol, decode_decision
+
+def send(n_events, clock=0):
+    # Datagrams of n_events events of a new sender, one event per datagram, the sender clock starts at clock
+    sender = MarkerProtocol()
+    return [sender.encode_events([(code, clock + 1000 * code)])[0] for code in range(n_events)]
+
+def received_codes(receiver, datagrams):
+    return [event.code for datagram in datagrams for event in receiver.decode(datagram)]
+
+def test_lost_and_reordered_events():
+    datagrams = send(6)
+    receiver = MarkerProtocol()
+    # Event 2 arrives late, event 4 is lost
+    assert received_codes(receiver, [datagrams[i] for i in [0, 1, 3, 2, 5]]) == [0, 1, 3, 2, 5]
+    assert (receiver.n_lost, receiver.n_reordered, receiver.n_duplicates) == (1, 1, 0)
+
+def test_duplicated_events():
+    datagrams = send(4)
+    receiver = MarkerProtocol(history=2)
+    assert received_codes(receiver, [datagrams[i] for i in [0, 1, 1, 2, 3]]) == [0, 1, 2, 3]
+    # Event 1 sent again after it left the recent events was never counted as lost
+    assert received_codes(receiver, [datagrams[1]]) == []
+    assert (receiver.n_lost, receiver.n_reordered, receiver.n_duplicates) == (0, 0, 2)
+
+def test_reset_of_the_sender():
+    first_run = send(4)
+    receiver = MarkerProtocol()
+    assert received_codes(receiver, first_run[:3]) == [0, 1, 2]
+    # The sender starts again, then an event of its first run arrives late
+    second_run = send(3, clock=10**9)
+    assert received_codes(receiver, second_run + [first_run[1]]) == [0, 1, 2]
+    assert (receiver.n_lost, receiver.n_reordered, receiver.n_duplicates) == (0, 0, 1)
+
+def test_encode_and_decode_batch():
+    sender, receiver = MarkerProtocol(), MarkerProtocol()
+    datagrams = sender.encode_events([(code, 10 * code, 0) for code in range(100)])
+    assert len(datagrams) > 1   # more events than fit in a datagram
+    events = [event for datagram in datagrams for event in receiver.decode(datagram)]
+    assert [(event.code, event.seq, event.sender_clock) for event in events] == [(code, code, 10 * code) for code in range(100)]
+    assert receiver.decode(b'7-1700000000.0')[0].code == 7   # ASCII protocol
+
+def test_encode_decision():
+    assert MarkerProtocol(decision_strings={5: 'left'}).encode_decision(3, 5) == b'left'
+    assert MarkerProtocol().encode_decision(3, 7) == b'7'
+    # Binary decision with the trial ID and the echo of the sender clock of the event
+    assert decode_decision(MarkerProtocol(binary_decisions=True).encode_decision(3, 5, 123456789)) == (3, 5, 123456789)
+    assert decode_decision(MarkerProtocol(binary_decisions=True).encode_decision(4, 5)) == (4, 5, -1)
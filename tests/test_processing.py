@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+from sklearn.cross_decomposition import CCA
+
+from src.decoders import regularize_covariance
+from src.processing import MITrialPreprocessor, StreamingCovariance, find_corr, predict_one_trial_SSVEP, predict_one_trial_SSVEP_dynamic, reference_templates
+
+def sklearn_find_corr(n_components, eeg_data, freq, **cca_params):
+    # find_corr as it was computed with the sklearn CCA, one fit per target frequency
+    cca = CCA(n_components, **cca_params)
+    corr = np.zeros(n_components)
+    result = np.zeros(freq.shape[0])
+    for freq_idx in range(freq.shape[0]):
+        cca.fit(eeg_data.T, freq[freq_idx].T)
+        O1_a, O1_b = cca.transform(eeg_data.T, freq[freq_idx].T)
+        for ind_val in range(n_components):
+            corr[ind_val] = np.corrcoef(O1_a[:, ind_val], O1_b[:, ind_val])[0, 1]
+        result[freq_idx] = np.max(corr)
+    return result
+
+def ssvep_window(seed, sampling_rate=250, n_samples=750):
+    # 3 s of 8 channels at 250 Hz with a 10 Hz SSVEP
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_samples) / sampling_rate
+    return rng.standard_normal((8, n_samples)) + 0.5 * np.sin(2 * np.pi * 10 * t + rng.uniform(0, np.pi, (8, 1)))
+
+@pytest.mark.parametrize('n_components', [1, 2])
+def test_find_corr_matches_sklearn_cca(n_components):
+    freq = reference_templates([8.5, 10, 12, 15], 250, 750)
+    for seed in range(20):
+        eeg_data = ssvep_window(seed)
+        corr = find_corr(n_components, eeg_data, freq)
+        # sklearn fits the CCA iteratively (NIPALS, tol=1e-6): the median difference of its correlations is
+        # ~5e-7, up to 1.3e-5 in the worst of these windows (seed 18). Converged, it matches the closed form
+        np.testing.assert_allclose(corr, sklearn_find_corr(n_components, eeg_data, freq), rtol=0, atol=2e-5)
+        np.testing.assert_allclose(corr, sklearn_find_corr(n_components, eeg_data, freq, tol=1e-14, max_iter=100000),
+                                   rtol=0, atol=1e-10)
+        assert np.argmax(corr) == 1
+
+class TrialBoard():
+    # Ring buffer of a recorded trial: the marker windows are taken from data, which starts at the go cue
+    def __init__(self, data):
+        self.data = data
+
+    def get_marker_window(self, marker_code, start, stop, timeout=None):
+        return self.data[:, start:stop]
+
+@pytest.mark.parametrize('method', ['cca', 'fbcca'])
+def test_dynamic_window_at_max_window_matches_the_fixed_window(method):
+    import mne
+
+    ch_names = ['Fp1', 'Fp2', 'Cz']
+    mne_info = mne.create_info(ch_names, 250, 'eeg')
+    board = TrialBoard(1e6 * np.stack([ssvep_window(seed, n_samples=1500)[0] for seed in range(3)]))
+    # threshold above 1: no early stopping, the decision is taken at max_window
+    trial_array, y_pred, _ = predict_one_trial_SSVEP_dynamic(board, [0, 1, 2], mne_info, min_window=2, max_window=3,
+                                                             step=0.5, threshold=2, method=method, marker_code=1)
+    fixed_array, fixed_pred = predict_one_trial_SSVEP(board, [0, 1, 2], mne_info, window_length=3, method=method,
+                                                      marker_code=1)
+    np.testing.assert_array_equal(trial_array, fixed_array)
+    assert y_pred == fixed_pred == 1
+
+def mne_preprocess(data, mne_info, tmin=2.5, tmax=4.5):
+    # Preprocessing of a trial with the MNE objects, as predict_one_trial_MI did
+    import mne
+
+    trial_epoch = mne.EpochsArray(data[None], mne_info, verbose=False)
+    trial_epoch.drop_channels(['NA'])
+    trial_epoch.filter(8, 30, verbose=False)
+    trial_epoch.crop(tmin, min(tmax, trial_epoch.tmax))   # the 4.5 s trial ends at its last sample, 4.496 s
+    return trial_epoch.get_data()
+
+@pytest.mark.parametrize('duration', [4.5, 2])   # the trial of predict_one_trial_MI, and one shorter than the filter
+def test_mi_trial_preprocessor_matches_mne(duration):
+    import mne
+
+    mne_info = mne.create_info(['C3', 'Cz', 'C4', 'NA'], 250, 'eeg')
+    data = 1e-5 * np.random.default_rng(0).standard_normal((4, int(duration * 250)))
+    tmin, tmax = (2.5, 4.5) if duration > 2 else (0.5, 1.5)
+    trial_array = MITrialPreprocessor(mne_info, tmin=tmin, tmax=tmax)(data)
+    expected = mne_preprocess(data, mne_info, tmin, tmax)
+    assert trial_array.shape == expected.shape
+    np.testing.assert_allclose(trial_array, expected, rtol=0, atol=1e-12 * np.abs(expected).max())
+
+def test_streaming_covariance_matches_the_covariance_of_the_window():
+    import mne
+    from scipy.signal import sosfilt, sosfilt_zi
+
+    mne_info = mne.create_info(['C3', 'Cz', 'C4', 'NA'], 250, 'eeg')
+    rng = np.random.default_rng(0)
+    stream = 1e-5 * rng.standard_normal((3, 5000))
+    streaming_covariance = StreamingCovariance(None, [0, 1, 2, 3], mne_info, window_length=2, recompute_every=700)
+    # Chunks of the size of the board polls, a few of them longer than the window
+    position = 0
+    while position < stream.shape[1]:
+        n_new = int(rng.choice([1, 5, 12, 600]))
+        streaming_covariance.push(stream[:, position:position + n_new])
+        position = min(position + n_new, stream.shape[1])
+        # Band-pass filter of the whole stream, from the same initial state, and the covariance of its last 2 s
+        # (not centered as np.cov, the band-passed signal has zero mean)
+        sos = streaming_covariance.bandpass.sos
+        filtered = sosfilt(sos, stream[:, :position], zi=sosfilt_zi(sos)[:, None, :] * stream[None, :, :1])[0]
+        if position < 500:
+            assert streaming_covariance.covariance() is None
+            continue
+        window = filtered[:, position - 500:position]
+        expected = regularize_covariance(window @ window.T / 500, streaming_covariance.ridge)
+        np.testing.assert_allclose(streaming_covariance.covariance(), expected, rtol=1e-9, atol=0)
@@ -0,0 +1,28 @@
+import numpy as np
+
+from src.spool import AcquisitionSpool, read_spool
+
+def test_spool_is_read_back_complete_or_partial(tmp_path):
+    path = str(tmp_path / 'run.spool')
+    spool = AcquisitionSpool(path, 4, 250, metadata={'session_type': 'MI'}, chunk_seconds=1)
+    data = np.arange(4 * 700, dtype=float).reshape(4, 700)
+    spool.append(data[:, :300])
+    spool.append(data[:, 300:520])
+    # Before the spool is closed, the chunks already written can be read (e.g. after a crash)
+    header, partial = read_spool(path)
+    assert not header['complete'] and header['metadata'] == {'session_type': 'MI'}
+    np.testing.assert_array_equal(partial, data[:, :500])   # the full chunks
+    spool.append(data[:, 520:])
+    spool.close()
+    header, complete = read_spool(path)
+    assert header['complete'] and header['n_samples'] == 700
+    np.testing.assert_array_equal(complete, data)
+
+def test_spool_ignores_a_partially_written_sample(tmp_path):
+    path = str(tmp_path / 'run.spool')
+    spool = AcquisitionSpool(path, 4, 250)
+    spool.append(np.ones((4, 10)))
+    spool.close()
+    with open(path, 'ab') as file:   # a crash in the middle of the write of a sample
+        file.write(np.zeros(2).tobytes())
+    assert read_spool(path)[1].shape == (4, 10)
@@ -0,0 +1,51 @@
+import time
+
+from src.UdpComms import UdpComms
+from src.markers import MarkerProtocol
+from src.stimulator import HeadlessStimulator
+from tests.test_udpcomms import free_port
+
+MARKERS_DICT = {'start_game': 1, 'end_game': 2, 'start_trial': 3, 'end_trial': 4,
+                'go_cue_left': 10, 'go_cue_right': 11, 'start_feedback_left': 20, 'start_feedback_right': 21,
+                'end_feedback_left': 30, 'end_feedback_right': 31}
+
+def test_headless_protocol_and_decisions():
+    stimulator_port, script_port = free_port(), free_port()
+    receiver = UdpComms(udpIP='127.0.0.1', portTX=stimulator_port, portRX=script_port, enableRX=True,
+                        protocol=MarkerProtocol(binary_decisions=True))
+    go_cues = []
+    def decide(event, receive_time):
+        # Answers each go cue with its class, as the online scripts
+        if event.code in (10, 11):
+            go_cues.append(event.code)
+            receiver.SendBytes(receiver.protocol.encode_decision(len(go_cues), event.code, event.sender_clock))
+    receiver.AddCallback(decide)
+    durations = dict.fromkeys(['start_trial', 'start_feedback', 'end_feedback', 'end_trial'], 0.01)
+    stimulator = HeadlessStimulator(MARKERS_DICT, n_trials=3, durations=dict(durations, go_cue=5),
+                                    wait_for_decision=True, seed=0, portTX=script_port, portRX=stimulator_port)
+    try:
+        start = time.perf_counter()
+        stimulator.start()
+        deadline = time.monotonic() + 10
+        while stimulator.poll() is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert stimulator.poll() == 0
+        # The go cue ends with the decision, not after its 5 s
+        assert time.perf_counter() - start < 5
+        received = [event.code for event, _ in receiver.DrainReceivedData()]
+        assert received == [code for code, _ in stimulator.sent]
+        assert received[0] == 1 and received[-1] == 2
+        assert sorted(go_cues) == [10, 10, 10, 11, 11, 11]
+        trial_codes = received[1:-1]
+        for trial, cls in enumerate(stimulator.trials):
+            assert trial_codes[5 * trial:5 * trial + 5] == [3] + [MARKERS_DICT[f'{name}_{cls}'] for name in
+                                                                  ['go_cue', 'start_feedback', 'end_feedback']] + [4]
+        assert [(decision['trial'], decision['message']) for decision in stimulator.decisions] == \
+            [(trial, MARKERS_DICT[f'go_cue_{cls}']) for trial, cls in enumerate(stimulator.trials, start=1)]
+        summary = stimulator.summary()
+        assert (summary['n_trials'], summary['n_decided_trials'], summary['n_feedback']) == (6, 6, 0)
+        assert 0 < summary['median_latency'] <= summary['max_latency'] < 1
+        assert receiver.protocol.n_lost == receiver.protocol.n_duplicates == 0
+    finally:
+        stimulator.kill()
+        receiver.CloseSocket()
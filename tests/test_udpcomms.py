@@ -0,0 +1,26 @@
+import socket
+import time
+
+from src.UdpComms import UdpComms
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def test_full_queue_drops_and_counts_the_oldest_strings():
+    port = free_port()
+    receiver = UdpComms(udpIP='127.0.0.1', portTX=free_port(), portRX=port, enableRX=True, maxQueue=2)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for code in range(5):
+            sender.sendto(f'{code}-0'.encode(), ('127.0.0.1', port))
+        deadline = time.monotonic() + 2
+        while receiver.n_received < 5 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert (receiver.n_received, receiver.n_overflow) == (5, 3)
+        assert [receiver.ReceiveData(timeout=1) for _ in range(2)] == ['3-0', '4-0']
+        assert receiver.ReceiveData(timeout=0.01) is None
+    finally:
+        sender.close()
+        receiver.CloseSocket()
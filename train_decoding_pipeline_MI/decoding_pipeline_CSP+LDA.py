@@ -1,140 +1,162 @@
-import numpy as np
-import os
-import json
-import mne
-
-import pickle
-from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
-from mne.decoding import CSP
-
-import pandas as pd
-
-
-# Import the parent directory and the src to system
-actual_path = os.path.dirname(os.path.realpath(__file__))
-parent_path = os.path.abspath(os.path.join(actual_path, os.pardir))
-os.sys.path.append(parent_path)
-os.sys.path.append(os.path.join(parent_path, 'src'))
-
-# Import the path to save the data
-from global_config import PATH_TO_SAVE_DATA_EEG_MI, PATH_TO_SAVE_MODELS_EEG_MI
-
-mne.set_log_level(verbose='warning') #to avoid info at terminal
-
-# SELECT THE SUBJECT, SESSION, RUNS AND TASK TO TRAIN THE DECODING PIPELINE
-training_subject_ID =  "003"
-training_session_ID = "0"
-training_runs_ID = ["3", "4","5"]
-training_task = "MI"
-project_name = "MIBCIproject"
-
-epochs = []
-for run in training_runs_ID:
-    # Load the training data
-    training_folder_path = os.path.join(PATH_TO_SAVE_DATA_EEG_MI, project_name, 'sub-' + training_subject_ID, 'ses-' + training_session_ID, 'eeg')
-    filename = os.path.join(training_folder_path, 'sub-' + training_subject_ID + '_ses-' + training_session_ID + '_task-' + training_task + '_run-' + run + '_eeg.vhdr')
-    raw = mne.io.read_raw_brainvision(filename, preload=True)
-
-    # Drop the last channel, since it is not being recorded
-    raw.drop_channels('NA')
-    
-    # Create events from annotations
-    event_annot = pd.read_csv(filename[:-8] + 'events.tsv', sep='\t')
-    event_annot = event_annot.loc[event_annot['trial_type'].isin(['go_cue_MI', 'go_cue_rest'])]
-    events_matrix = np.vstack((event_annot['sample'],
-                                event_annot['duration'],
-                                event_annot['value'])).T
-    events_matrix = events_matrix.astype('int32')
-    # Set montage
-    ten_twenty_montage = mne.channels.make_standard_montage(
-        'standard_1020')
-    raw.info.set_montage(ten_twenty_montage)
-
-    ########################### PREPROCESSING ###########################
-    # Band-pass and notch filtering
-    raw.filter(1, 60)
-    raw.notch_filter(50)
-
-    # Epoching
-    tmin, tmax = -3, 6  # -1 s before trial indicative
-    event_ids = dict(MI=420, rest=421)  # map event IDs to tasks
-
-    epochs_i = mne.Epochs(raw, events_matrix, tmin=tmin, tmax=tmax,
-                         event_id=event_ids,
-                         reject=None, baseline=None,
-                         preload=True)
-    
-    epochs_i.filter(8, 30) # mu and beta band
-
-    epochs.append(epochs_i)
-
-epochs = mne.concatenate_epochs(epochs, verbose='ERROR')
-
-# Crop epochs for the decoding pipeline from 0.5 to 2.5 after GO cue
-epochs.crop(2.5, 4.5)
-
-# Train the decoding pipeline
-data = epochs.get_data()
-labels = epochs.events[:, -1]
-
-# Change labels to 0 and 1 - 0 class rest
-labels[labels == 422] = 0
-labels[labels == 421] = 1
-
-
-############################# Data partitioning for training and testing #############################
-
-train_data, test_data = [], []
-train_labels, test_labels = [], []
-
-for label in np.unique(labels):
-    class_indices = np.where(labels == label)[0]
-    train_size = int(len(class_indices) * 0.8)
-
-    # Divide los índices sin mezclar
-    train_indices = class_indices[:train_size]
-    test_indices = class_indices[train_size:]
-
-    # Añade los datos de entrenamiento y prueba
-    train_data.append(data[train_indices])
-    test_data.append(data[test_indices])
-    train_labels.append(labels[train_indices])
-    test_labels.append(labels[test_indices])
-
-# Concatena las listas para obtener arrays finales
-train_data = np.concatenate(train_data)
-test_data = np.concatenate(test_data)
-train_labels = np.concatenate(train_labels)
-test_labels = np.concatenate(test_labels)
-
-######################### TRAINING THE DECODING PIPELINE #########################
-
-csp = CSP(n_components=6, reg='empirical', log=True, norm_trace=True, cov_est='epoch')
-lda = LinearDiscriminantAnalysis()
-
-train_data_csp = csp.fit_transform(train_data.astype(float), train_labels)
-lda.fit(train_data_csp, train_labels)
-
-print('Test accuracy: ', lda.score(csp.transform(test_data.astype(float)), test_labels))
-
-
-######################### TRAIN WITH THE WHOLE DATA #########################
-
-csp = CSP(n_components=6, reg='empirical', log=True, norm_trace=True, cov_est='epoch')
-lda = LinearDiscriminantAnalysis()
-
-data_csp = csp.fit_transform(data.astype(float), labels)
-lda.fit(data_csp, labels)
-
-print(f'Calibration: {lda.score(data_csp, labels)}')
-
-
-# Save the decoding pipeline
-trained_pipeline = {'csp': csp, 'lda': lda}
-
-# Check the path to save the model
-save_model_path = os.path.join(PATH_TO_SAVE_MODELS_EEG_MI, project_name, 'sub-' + training_subject_ID, 'ses-' + training_session_ID)
-os.makedirs(save_model_path, exist_ok=True)
-
-with open(os.path.join(save_model_path, 'CSP_LDA.pkl'), 'wb') as file:
-    pickle.dump(trained_pipeline, file)
\ No newline at end of file
+import numpy as np
+import os
+import json
+import mne
+
+import pickle
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from mne.decoding import CSP
+
+import pandas as pd
+
+
+# Import the parent directory and the src to system
+actual_path = os.path.dirname(os.path.realpath(__file__))
+parent_path = os.path.abspath(os.path.join(actual_path, os.pardir))
+os.sys.path.append(parent_path)
+os.sys.path.append(os.path.join(parent_path, 'src'))
+
+from src.decoders import FusedCSPLDA
+from src.epoch_cache import EpochCache
+
+# Import the path to save the data
+from global_config import PATH_TO_SAVE_DATA_EEG_MI, PATH_TO_SAVE_MODELS_EEG_MI
+
+mne.set_log_level(verbose='warning') #to avoid info at terminal
+
+# SELECT THE SUBJECT, SESSION, RUNS AND TASK TO TRAIN THE DECODING PIPELINE
+training_subject_ID =  "003"
+training_session_ID = "0"
+training_runs_ID = ["3", "4","5"]
+training_task = "MI"
+project_name = "MIBCIproject"
+
+# Preprocessing of each run. The preprocessed epochs are cached in the derivatives folder of the project, keyed by
+# the content of the run files and these parameters, so the runs are only filtered again when they or the
+# parameters change (see src.epoch_cache)
+preprocessing_params = dict(drop_channels=['NA'], trial_types=['go_cue_MI', 'go_cue_rest'], montage='standard_1020',
+                            l_freq=1, h_freq=60, notch_freq=50,   # band-pass and notch filtering
+                            tmin=-3, tmax=6,   # -1 s before trial indicative
+                            event_ids=dict(MI=420, rest=421),   # map event IDs to tasks
+                            epochs_l_freq=8, epochs_h_freq=30)   # mu and beta band
+epoch_cache = EpochCache(os.path.join(PATH_TO_SAVE_DATA_EEG_MI, project_name, 'derivatives', 'epoch_cache'))
+
+def preprocess_run(filename, params):
+    raw = mne.io.read_raw_brainvision(filename, preload=True)
+
+    # Drop the last channel, since it is not being recorded
+    raw.drop_channels(params['drop_channels'])
+    
+    # Create events from annotations
+    event_annot = pd.read_csv(filename[:-8] + 'events.tsv', sep='\t')
+    event_annot = event_annot.loc[event_annot['trial_type'].isin(params['trial_types'])]
+    events_matrix = np.vstack((event_annot['sample'],
+                                event_annot['duration'],
+                                event_annot['value'])).T
+    events_matrix = events_matrix.astype('int32')
+    # Set montage
+    ten_twenty_montage = mne.channels.make_standard_montage(
+        params['montage'])
+    raw.info.set_montage(ten_twenty_montage)
+
+    ########################### PREPROCESSING ###########################
+    # Band-pass and notch filtering
+    raw.filter(params['l_freq'], params['h_freq'])
+    raw.notch_filter(params['notch_freq'])
+
+    # Epoching
+    epochs_i = mne.Epochs(raw, events_matrix, tmin=params['tmin'], tmax=params['tmax'],
+                         event_id=params['event_ids'],
+                         reject=None, baseline=None,
+                         preload=True)
+    
+    epochs_i.filter(params['epochs_l_freq'], params['epochs_h_freq']) # mu and beta band
+    return epochs_i
+
+epochs = []
+for run in training_runs_ID:
+    # Load the training data
+    training_folder_path = os.path.join(PATH_TO_SAVE_DATA_EEG_MI, project_name, 'sub-' + training_subject_ID, 'ses-' + training_session_ID, 'eeg')
+    filename = os.path.join(training_folder_path, 'sub-' + training_subject_ID + '_ses-' + training_session_ID + '_task-' + training_task + '_run-' + run + '_eeg.vhdr')
+    run_files = [filename, filename[:-5] + '.eeg', filename[:-5] + '.vmrk', filename[:-8] + 'events.tsv']
+    epochs_i = epoch_cache.get(run_files, preprocessing_params, lambda: preprocess_run(filename, preprocessing_params))
+
+    epochs.append(epochs_i)
+
+print(f"Epoch cache: {epoch_cache.hits} runs loaded from the cache, {epoch_cache.misses} runs preprocessed")
+
+epochs = mne.concatenate_epochs(epochs, verbose='ERROR')
+
+# Crop epochs for the decoding pipeline from 0.5 to 2.5 after GO cue
+epochs.crop(2.5, 4.5)
+
+# Train the decoding pipeline
+data = epochs.get_data()
+labels = epochs.events[:, -1]
+
+# Change labels to 0 and 1 - 0 class rest
+labels[labels == 421] = 0
+labels[labels == 420] = 1
+
+
+############################# Data partitioning for training and testing #############################
+
+train_data, test_data = [], []
+train_labels, test_labels = [], []
+
+for label in np.unique(labels):
+    class_indices = np.where(labels == label)[0]
+    train_size = int(len(class_indices) * 0.8)
+
+    # Divide los índices sin mezclar
+    train_indices = class_indices[:train_size]
+    test_indices = class_indices[train_size:]
+
+    # Añade los datos de entrenamiento y prueba
+    train_data.append(data[train_indices])
+    test_data.append(data[test_indices])
+    train_labels.append(labels[train_indices])
+    test_labels.append(labels[test_indices])
+
+# Concatena las listas para obtener arrays finales
+train_data = np.concatenate(train_data)
+test_data = np.concatenate(test_data)
+train_labels = np.concatenate(train_labels)
+test_labels = np.concatenate(test_labels)
+
+######################### TRAINING THE DECODING PIPELINE #########################
+
+csp = CSP(n_components=6, reg='empirical', log=True, norm_trace=True, cov_est='epoch')
+lda = LinearDiscriminantAnalysis(store_covariance=True)   # the covariance is needed to adapt the model online
+
+train_data_csp = csp.fit_transform(train_data.astype(float), train_labels)
+lda.fit(train_data_csp, train_labels)
+
+# Evaluate with the fused CSP+LDA kernel, the same one used online
+fused_pipeline = FusedCSPLDA.from_pipeline({'csp': csp, 'lda': lda})
+print('Test accuracy: ', np.mean(fused_pipeline.predict(test_data) == test_labels))
+
+
+######################### TRAIN WITH THE WHOLE DATA #########################
+
+csp = CSP(n_components=6, reg='empirical', log=True, norm_trace=True, cov_est='epoch')
+lda = LinearDiscriminantAnalysis(store_covariance=True)   # the covariance is needed to adapt the model online
+
+data_csp = csp.fit_transform(data.astype(float), labels)
+lda.fit(data_csp, labels)
+
+print(f'Calibration: {lda.score(data_csp, labels)}')
+
+
+# Save the decoding pipeline
+trained_pipeline = {'csp': csp, 'lda': lda}
+
+# Check the path to save the model
+save_model_path = os.path.join(PATH_TO_SAVE_MODELS_EEG_MI, project_name, 'sub-' + training_subject_ID, 'ses-' + training_session_ID)
+os.makedirs(save_model_path, exist_ok=True)
+
+with open(os.path.join(save_model_path, 'CSP_LDA.pkl'), 'wb') as file:
+    pickle.dump(trained_pipeline, file)
+
+# Save the fused version of the pipeline, loaded by the online decoder
+FusedCSPLDA.from_pipeline(trained_pipeline).save(os.path.join(save_model_path, 'CSP_LDA.npz'))
\ No newline at end of file
@@ -0,0 +1,113 @@
+import numpy as np
+import os
+import mne
+
+import pandas as pd
+
+
+# Import the parent directory and the src to system
+actual_path = os.path.dirname(os.path.realpath(__file__))
+parent_path = os.path.abspath(os.path.join(actual_path, os.pardir))
+os.sys.path.append(parent_path)
+os.sys.path.append(os.path.join(parent_path, 'src'))
+
+from src.processing import StreamingBandpass
+from src.decoders import TangentSpaceLDA, regularize_covariance
+
+# Import the path to save the data
+from global_config import PATH_TO_SAVE_DATA_EEG_MI, PATH_TO_SAVE_MODELS_EEG_MI
+
+mne.set_log_level(verbose='warning') #to avoid info at terminal
+
+# SELECT THE SUBJECT, SESSION, RUNS AND TASK TO TRAIN THE DECODING PIPELINE
+training_subject_ID =  "003"
+training_session_ID = "0"
+training_runs_ID = ["3", "4","5"]
+training_task = "MI"
+project_name = "MIBCIproject"
+
+# Decoding parameters, the online StreamingCovariance uses the same ones
+l_freq, h_freq = 8, 30   # causal band-pass filter (Hz)
+window_end = 2.5   # the covariance window ends 2.5 s after the go cue
+window_length = 2   # s
+ridge = 1e-3   # regularization of the covariances, relative to their trace (they can be rank-deficient)
+
+# rest: 0 , MI: 1 , as in the online session
+event_ids = dict(go_cue_rest=0, go_cue_MI=1)
+
+covariances = []
+labels = []
+for run in training_runs_ID:
+    # Load the training data
+    training_folder_path = os.path.join(PATH_TO_SAVE_DATA_EEG_MI, project_name, 'sub-' + training_subject_ID, 'ses-' + training_session_ID, 'eeg')
+    filename = os.path.join(training_folder_path, 'sub-' + training_subject_ID + '_ses-' + training_session_ID + '_task-' + training_task + '_run-' + run + '_eeg.vhdr')
+    raw = mne.io.read_raw_brainvision(filename, preload=True)
+
+    # Drop the last channel, since it is not being recorded
+    raw.drop_channels('NA')
+    ch_names = raw.ch_names
+    sampling_rate = raw.info['sfreq']
+
+    # Go cues of the run
+    event_annot = pd.read_csv(filename[:-8] + 'events.tsv', sep='\t')
+    event_annot = event_annot.loc[event_annot['trial_type'].isin(list(event_ids))]
+
+    ########################### PREPROCESSING ###########################
+    # The whole run is filtered with the causal filter used online, so the training covariances
+    # are the ones that the StreamingCovariance computes during the online session
+    bandpass = StreamingBandpass(len(ch_names), sampling_rate, l_freq, h_freq)
+    data = bandpass(raw.get_data())
+    n_window = int(window_length * sampling_rate)
+    for sample, trial_type in zip(event_annot['sample'], event_annot['trial_type']):
+        stop = int(sample + window_end * sampling_rate)
+        if stop > data.shape[1]:
+            continue
+        window = data[:, stop - n_window:stop]
+        covariances.append(regularize_covariance(window @ window.T / n_window, ridge))
+        labels.append(event_ids[trial_type])
+
+covariances = np.array(covariances)
+labels = np.array(labels)
+print(f'Trials per class: {np.bincount(labels)}')
+
+
+############################# Data partitioning for training and testing #############################
+
+train_data, test_data = [], []
+train_labels, test_labels = [], []
+
+for label in np.unique(labels):
+    class_indices = np.where(labels == label)[0]
+    train_size = int(len(class_indices) * 0.8)
+
+    # Split the indices without shuffling
+    train_indices = class_indices[:train_size]
+    test_indices = class_indices[train_size:]
+
+    train_data.append(covariances[train_indices])
+    test_data.append(covariances[test_indices])
+    train_labels.append(labels[train_indices])
+    test_labels.append(labels[test_indices])
+
+train_data = np.concatenate(train_data)
+test_data = np.concatenate(test_data)
+train_labels = np.concatenate(train_labels)
+test_labels = np.concatenate(test_labels)
+
+######################### TRAINING THE DECODING PIPELINE #########################
+
+decoder = TangentSpaceLDA.fit(train_data, train_labels, ch_names, l_freq, h_freq, ridge)
+print('Test accuracy: ', np.mean(decoder.predict(test_data) == test_labels))
+
+
+######################### TRAIN WITH THE WHOLE DATA #########################
+
+decoder = TangentSpaceLDA.fit(covariances, labels, ch_names, l_freq, h_freq, ridge)
+print(f'Calibration: {np.mean(decoder.predict(covariances) == labels)}')
+
+
+# Check the path to save the model
+save_model_path = os.path.join(PATH_TO_SAVE_MODELS_EEG_MI, project_name, 'sub-' + training_subject_ID, 'ses-' + training_session_ID)
+os.makedirs(save_model_path, exist_ok=True)
+
+decoder.save(os.path.join(save_model_path, 'TS_LDA.npz'))
@@ -0,0 +1,119 @@
+import numpy as np
+import os
+import mne
+from scipy.signal import sosfiltfilt
+
+import pandas as pd
+
+
+# Import the parent directory and the src to system
+actual_path = os.path.dirname(os.path.realpath(__file__))
+parent_path = os.path.abspath(os.path.join(actual_path, os.pardir))
+os.sys.path.append(parent_path)
+os.sys.path.append(os.path.join(parent_path, 'src'))
+
+from src.processing import TRCADecoder, train_trca, design_bandpass, window_n_samples, SSVEP_CHANNELS
+
+# Import the path to save the data
+from global_config import PATH_TO_SAVE_DATA_EEG_MI, PATH_TO_SAVE_MODELS_EEG_MI
+
+mne.set_log_level(verbose='warning') #to avoid info at terminal
+
+# SELECT THE SUBJECT, SESSION, RUNS AND TASK TO TRAIN THE DECODING PIPELINE
+training_subject_ID =  "001"
+training_session_ID = "0"
+training_runs_ID = ["1"]
+training_task = "SSVEP"
+project_name = "SSVEPBCIproject"
+
+# Decoding parameters, the online decoder uses the same preprocessing
+channels = SSVEP_CHANNELS
+l_freq, h_freq = 6, 40   # band-pass filter (Hz)
+window_length = 3   # longest window (s) that the online decoder can use, starting 1 s after the go cue
+
+# left: 8.5 Hz / 0 , right: 10 Hz / 1 , up: 12Hz / 2 ,  down: 15Hz / 3
+event_ids = dict(go_cue_left=0, go_cue_right=1, go_cue_up=2, go_cue_down=3)
+
+trials = []
+labels = []
+for run in training_runs_ID:
+    # Load the training data
+    training_folder_path = os.path.join(PATH_TO_SAVE_DATA_EEG_MI, project_name, 'sub-' + training_subject_ID, 'ses-' + training_session_ID, 'eeg')
+    filename = os.path.join(training_folder_path, 'sub-' + training_subject_ID + '_ses-' + training_session_ID + '_task-' + training_task + '_run-' + run + '_eeg.vhdr')
+    raw = mne.io.read_raw_brainvision(filename, preload=True)
+    raw.pick(channels)
+    sampling_rate = raw.info['sfreq']
+
+    # Go cues of the run
+    event_annot = pd.read_csv(filename[:-8] + 'events.tsv', sep='\t')
+    event_annot = event_annot.loc[event_annot['trial_type'].isin(list(event_ids))]
+
+    ########################### PREPROCESSING ###########################
+    # Same as online: the trial from the go cue to window_length + 2 s is band-pass filtered,
+    # and cropped from 1 s to window_length + 1 s post go cue
+    sos = design_bandpass(sampling_rate, l_freq, h_freq)
+    data = raw.get_data()
+    n_samples = int((window_length + 2) * sampling_rate)
+    start = int(round(1 * sampling_rate))
+    stop = start + window_n_samples(window_length, sampling_rate)
+    for sample, trial_type in zip(event_annot['sample'], event_annot['trial_type']):
+        if sample + n_samples > data.shape[1]:
+            continue
+        trial = sosfiltfilt(sos, data[:, sample:sample + n_samples], axis=-1)
+        trials.append(trial[:, start:stop])
+        labels.append(event_ids[trial_type])
+
+trials = np.array(trials)
+labels = np.array(labels)
+print(f'Trials per class: {np.bincount(labels)}')
+
+
+############################# Data partitioning for training and testing #############################
+
+train_data, test_data = [], []
+train_labels, test_labels = [], []
+
+for label in np.unique(labels):
+    class_indices = np.where(labels == label)[0]
+    train_size = int(len(class_indices) * 0.8)
+
+    # Split the indices without shuffling
+    train_indices = class_indices[:train_size]
+    test_indices = class_indices[train_size:]
+
+    train_data.append(trials[train_indices])
+    test_data.append(trials[test_indices])
+    train_labels.append(labels[train_indices])
+    test_labels.append(labels[test_indices])
+
+train_data = np.concatenate(train_data)
+test_data = np.concatenate(test_data)
+train_labels = np.concatenate(train_labels)
+test_labels = np.concatenate(test_labels)
+
+######################### TRAINING THE DECODING PIPELINE #########################
+
+filters, templates = train_trca(train_data, train_labels)
+decoder = TRCADecoder(filters, templates, sampling_rate, channels, l_freq, h_freq)
+
+# Accuracy on the test trials for the window lengths that can be used online
+for test_window in np.arange(0.5, window_length + 0.5, 0.5):
+    n_window = window_n_samples(test_window, sampling_rate)
+    y_pred = np.argmax(decoder.scores(test_data[..., :n_window]), axis=-1)
+    print(f'Test accuracy ({test_window} s): {np.mean(y_pred == test_labels)}')
+
+
+######################### TRAIN WITH THE WHOLE DATA #########################
+
+filters, templates = train_trca(trials, labels)
+decoder = TRCADecoder(filters, templates, sampling_rate, channels, l_freq, h_freq)
+
+y_pred = np.argmax(decoder.scores(trials), axis=-1)
+print(f'Calibration: {np.mean(y_pred == labels)}')
+
+
+# Check the path to save the model
+save_model_path = os.path.join(PATH_TO_SAVE_MODELS_EEG_MI, project_name, 'sub-' + training_subject_ID, 'ses-' + training_session_ID)
+os.makedirs(save_model_path, exist_ok=True)
+
+decoder.save(os.path.join(save_model_path, 'TRCA.npz'))